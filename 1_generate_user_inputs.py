@@ -1,15 +1,22 @@
+import argparse
+import difflib
 import os
 import json
 import random
-import glob
 import re
-import time
+import threading
+import unicodedata
 from datetime import datetime
-import pandas as pd
 import boto3
-from botocore.exceptions import ClientError
 
 import config
+from bedrock_cache import cached_call, open_bedrock_cache
+from checkpoint import CheckpointWriter, read_csv_rows
+from kb_chunker import TokenEstimator, chunk_document, load_token_counts, normalize_file_key
+from kb_loader import extract_bd_code, kb_relpath, read_kb_texts, scan_kb
+from kb_manifest import build_manifest, diff_manifests, load_manifest, save_manifest
+from parallel import ordered_map
+from throttling import AdaptiveConcurrencyController
 
 # --- CHILEAN BANKING CONTEXT CONFIGURATION ---
 
@@ -44,12 +51,86 @@ QUERY_STYLES = [
     },
 ]
 
-def extract_bd_code(filename):
-    if not filename:
-        return ""
-    return filename[:9]
+# --- QUESTION GENERATION PROMPTS ---
 
+QUESTION_RULES_PROMPT = """
+### ROL DEL SISTEMA
+Eres un Generador de Datos Sintéticos especializado en Banca y Bienes Raíces de Chile.
+Tu trabajo es crear el "Test Set" para evaluar un asistente de IA (RAG) del Banco Estado (Casaverso).
+
+### TAREA PRINCIPAL
+Se te entregará un fragmento de texto (La "Respuesta").
+Tu objetivo es redactar la **Consulta del Usuario** (El "Input") que provocaría que el sistema recupere este texto como respuesta.
+
+### REGLAS DE ORO (CRÍTICO: LEER CON ATENCIÓN)
+1. **ASIMETRÍA DE INFORMACIÓN:** El usuario NO ha leído el texto. No sabe los términos técnicos exactos, ni los porcentajes, ni los artículos de la ley que aparecen en el texto.
+2. **INTENCIÓN vs CONTENIDO:**
+- MAL (Contaminado): "¿Cuáles son los requisitos del artículo 5 del subsidio DS19?" (El usuario no sabe que existe el artículo 5).
+- BIEN (Realista): "Oye, ¿qué papeles me piden para postular al subsidio?"
+3. **ABSTRACCIÓN:** Si el texto habla de "Tasa fija del 4.5%", el usuario NO pregunta "¿Es la tasa del 4.5%?". El usuario pregunta "¿Cómo están las tasas hoy?".
+4. **SI EL TEXTO ES CORTO/PARCIAL:** Si el fragmento es muy específico o técnico, el usuario debe hacer una pregunta más amplia o vaga que este fragmento respondería parcialmente.
+5. **CONTEXTO CHILENO:** Usa vocabulario local, modismos y el tono correspondiente al estilo solicitado.
+
+
+### DOCUMENTO DE REFERENCIA:
+Se te etregará un fragmento de texto que el asistente debería recuperar como respuesta a la consulta del usuario.
+
+"""
+
+SINGLE_QUESTION_FORMAT_PROMPT = """### ESTILOS DE CONSULTA DISPONIBLES:
+Se te entregará una lista de 2 estilos. 
+Debes seleccionar uno de los estilos para redactar la pregunta. 
+Si ambos estilos sirven para el fragmento, selecciona al azar, no siempre el más simple. Si sólo uno sirve, úsalo. Si ninguno sirve, elige el que mejor se adapte con modificaciones.
+Luego, debes redactar la consulta adoptando el estilo seleccionado.
+
+### FORMATO DE SALIDA
+Tu respuesta serán dos tags xml: <style_name> y <user_input>.
+El texto dentro de style_name es el nombre del estilo seleccionado. Debes mantener el MISMO style_name entregado.
+El texto dentro del <user_input> debe ser la consulta generada, sin comillas, sin saltos de línea, sin explicaciones adicionales. Es el texto plano de la consulta del usuario.
+Responde ÚNICAMENTE con este formato XML (sin markdown, sin explicaciones):
+
+<style_name>NOMBRE_DEL_ESTILO</style_name>
+<user_input>TU_CONSULTA_GENERADA_AQUI</user_input>
+"""
+
+# Used when several questions (one per style) are requested in a single call.
+BATCH_QUESTION_FORMAT_PROMPT = """### ESTILOS DE CONSULTA ASIGNADOS:
+Se te entregará una lista de estilos.
+Debes redactar UNA consulta distinta por cada estilo de la lista, en el mismo orden, adoptando ese estilo.
+Las consultas deben ser independientes entre sí y no repetir la misma pregunta con otras palabras.
+
+### FORMATO DE SALIDA
+Tu respuesta será un bloque <question> por cada estilo, cada uno con dos tags xml: <style_name> y <user_input>.
+El texto dentro de style_name es el nombre del estilo asignado. Debes mantener el MISMO style_name entregado.
+El texto dentro del <user_input> debe ser la consulta generada, sin comillas, sin saltos de línea, sin explicaciones adicionales. Es el texto plano de la consulta del usuario.
+Responde ÚNICAMENTE con este formato XML (sin markdown, sin explicaciones):
+
+<question>
+<style_name>NOMBRE_DEL_ESTILO_1</style_name>
+<user_input>CONSULTA_PARA_EL_ESTILO_1</user_input>
+</question>
+<question>
+<style_name>NOMBRE_DEL_ESTILO_2</style_name>
+<user_input>CONSULTA_PARA_EL_ESTILO_2</user_input>
+</question>
+"""
+
+TESTSET_COLUMNS = ["user_input", "reference_contexts", "query_style", "source_file"]
+if config.CHUNKING_ENABLED:
+    TESTSET_COLUMNS.append("chunk_id")
+
+PARSE_FAIL_LOG_LOCK = threading.Lock()
+
+# How each generated response was parsed: strict regexes, the local lenient
+# tier, the LLM repair call, or not at all. repair_calls_avoided only counts
+# lenient parses on the single-question path, the one that would otherwise
+# have made an LLM repair call (batched mode never does).
+PARSE_STATS = {"strict": 0, "lenient": 0, "llm_repair": 0, "failed": 0, "repair_calls_avoided": 0}
+PARSE_STATS_LOCK = threading.Lock()
 
+def record_parse(kind):
+    with PARSE_STATS_LOCK:
+        PARSE_STATS[kind] += 1
 
 def get_bedrock_client():
     session = boto3.Session(profile_name=config.AWS_PROFILE_LLM)
@@ -60,32 +141,11 @@ def ensure_parent_dir(path):
     if parent:
         os.makedirs(parent, exist_ok=True)
 
-def backoff_sleep(attempt):
-    base = config.BACKOFF_BASE_SECONDS * (2 ** attempt)
-    sleep_for = min(base, config.BACKOFF_MAX_SECONDS)
-    sleep_for += random.uniform(0, config.BACKOFF_JITTER_SECONDS)
-    time.sleep(sleep_for)
+# Shared AIMD limiter + retry policy for every Bedrock call in this stage.
+RETRY_CONTROLLER = AdaptiveConcurrencyController()
 
 def call_with_retry(fn, operation_name, error_log):
-    last_error = None
-    for attempt in range(config.MAX_RETRIES + 1):
-        try:
-            return fn()
-        except ClientError as e:
-            last_error = e
-        except Exception as e:
-            last_error = e
-
-        if attempt < config.MAX_RETRIES:
-            backoff_sleep(attempt)
-        else:
-            if last_error is not None:
-                error_log.append({
-                    "timestamp": datetime.utcnow().isoformat() + "Z",
-                    "operation": operation_name,
-                    "error": str(last_error),
-                })
-            return None
+    return RETRY_CONTROLLER.call(fn, operation_name, error_log)
 
 def clean_llm_output(text):
     """Removes <reasoning> tags and their content from the LLM output."""
@@ -114,7 +174,141 @@ def parse_llm_xml(content, allowed_styles):
 
     return question_text, style_found, content_no_reasoning
 
-def repair_xml_response(raw_content, allowed_styles, client, error_log):
+def normalize_style_name(name):
+    """Casefolds, strips accents, quotes and repeated whitespace from a style name."""
+    decomposed = unicodedata.normalize("NFKD", name or "")
+    no_accents = "".join(c for c in decomposed if not unicodedata.combining(c))
+    no_quotes = no_accents.strip().strip("'\"`*.").casefold()
+    return " ".join(no_quotes.split())
+
+def match_allowed_style(style_found, allowed_styles, cutoff=0.8):
+    """Maps a style name with different casing, accents or small typos to its allowed spelling."""
+    if not allowed_styles:
+        return style_found
+    normalized = {normalize_style_name(style): style for style in allowed_styles}
+    key = normalize_style_name(style_found)
+    if key in normalized:
+        return normalized[key]
+    close = difflib.get_close_matches(key, list(normalized), n=1, cutoff=cutoff)
+    return normalized[close[0]] if close else None
+
+def strip_llm_noise(text):
+    """Removes markdown fences and complete or dangling <reasoning> fragments."""
+    text = re.sub(r'```[a-zA-Z]*', '', text)
+    text = re.sub(r'<reasoning>.*?</reasoning>', '', text, flags=re.DOTALL | re.IGNORECASE)
+    # Unclosed <reasoning>: drop it up to the first answer tag.
+    text = re.sub(
+        r'<reasoning>.*?(?=<(?:question|style_name|user_input)>|$)',
+        '',
+        text,
+        flags=re.DOTALL | re.IGNORECASE
+    )
+    # Stray </reasoning>: everything before it is reasoning.
+    parts = re.split(r'</reasoning>', text, flags=re.IGNORECASE)
+    return parts[-1].strip()
+
+def extract_lenient_tag(tag, text):
+    """Tag content up to its closing tag, the next opening tag, or (for style) the end of line."""
+    match = re.search(
+        rf'<{tag}>(.*?)(?:</{tag}>|(?=<[a-zA-Z_]+>)|$)',
+        text,
+        re.DOTALL | re.IGNORECASE
+    )
+    if not match:
+        return None
+    return match.group(1).strip()
+
+def lenient_parse_llm_xml(content, allowed_styles):
+    """
+    Local recovery tier used before paying for an LLM repair call. Handles
+    markdown-fenced XML, unclosed tags, dangling <reasoning> fragments and
+    style names that differ in casing, accents or small typos.
+    """
+    cleaned = strip_llm_noise(content)
+
+    style_raw = extract_lenient_tag("style_name", cleaned)
+    question_raw = extract_lenient_tag("user_input", cleaned)
+    if style_raw is None or question_raw is None:
+        return None, None, cleaned
+
+    style_found = match_allowed_style(style_raw.split("\n")[0], allowed_styles)
+    question_text = re.sub(r'</?[a-zA-Z_]+>', '', question_raw)
+    question_text = question_text.replace('"', '').replace('\n', ' ').strip()
+
+    if not (style_found and question_text):
+        return None, None, cleaned
+
+    return question_text, style_found, cleaned
+
+def parse_llm_xml_items(content, allowed_styles):
+    """
+    Parses a batched response into a list of (question, style) pairs. Each
+    <question> block is validated on its own, so one malformed item does not
+    discard the rest of the response.
+    """
+    content_no_reasoning = strip_llm_noise(clean_llm_output(content))
+
+    blocks = re.findall(r'<question>(.*?)</question>', content_no_reasoning, re.DOTALL | re.IGNORECASE)
+    if not blocks:
+        # The model dropped the wrapper tags: pair style/input tags in order.
+        styles = re.findall(r'<style_name>(.*?)</style_name>', content_no_reasoning, re.DOTALL | re.IGNORECASE)
+        inputs = re.findall(r'<user_input>(.*?)</user_input>', content_no_reasoning, re.DOTALL | re.IGNORECASE)
+        blocks = [
+            f"<style_name>{style}</style_name><user_input>{question}</user_input>"
+            for style, question in zip(styles, inputs)
+        ]
+
+    items = []
+    seen_styles = set()
+    for block in blocks:
+        question_text, style_found, _ = parse_llm_xml(block, allowed_styles)
+        parsed_by = "strict"
+        if not (question_text and style_found):
+            question_text, style_found, _ = lenient_parse_llm_xml(block, allowed_styles)
+            parsed_by = "lenient"
+        if question_text and style_found and style_found not in seen_styles:
+            items.append((question_text, style_found))
+            seen_styles.add(style_found)
+            record_parse(parsed_by)
+
+    return items, content_no_reasoning
+
+def log_parse_failure(parse_fail_log_path, reason, allowed_styles, cleaned):
+    ensure_parent_dir(parse_fail_log_path)
+    with PARSE_FAIL_LOG_LOCK, open(parse_fail_log_path, "a", encoding="utf-8") as log_file:
+        log_file.write(json.dumps({
+            "timestamp": datetime.utcnow().isoformat() + "Z",
+            "reason": reason,
+            "allowed_styles": allowed_styles,
+            "raw_response": cleaned,
+        }, ensure_ascii=False) + "\n")
+
+def invoke_llm_content(body, operation_name, client, error_log, cache=None):
+    """Invokes MODEL_ID (through the response cache) and returns the message text, or None."""
+    def _call():
+        return client.invoke_model(
+            modelId=config.MODEL_ID,
+            body=body
+        )
+
+    def _invoke():
+        response = call_with_retry(_call, operation_name, error_log)
+        if response is None:
+            return None
+        return response.get('body').read().decode('utf-8')
+
+    raw_response = cached_call(cache, config.MODEL_ID, body, _invoke)
+    if raw_response is None:
+        return None
+
+    response_body = json.loads(raw_response)
+    if 'choices' in response_body:
+        return response_body['choices'][0]['message']['content']
+    if 'output' in response_body:
+        return response_body['output']['message']['content']
+    return str(response_body)
+
+def repair_xml_response(raw_content, allowed_styles, client, error_log, cache=None):
     allowed_str = ", ".join(allowed_styles) if allowed_styles else ""
     repair_prompt = f"""
 Extrae la consulta del usuario y el estilo desde el siguiente texto y devuelve SOLO el formato XML requerido.
@@ -135,66 +329,16 @@ Formato requerido (sin markdown, sin texto adicional):
         "max_tokens": 500,
     })
 
-    def _call():
-        return client.invoke_model(
-            modelId=config.MODEL_ID,
-            body=body
-        )
-
-    response = call_with_retry(_call, "invoke_model_repair", error_log)
-    if response is None:
+    content = invoke_llm_content(body, "invoke_model_repair", client, error_log, cache)
+    if content is None:
         return None, None, None
 
-    response_body = json.loads(response.get('body').read().decode('utf-8'))
-    if 'choices' in response_body:
-        content = response_body['choices'][0]['message']['content']
-    elif 'output' in response_body:
-        content = response_body['output']['message']['content']
-    else:
-        content = str(response_body)
-
     return parse_llm_xml(content, allowed_styles)
 
-def generate_question_only(chunk_text, query_styles, client, error_log, parse_fail_log_path):
+def generate_question_only(chunk_text, query_styles, client, error_log, parse_fail_log_path, cache=None):
     allowed_styles = [style["style_name"] for style in query_styles]
     
-    system_prompt = f"""
-### ROL DEL SISTEMA
-Eres un Generador de Datos Sintéticos especializado en Banca y Bienes Raíces de Chile.
-Tu trabajo es crear el "Test Set" para evaluar un asistente de IA (RAG) del Banco Estado (Casaverso).
-
-### TAREA PRINCIPAL
-Se te entregará un fragmento de texto (La "Respuesta").
-Tu objetivo es redactar la **Consulta del Usuario** (El "Input") que provocaría que el sistema recupere este texto como respuesta.
-
-### REGLAS DE ORO (CRÍTICO: LEER CON ATENCIÓN)
-1. **ASIMETRÍA DE INFORMACIÓN:** El usuario NO ha leído el texto. No sabe los términos técnicos exactos, ni los porcentajes, ni los artículos de la ley que aparecen en el texto.
-2. **INTENCIÓN vs CONTENIDO:**
-- MAL (Contaminado): "¿Cuáles son los requisitos del artículo 5 del subsidio DS19?" (El usuario no sabe que existe el artículo 5).
-- BIEN (Realista): "Oye, ¿qué papeles me piden para postular al subsidio?"
-3. **ABSTRACCIÓN:** Si el texto habla de "Tasa fija del 4.5%", el usuario NO pregunta "¿Es la tasa del 4.5%?". El usuario pregunta "¿Cómo están las tasas hoy?".
-4. **SI EL TEXTO ES CORTO/PARCIAL:** Si el fragmento es muy específico o técnico, el usuario debe hacer una pregunta más amplia o vaga que este fragmento respondería parcialmente.
-5. **CONTEXTO CHILENO:** Usa vocabulario local, modismos y el tono correspondiente al estilo solicitado.
-
-
-### DOCUMENTO DE REFERENCIA:
-Se te etregará un fragmento de texto que el asistente debería recuperar como respuesta a la consulta del usuario.
-
-### ESTILOS DE CONSULTA DISPONIBLES:
-Se te entregará una lista de 2 estilos. 
-Debes seleccionar uno de los estilos para redactar la pregunta. 
-Si ambos estilos sirven para el fragmento, selecciona al azar, no siempre el más simple. Si sólo uno sirve, úsalo. Si ninguno sirve, elige el que mejor se adapte con modificaciones.
-Luego, debes redactar la consulta adoptando el estilo seleccionado.
-
-### FORMATO DE SALIDA
-Tu respuesta serán dos tags xml: <style_name> y <user_input>.
-El texto dentro de style_name es el nombre del estilo seleccionado. Debes mantener el MISMO style_name entregado.
-El texto dentro del <user_input> debe ser la consulta generada, sin comillas, sin saltos de línea, sin explicaciones adicionales. Es el texto plano de la consulta del usuario.
-Responde ÚNICAMENTE con este formato XML (sin markdown, sin explicaciones):
-
-<style_name>NOMBRE_DEL_ESTILO</style_name>
-<user_input>TU_CONSULTA_GENERADA_AQUI</user_input>
-"""
+    system_prompt = QUESTION_RULES_PROMPT + SINGLE_QUESTION_FORMAT_PROMPT
 
     prompt = f"""
 ### DOCUMENTO DE REFERENCIA:
@@ -210,47 +354,175 @@ Responde ÚNICAMENTE con este formato XML (sin markdown, sin explicaciones):
         "max_tokens": 2000 
     })
 
-    def _call():
-        return client.invoke_model(
-            modelId=config.MODEL_ID,
-            body=body
-        )
-
-    response = call_with_retry(_call, "invoke_model", error_log)
-    if response is None:
+    content = invoke_llm_content(body, "invoke_model", client, error_log, cache)
+    if content is None:
         return None, None
 
-    response_body = json.loads(response.get('body').read().decode('utf-8'))
-
-    if 'choices' in response_body:
-        content = response_body['choices'][0]['message']['content']
-    elif 'output' in response_body:
-        content = response_body['output']['message']['content']
-    else:
-        content = str(response_body)
-
     question_text, style_found, cleaned = parse_llm_xml(content, allowed_styles)
     if question_text and style_found:
+        record_parse("strict")
+        return question_text, style_found
+
+    # Local recovery first; the LLM repair round-trip is the last resort.
+    question_text, style_found, _ = lenient_parse_llm_xml(content, allowed_styles)
+    if question_text and style_found:
+        record_parse("lenient")
+        record_parse("repair_calls_avoided")
         return question_text, style_found
 
-    repair_q, repair_style, _ = repair_xml_response(content, allowed_styles, client, error_log)
+    repair_q, repair_style, _ = repair_xml_response(content, allowed_styles, client, error_log, cache)
     if repair_q and repair_style:
+        record_parse("llm_repair")
         return repair_q, repair_style
 
-    ensure_parent_dir(parse_fail_log_path)
-    with open(parse_fail_log_path, "a", encoding="utf-8") as log_file:
-        log_file.write(json.dumps({
-            "timestamp": datetime.utcnow().isoformat() + "Z",
-            "reason": "parse_failed",
-            "allowed_styles": allowed_styles,
-            "raw_response": cleaned,
-        }, ensure_ascii=False) + "\n")
+    record_parse("failed")
+    log_parse_failure(parse_fail_log_path, "parse_failed", allowed_styles, cleaned)
 
     print(f"Warning: Could not parse XML from LLM response: {cleaned[:100]}...")
     return None, None
 
+def generate_questions_batch(chunk_text, query_styles, client, error_log, parse_fail_log_path, cache=None):
+    """
+    Generates one question per style in a single call, so the system prompt
+    and the chunk are sent once per document instead of once per question.
+    Returns the list of (question, style) pairs that parsed correctly.
+    """
+    allowed_styles = [style["style_name"] for style in query_styles]
+
+    system_prompt = QUESTION_RULES_PROMPT + BATCH_QUESTION_FORMAT_PROMPT
+
+    prompt = f"""
+### DOCUMENTO DE REFERENCIA:
+{chunk_text}    
+### ESTILOS DE CONSULTA ASIGNADOS:
+{query_styles}
+"""
+
+    body = json.dumps({
+        "messages": [{"role": "system", "content": system_prompt}, {"role": "user", "content": prompt}],
+        "temperature": config.TEMPERATURE,
+        "max_tokens": 2000 + 500 * (len(query_styles) - 1)
+    })
+
+    content = invoke_llm_content(body, "invoke_model_batch", client, error_log, cache)
+    if content is None:
+        return []
+
+    items, cleaned = parse_llm_xml_items(content, allowed_styles)
+    if len(items) < len(allowed_styles):
+        with PARSE_STATS_LOCK:
+            PARSE_STATS["failed"] += len(allowed_styles) - len(items)
+        missing = [style for style in allowed_styles if style not in {s for _, s in items}]
+        log_parse_failure(parse_fail_log_path, "batch_items_missing", missing, cleaned)
+        print(f"Warning: {len(missing)} of {len(allowed_styles)} batched questions could not be parsed.")
+
+    return items
+
+
+def file_rng(file_path, chunk_id=None):
+    """Per-file (or per-chunk) RNG so style draws do not depend on processing order."""
+    seed = f"{config.SEED}:{kb_relpath(file_path, config.KB_FOLDER)}"
+    if chunk_id:
+        seed = f"{seed}:{chunk_id}"
+    return random.Random(seed)
+
+
+def task_key(source_file, chunk_id=None):
+    """Identifies a generation unit: the chunk when chunking, else the source file."""
+    return chunk_id or source_file
+
+
+def row_key(row):
+    return task_key(row.get("source_file"), row.get("chunk_id"))
+
+
+def plan_document(file_path, text, estimator=None):
+    """Returns the generation tasks for one KB file: the whole file, or one per chunk."""
+    source_file = extract_bd_code(os.path.basename(file_path))
+
+    if estimator is None:
+        units = [{"text": text, "chunk_id": None}]
+    else:
+        units = chunk_document(
+            text,
+            normalize_file_key(file_path),
+            source_file,
+            estimator,
+            config.CHUNK_SIZE_TOKENS,
+            int(config.CHUNK_SIZE_TOKENS * config.CHUNK_OVERLAP_PCT / 100),
+        )
+
+    tasks = []
+    for unit in units:
+        task = plan_unit(file_path, unit["text"], unit["chunk_id"])
+        if task is not None:
+            tasks.append(task)
+    return tasks
+
+
+def plan_unit(file_path, chunk_text, chunk_id=None):
+    # Skip empty files
+    if len(chunk_text) < 30:
+        return None
+
+    # --- PROGRAMMATIC SELECTION ---
+    # Styles are pre-drawn here, before any LLM call, so parallel and serial
+    # runs with the same seed produce the same rows.
+    # In batched mode each drawn style gets its own question; otherwise the
+    # LLM picks one of two styles.
+    if config.QUESTIONS_PER_DOC > 1:
+        style_count = min(config.QUESTIONS_PER_DOC, len(QUERY_STYLES))
+    else:
+        style_count = 2
+    selected_styles = file_rng(file_path, chunk_id).sample(QUERY_STYLES, style_count)
+
+    source_file = extract_bd_code(os.path.basename(file_path))
+    return {
+        "file_path": file_path,
+        "chunk_text": chunk_text,
+        "chunk_id": chunk_id,
+        "key": task_key(source_file, chunk_id),
+        "selected_styles": selected_styles,
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Generate synthetic user inputs from the KB.")
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        default=config.INCREMENTAL,
+        help="Only generate questions for new or changed KB files and merge with the previous testset",
+    )
+    return parser.parse_args()
+
+
+def incremental_base_rows(manifest):
+    """
+    Diffs the current KB manifest against the stored one and returns the
+    previous testset rows that can be kept, plus the diff itself.
+    """
+    old_manifest = load_manifest(config.KB_MANIFEST_PATH)
+    diff = diff_manifests(old_manifest, manifest)
+
+    if old_manifest is None:
+        print(f"No manifest found at {config.KB_MANIFEST_PATH}; generating the full KB.")
+        return [], diff
+
+    unchanged_codes = {extract_bd_code(os.path.basename(p)) for p in diff["unchanged"]}
+    previous_rows = read_csv_rows(config.OUTPUT_TESTSET_CSV)
+    kept_rows = [row for row in previous_rows if row.get("source_file") in unchanged_codes]
+
+    print(
+        f"KB diff: {len(diff['added'])} added | {len(diff['changed'])} changed | "
+        f"{len(diff['deleted'])} deleted | {len(diff['unchanged'])} unchanged"
+    )
+    print(f"Keeping {len(kept_rows)} of {len(previous_rows)} rows from {config.OUTPUT_TESTSET_CSV}")
+    return kept_rows, diff
+
 
 def main():
+    args = parse_args()
     random.seed(config.SEED)
     print(f"Using seed: {config.SEED}")
     print(f"Scanning for files in {config.KB_FOLDER}...")
@@ -259,18 +531,18 @@ def main():
         print(f"Error: Directory {config.KB_FOLDER} does not exist.")
         return
 
-    # Recursive glob search for .md files
-    search_pattern = os.path.join(config.KB_FOLDER, "**", "*.md")
-    files = glob.glob(search_pattern, recursive=True)
+    # Recursive scan for .md files (sorted so output order is stable); hashes
+    # come from the cached KB index when files are unchanged.
+    kb_entries = scan_kb(config.KB_FOLDER)
     
-    if not files:
+    if not kb_entries:
         print(f"No .md files found in {config.KB_FOLDER} or its subdirectories.")
         return
 
-    print(f"Found {len(files)} Markdown files.")
+    print(f"Found {len(kb_entries)} Markdown files.")
 
     client = get_bedrock_client()
-    dataset = []
+    cache = open_bedrock_cache()
     error_log = []
     parse_failures = 0
     parse_fail_log_path = os.path.join(
@@ -278,69 +550,159 @@ def main():
         "parse_failures.jsonl"
     )
 
-    print("Generating synthetic questions...")
+    documents = [(entry["path"], text) for entry, text, _ in read_kb_texts(kb_entries)]
 
-    for i, file_path in enumerate(files):
+    estimator = None
+    if config.CHUNKING_ENABLED:
+        estimator = TokenEstimator(load_token_counts(config.TOKEN_COUNTS_CSV))
+        ratio = estimator.calibrate({normalize_file_key(path): text for path, text in documents})
+        print(
+            f"Chunking: {config.CHUNK_SIZE_TOKENS} tokens, {config.CHUNK_OVERLAP_PCT:g}% overlap "
+            f"({ratio:.2f} chars/token)"
+        )
+
+    tasks = []
+    for file_path, text in documents:
+        tasks.extend(plan_document(file_path, text, estimator))
+    if estimator is not None:
+        print(f"Planned {len(tasks)} chunks from {len(documents)} files.")
+
+    manifest = build_manifest(kb_entries, config.KB_FOLDER)
+    base_rows = None
+    kb_diff = None
+    if args.incremental:
+        base_rows, kb_diff = incremental_base_rows(manifest)
+
+    # Rows are appended to "<output>.partial" as they are produced; files that
+    # already have a row there (RESUME=1) or in the kept rows are skipped.
+    checkpoint = CheckpointWriter(
+        config.OUTPUT_TESTSET_CSV,
+        TESTSET_COLUMNS,
+        resume=config.RESUME,
+        base_rows=base_rows
+    )
+    done_keys = {row_key(row) for row in checkpoint.existing_rows}
+    if done_keys:
+        task_order = {task["key"]: i for i, task in enumerate(tasks)}
+        tasks = [task for task in tasks if task["key"] not in done_keys]
+        print(f"Reusing {len(checkpoint.existing_rows)} existing rows, {len(tasks)} units left.")
+
+    def _generate(task):
+        # --- CALL LLM FOR USER INPUT ONLY ---
+        # Returns a list of (question, style_used) pairs
+        if config.QUESTIONS_PER_DOC > 1:
+            return generate_questions_batch(
+                task["chunk_text"],
+                task["selected_styles"],
+                client,
+                error_log,
+                parse_fail_log_path,
+                cache
+            )
+
+        generated_question, style_used = generate_question_only(
+            task["chunk_text"],
+            task["selected_styles"],
+            client,
+            error_log,
+            parse_fail_log_path,
+            cache
+        )
+        if generated_question and style_used:
+            return [(generated_question, style_used)]
+        return []
+
+    def _process(task):
+        # One bad unit (e.g. a malformed model response) is logged and counted
+        # as a failure instead of aborting the whole run.
         try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                chunk_text = f.read()
-                
-                # Skip empty files
-                if len(chunk_text) < 30: 
-                    continue
-                
-                # --- PROGRAMMATIC SELECTION ---
-                # Select 3 random styles from the global list
-                selected_styles = random.sample(QUERY_STYLES, 2)
-                
-                print(f"[{i+1}/{len(files)}] Processing {os.path.basename(file_path)}")
-                
-                # --- CALL LLM FOR USER INPUT ONLY ---
-                # Now expects a tuple return (question, style_used)
-                generated_question, style_used = generate_question_only(
-                    chunk_text,
-                    selected_styles,
-                    client,
-                    error_log,
-                    parse_fail_log_path
-                )
-                
-                if generated_question and style_used:
-                    # --- CONSTRUCT ROW PROGRAMMATICALLY ---
-                    row = {
-                        "user_input": generated_question,
-                        "reference_contexts": [chunk_text], 
-                        "query_style": style_used,
-                        "source_file": extract_bd_code(os.path.basename(file_path))
-                    }
-                    dataset.append(row)
-                else:
-                    parse_failures += 1
-                    
+            return _generate(task)
         except Exception as e:
-            print(f"Error reading file {file_path}: {e}")
-
-    if dataset:
-        df = pd.DataFrame(dataset)
-        ensure_parent_dir(config.OUTPUT_TESTSET_CSV)
-        df.to_csv(config.OUTPUT_TESTSET_CSV, index=False)
-        print(f"Successfully generated {len(df)} test cases. Saved to {config.OUTPUT_TESTSET_CSV}")
+            unit_name = task["chunk_id"] or os.path.basename(task["file_path"])
+            print(f"Error processing {unit_name}: {e}")
+            error_log.append({
+                "timestamp": datetime.utcnow().isoformat() + "Z",
+                "operation": "process_unit",
+                "unit": unit_name,
+                "error": str(e),
+            })
+            return []
+
+    print(f"Generating synthetic questions with {config.GENERATION_WORKERS} worker(s)...")
+
+    expected_per_file = min(config.QUESTIONS_PER_DOC, len(QUERY_STYLES)) if config.QUESTIONS_PER_DOC > 1 else 1
+    results = ordered_map(_process, tasks, config.GENERATION_WORKERS)
+    for i, (task, generated) in enumerate(results):
+        file_name = os.path.basename(task["file_path"])
+        unit_name = task["chunk_id"] or file_name
+        print(f"[{i+1}/{len(tasks)}] Processed {unit_name} ({len(generated)} question(s))")
+
+        unit_rows = []
+        for generated_question, style_used in generated:
+            # --- CONSTRUCT ROW PROGRAMMATICALLY ---
+            row = {
+                "user_input": generated_question,
+                "reference_contexts": [task["chunk_text"]],
+                "query_style": style_used,
+                "source_file": extract_bd_code(file_name)
+            }
+            if task["chunk_id"]:
+                row["chunk_id"] = task["chunk_id"]
+            unit_rows.append(row)
+        # Resume skips a unit once any of its rows is on disk, so all of them go in one write.
+        checkpoint.write_rows(unit_rows)
+        parse_failures += expected_per_file - len(generated)
+
+    if checkpoint.total_rows:
+        sort_key = None
+        if done_keys:
+            # Restore KB order so a resumed run matches an uninterrupted one.
+            sort_key = lambda row: task_order.get(row_key(row), len(task_order))
+        checkpoint.finalize(sort_key=sort_key)
+        save_manifest(config.KB_MANIFEST_PATH, manifest)
+        print(
+            f"Successfully generated {checkpoint.rows_written} test cases "
+            f"({checkpoint.total_rows} total). Saved to {config.OUTPUT_TESTSET_CSV}"
+        )
     else:
+        checkpoint.discard()
         print("No data generated.")
 
+    cache_stats = None
+    if cache is not None:
+        cache.close()
+        cache_stats = cache.stats()
+        print(f"Bedrock cache: {cache_stats['hits']} hits | {cache_stats['misses']} misses")
+
+    throughput = RETRY_CONTROLLER.stats()
+    print(
+        f"Bedrock: {throughput['requests_per_second']} req/s | "
+        f"throttle rate {throughput['throttle_rate']:.1%} | final concurrency {throughput['final_concurrency_limit']}"
+    )
+    print(
+        f"Parsing: {PARSE_STATS['strict']} strict | {PARSE_STATS['lenient']} local repair | "
+        f"{PARSE_STATS['llm_repair']} LLM repair | {PARSE_STATS['failed']} failed"
+    )
     if error_log or parse_failures:
         print(f"Non-fatal errors: {len(error_log)} | Parse failures: {parse_failures}")
-        summary_path = os.path.join(
-            os.path.dirname(config.OUTPUT_TESTSET_CSV),
-            "run_summary.json"
-        )
-        ensure_parent_dir(summary_path)
-        with open(summary_path, "w", encoding="utf-8") as summary_file:
-            json.dump({
-                "generated": len(dataset),
-                "parse_failures": parse_failures,
-                "errors": error_log,
-            }, summary_file, ensure_ascii=False, indent=2)
+
+    # The summary is always written: besides errors it carries cache and parse stats.
+    summary_path = os.path.join(
+        os.path.dirname(config.OUTPUT_TESTSET_CSV),
+        "run_summary.json"
+    )
+    ensure_parent_dir(summary_path)
+    with open(summary_path, "w", encoding="utf-8") as summary_file:
+        json.dump({
+            "generated": checkpoint.rows_written,
+            "resumed": len(checkpoint.existing_rows),
+            "kb_diff": {k: len(v) for k, v in kb_diff.items()} if kb_diff else None,
+            "parse_failures": parse_failures,
+            "parse_stats": dict(PARSE_STATS),
+            "cache": cache_stats,
+            "throughput": throughput,
+            "errors": error_log,
+        }, summary_file, ensure_ascii=False, indent=2)
 
 if __name__ == "__main__":
     main()
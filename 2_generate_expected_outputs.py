@@ -2,14 +2,20 @@
 import csv
 import json
 import os
-import random
+import re
+import threading
 import time
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
-from botocore.exceptions import ClientError
 
 import config
+from bedrock_cache import cached_call, open_bedrock_cache
+from checkpoint import CheckpointWriter, keyed_rows, load_filled_rows
+from dedup import SingleFlight, request_key
+from latency_stats import percentile
+from parallel import ordered_map
+from throttling import AdaptiveConcurrencyController
 
 # --- CONFIG ---
 # INPUT_CSV_PATH = os.getenv("EXPECTED_INPUT_CSV_PATH", config.OUTPUT_TESTSET_CSV)
@@ -39,6 +45,55 @@ BACKOFF_MAX_SECONDS = float(
 BACKOFF_JITTER_SECONDS = float(
     os.getenv("EXPECTED_OUTPUT_BACKOFF_JITTER_SECONDS", str(config.BACKOFF_JITTER_SECONDS))
 )
+# Rows in flight at once (1 = serial). Output keeps the input row order, and
+# the reader never runs more than MAX_IN_FLIGHT rows ahead of the writer.
+WORKERS = int(os.getenv("EXPECTED_OUTPUT_WORKERS", "1"))
+MAX_IN_FLIGHT = int(os.getenv("EXPECTED_OUTPUT_MAX_IN_FLIGHT", str(2 * WORKERS)))
+
+# Resume: rows of an existing output (or its .partial file) whose expected_output
+# is filled are kept, matched by a hash of RESUME_KEY_FIELDS; only missing or
+# errored rows are sent to the model again.
+RESUME = os.getenv("EXPECTED_OUTPUT_RESUME", "1") == "1"
+RESUME_KEY_FIELDS = ("user_input", "reference_contexts", "source_file")
+# In-run dedup: rows with the same normalized (user_input, reference_contexts)
+# share one model call. Shared rows get the text but no usage/timing columns.
+DEDUP = os.getenv("EXPECTED_OUTPUT_DEDUP", "1") == "1"
+# Dedup results kept in memory (LRU); older duplicates are simply called again.
+DEDUP_MAX_RESULTS = int(os.getenv("EXPECTED_OUTPUT_DEDUP_MAX_RESULTS", "4096"))
+
+# Converse API mode: the system prompt is sent as a cache point so repeated rows
+# read it from the prompt cache. Set PROMPT_CACHE=0 for models without caching.
+USE_CONVERSE = os.getenv("EXPECTED_OUTPUT_USE_CONVERSE", "0") == "1"
+PROMPT_CACHE = os.getenv("EXPECTED_OUTPUT_PROMPT_CACHE", "1") == "1"
+USAGE_COLUMNS = [
+    "input_tokens",
+    "output_tokens",
+    "cache_read_input_tokens",
+    "cache_write_input_tokens",
+]
+# Streaming mode (converse_stream, same request as Converse mode) also records
+# per-row latency. A generation still running after ROW_BUDGET_SECONDS (counted
+# from the row's first attempt, 0 = no budget) is cancelled and its partial
+# text kept with stop_reason "budget_exceeded"; such rows are not cached.
+USE_STREAMING = os.getenv("EXPECTED_OUTPUT_STREAMING", "0") == "1"
+ROW_BUDGET_SECONDS = float(os.getenv("EXPECTED_OUTPUT_ROW_BUDGET_SECONDS", "60"))
+BUDGET_EXCEEDED = "budget_exceeded"
+STREAM_COLUMNS = [
+    "ttft_ms",
+    "latency_ms",
+    "tokens_per_second",
+    "stop_reason",
+]
+# Multi-model fan-out: a comma-separated list of model IDs, all called
+# concurrently for every row. Each model gets expected_output__<model> plus
+# latency and token columns; expected_output keeps the first model's answer so
+# later stages work unchanged. Empty = single-model mode with MODEL_ID.
+MODEL_IDS = [
+    model_id.strip()
+    for model_id in os.getenv("EXPECTED_OUTPUT_MODEL_IDS", "").split(",")
+    if model_id.strip()
+]
+FAN_OUT_COLUMNS = ["expected_output", "latency_ms", "input_tokens", "output_tokens"]
 RUN_SUMMARY_PATH = os.getenv(
     "EXPECTED_OUTPUT_RUN_SUMMARY_PATH",
     "outputs/test/expected_outputs_run_summary.json"
@@ -60,33 +115,17 @@ def get_bedrock_client():
     return session.client(service_name="bedrock-runtime", region_name=AWS_REGION)
 
 
-def backoff_sleep(attempt):
-    base = BACKOFF_BASE_SECONDS * (2 ** attempt)
-    sleep_for = min(base, BACKOFF_MAX_SECONDS)
-    sleep_for += random.uniform(0, BACKOFF_JITTER_SECONDS)
-    time.sleep(sleep_for)
+# Shared AIMD limiter + retry policy for every Bedrock call in this stage.
+RETRY_CONTROLLER = AdaptiveConcurrencyController(
+    max_retries=MAX_RETRIES,
+    backoff_base_seconds=BACKOFF_BASE_SECONDS,
+    backoff_max_seconds=BACKOFF_MAX_SECONDS,
+    backoff_jitter_seconds=BACKOFF_JITTER_SECONDS,
+)
 
 
 def call_with_retry(fn, operation_name, error_log):
-    last_error = None
-    for attempt in range(MAX_RETRIES + 1):
-        try:
-            return fn()
-        except ClientError as e:
-            last_error = e
-        except Exception as e:
-            last_error = e
-
-        if attempt < MAX_RETRIES:
-            backoff_sleep(attempt)
-        else:
-            if last_error is not None:
-                error_log.append({
-                    "timestamp": datetime.utcnow().isoformat() + "Z",
-                    "operation": operation_name,
-                    "error": str(last_error),
-                })
-            return None
+    return RETRY_CONTROLLER.call(fn, operation_name, error_log)
 
 
 def extract_response_text(response_body):
@@ -128,6 +167,22 @@ def normalize_reference_contexts(reference_contexts_value):
     return []
 
 
+def extract_converse_text(response):
+    content = response.get("output", {}).get("message", {}).get("content", [])
+    text_parts = [block.get("text", "") for block in content if isinstance(block, dict)]
+    return "".join(text_parts).strip()
+
+
+def extract_converse_usage(response):
+    usage = response.get("usage", {})
+    return {
+        "input_tokens": usage.get("inputTokens", 0),
+        "output_tokens": usage.get("outputTokens", 0),
+        "cache_read_input_tokens": usage.get("cacheReadInputTokens", 0),
+        "cache_write_input_tokens": usage.get("cacheWriteInputTokens", 0),
+    }
+
+
 def build_user_message(user_input, reference_contexts):
     context_blocks = []
     for i, ctx in enumerate(reference_contexts, start=1):
@@ -136,57 +191,302 @@ def build_user_message(user_input, reference_contexts):
     return f"{context_text}\n\nConsulta del usuario: {user_input}"
 
 
-def generate_expected_output(user_input, reference_contexts, client, error_log):
-    user_message = build_user_message(user_input, reference_contexts)
+def build_converse_request(user_message):
+    system_blocks = [{"text": system_prompt}]
+    if PROMPT_CACHE:
+        system_blocks.append({"cachePoint": {"type": "default"}})
+    return {
+        "system": system_blocks,
+        "messages": [{"role": "user", "content": [{"text": user_message}]}],
+        "inferenceConfig": {"temperature": TEMPERATURE, "maxTokens": MAX_TOKENS},
+    }
+
+
+def extract_response_usage(response_body):
+    """Token usage of an invoke_model body (Anthropic or OpenAI-style field names)."""
+    usage = response_body.get("usage") or {}
+    return {
+        "input_tokens": usage.get("input_tokens", usage.get("prompt_tokens", 0)),
+        "output_tokens": usage.get("output_tokens", usage.get("completion_tokens", 0)),
+    }
+
+
+def elapsed_ms(started):
+    return round((time.monotonic() - started) * 1000)
+
+
+def generate_expected_output_converse(user_message, client, error_log, cache=None, model_id=MODEL_ID):
+    request = build_converse_request(user_message)
+    timing = {}
+
+    def _call():
+        return client.converse(modelId=model_id, **request)
 
-    if MODEL_ID.startswith("us.anthropic."):
-        request_payload = {
+    def _invoke():
+        started = time.monotonic()
+        response = call_with_retry(_call, "converse_expected_output", error_log)
+        if response is None:
+            return None
+        timing["latency_ms"] = elapsed_ms(started)
+        return json.dumps(response, ensure_ascii=False, default=str)
+
+    raw_response = cached_call(cache, model_id, request, _invoke)
+    if raw_response is None:
+        return "", {}
+
+    response = json.loads(raw_response)
+    usage = extract_converse_usage(response)
+    usage.update(timing)
+    return extract_converse_text(response), usage
+
+
+def consume_converse_stream(response, started, deadline):
+    """
+    Reads a converse_stream response as events arrive. Returns a
+    Converse-shaped response dict plus a "timing" dict; stops early (closing
+    the stream) once the deadline has passed. A watchdog timer closes the
+    stream at the deadline, so a stream that stalls between events is
+    cancelled too.
+    """
+    text_parts = []
+    stop_reason = ""
+    usage = {}
+    first_token_at = None
+    completed = False
+    stream = response["stream"]
+    expired = threading.Event()
+
+    def _expire():
+        expired.set()
+        stream.close()
+
+    watchdog = None
+    if deadline:
+        watchdog = threading.Timer(max(0.0, deadline - time.monotonic()), _expire)
+        watchdog.daemon = True
+        watchdog.start()
+
+    try:
+        for event in stream:
+            if "contentBlockDelta" in event:
+                delta = event["contentBlockDelta"].get("delta", {}).get("text", "")
+                if delta and first_token_at is None:
+                    first_token_at = time.monotonic()
+                text_parts.append(delta)
+            elif "messageStop" in event:
+                stop_reason = event["messageStop"].get("stopReason", "")
+            elif "metadata" in event:
+                usage = event["metadata"].get("usage", {})
+                completed = True
+
+            if expired.is_set():
+                break
+    except Exception:
+        # Reading a stream closed by the watchdog fails; anything else is a real error.
+        if not expired.is_set():
+            raise
+    finally:
+        if watchdog is not None:
+            watchdog.cancel()
+
+    if expired.is_set() and not completed:
+        stop_reason = BUDGET_EXCEEDED
+
+    finished_at = time.monotonic()
+    timing = {
+        "ttft_ms": round((first_token_at - started) * 1000) if first_token_at else "",
+        "latency_ms": round((finished_at - started) * 1000),
+        "tokens_per_second": "",
+        "stop_reason": stop_reason,
+    }
+    # Decode rate: output tokens over the time after the first token.
+    output_tokens = usage.get("outputTokens")
+    if output_tokens and first_token_at and finished_at > first_token_at:
+        timing["tokens_per_second"] = round(output_tokens / (finished_at - first_token_at), 2)
+
+    return {
+        "output": {"message": {"role": "assistant", "content": [{"text": "".join(text_parts)}]}},
+        "stopReason": stop_reason,
+        "usage": usage,
+        "timing": timing,
+    }
+
+
+def generate_expected_output_stream(user_message, client, error_log, cache=None, model_id=MODEL_ID):
+    """
+    Streaming variant of generate_expected_output_converse. Cached entries use
+    the Converse response shape, so both modes share them; a cache hit has no
+    timing columns.
+    """
+    request = build_converse_request(user_message)
+    row_started = time.monotonic()
+    deadline = row_started + ROW_BUDGET_SECONDS if ROW_BUDGET_SECONDS > 0 else None
+    streamed = {}
+
+    def _call():
+        started = time.monotonic()
+        response = client.converse_stream(modelId=model_id, **request)
+        return consume_converse_stream(response, started, deadline)
+
+    def _invoke():
+        response = call_with_retry(_call, "converse_stream_expected_output", error_log)
+        if response is None:
+            return None
+        streamed.update(response)
+        if response["stopReason"] == BUDGET_EXCEEDED:
+            # Truncated output: returned to the caller but never cached.
+            return None
+        cached = {key: value for key, value in response.items() if key != "timing"}
+        return json.dumps(cached, ensure_ascii=False)
+
+    raw_response = cached_call(cache, model_id, request, _invoke)
+    if raw_response is None and not streamed:
+        return "", {}
+
+    response = streamed or json.loads(raw_response)
+    usage = extract_converse_usage(response)
+    usage.update(response.get("timing") or {"stop_reason": response.get("stopReason", "")})
+    return extract_converse_text(response), usage
+
+
+def is_anthropic_model(model_id):
+    """Matches plain and cross-region inference profile IDs (anthropic., us.anthropic., ...)."""
+    return ".anthropic." in f".{model_id}"
+
+
+def build_invoke_payload(model_id, user_message):
+    """invoke_model body for the target model: Anthropic Messages or OpenAI-style messages."""
+    if is_anthropic_model(model_id):
+        return {
             "anthropic_version": "bedrock-2023-05-31",
             "system": system_prompt,
             "messages": [{"role": "user", "content": user_message}],
             "temperature": TEMPERATURE,
             "max_tokens": MAX_TOKENS,
         }
-    else:
-        request_payload = {
-            "messages": [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_message},
-            ],
-            "temperature": TEMPERATURE,
-            "max_tokens": MAX_TOKENS,
-        }
-
-    body = json.dumps(request_payload)
+    return {
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_message},
+        ],
+        "temperature": TEMPERATURE,
+        "max_tokens": MAX_TOKENS,
+    }
+
+
+def generate_expected_output(user_message, client, error_log, cache=None, model_id=MODEL_ID):
+    """
+    Returns (expected_output, usage) for one model. usage holds token counts and,
+    when a call was made (not a cache hit), latency_ms.
+    """
+    if USE_STREAMING:
+        return generate_expected_output_stream(user_message, client, error_log, cache, model_id)
+
+    if USE_CONVERSE:
+        return generate_expected_output_converse(user_message, client, error_log, cache, model_id)
+
+    body = json.dumps(build_invoke_payload(model_id, user_message))
+    timing = {}
 
     def _call():
         return client.invoke_model(
-            modelId=MODEL_ID,
+            modelId=model_id,
             body=body
         )
 
-    response = call_with_retry(_call, "invoke_model_expected_output", error_log)
-    if response is None:
-        return ""
+    def _invoke():
+        started = time.monotonic()
+        response = call_with_retry(_call, "invoke_model_expected_output", error_log)
+        if response is None:
+            return None
+        raw = response.get("body").read().decode("utf-8")
+        timing["latency_ms"] = elapsed_ms(started)
+        return raw
+
+    raw_response = cached_call(cache, model_id, body, _invoke)
+    if raw_response is None:
+        return "", {}
+
+    response_body = json.loads(raw_response)
+    usage = extract_response_usage(response_body)
+    usage.update(timing)
+    return extract_response_text(response_body), usage
+
+
+def model_column(column, model_id):
+    """Per-model column name, e.g. expected_output__us_anthropic_claude_3_5_haiku_20241022_v1_0."""
+    return f"{column}__{re.sub(r'[^0-9A-Za-z]+', '_', model_id).strip('_')}"
+
 
-    response_body = json.loads(response.get("body").read().decode("utf-8"))
-    return extract_response_text(response_body)
+def fan_out_columns():
+    columns = list(FAN_OUT_COLUMNS)
+    if USE_STREAMING:
+        columns += [col for col in STREAM_COLUMNS if col != "latency_ms"]
+    return columns
 
 
 def build_output_columns(input_columns):
     expected_column = "expected_output"
-    if expected_column in input_columns:
-        return input_columns
-
     columns = list(input_columns)
-    if "reference_contexts" in columns:
-        idx = columns.index("reference_contexts")
-        columns.insert(idx + 1, expected_column)
-    else:
-        columns.append(expected_column)
+    if expected_column not in columns:
+        if "reference_contexts" in columns:
+            idx = columns.index("reference_contexts")
+            columns.insert(idx + 1, expected_column)
+        else:
+            columns.append(expected_column)
+
+    if MODEL_IDS:
+        for model_id in MODEL_IDS:
+            columns.extend(
+                model_column(col, model_id) for col in fan_out_columns()
+                if model_column(col, model_id) not in columns
+            )
+        return columns
+
+    if USE_CONVERSE or USE_STREAMING:
+        columns.extend(col for col in USAGE_COLUMNS if col not in columns)
+    if USE_STREAMING:
+        columns.extend(col for col in STREAM_COLUMNS if col not in columns)
     return columns
 
 
+TIMING_SAMPLE_COLUMNS = ("ttft_ms", "latency_ms", "tokens_per_second")
+
+
+def record_latency(samples, output_row, model_id=None):
+    """
+    Keeps only the numeric timing values of a generated row, per model
+    (model_id selects the fan-out columns), so memory does not grow with the
+    answers. Rows without a call in this run (cache hits, deduplicated rows)
+    have no latency and are skipped.
+    """
+    def col_name(col):
+        return model_column(col, model_id) if model_id else col
+
+    if not isinstance(output_row.get(col_name("latency_ms")), (int, float)):
+        return
+    model_samples = samples.setdefault(
+        model_id, {**{col: [] for col in TIMING_SAMPLE_COLUMNS}, "budget_exceeded": 0}
+    )
+    for col in TIMING_SAMPLE_COLUMNS:
+        value = output_row.get(col_name(col))
+        if isinstance(value, (int, float)):
+            model_samples[col].append(value)
+    if output_row.get(col_name("stop_reason")) == BUDGET_EXCEEDED:
+        model_samples["budget_exceeded"] += 1
+
+
+def summarize_latency(samples, model_id=None):
+    """p50/p95 of the timing values recorded for one model (None = single-model mode)."""
+    model_samples = samples.get(model_id) or {col: [] for col in TIMING_SAMPLE_COLUMNS}
+    summary = {"rows": len(model_samples["latency_ms"])}
+    for col in TIMING_SAMPLE_COLUMNS:
+        values = model_samples[col]
+        summary[col] = {"p50": percentile(values, 50), "p95": percentile(values, 95)}
+    summary["budget_exceeded"] = model_samples.get("budget_exceeded", 0)
+    return summary
+
+
 def main():
     if not os.path.exists(INPUT_CSV_PATH):
         print(f"Input file not found: {INPUT_CSV_PATH}")
@@ -194,56 +494,196 @@ def main():
 
     ensure_parent_dir(OUTPUT_CSV_PATH)
     client = get_bedrock_client()
+    cache = open_bedrock_cache()
     error_log = []
+    reused_rows = 0
+    # Numeric timing values only (per model), never the generated rows themselves.
+    latency_samples = {}
+    dedup = SingleFlight(is_ok=lambda result: bool(result[0]), max_results=DEDUP_MAX_RESULTS)
+    # Fan-out calls run on their own pool so every row dispatches all models at once.
+    model_executor = ThreadPoolExecutor(max_workers=WORKERS * len(MODEL_IDS)) if MODEL_IDS else None
+
+    filled_rows = {}
+    if RESUME:
+        # Fan-out rows count as filled per model: rows with some models answered
+        # are kept and only the missing models are called again.
+        resume_columns = (
+            [model_column("expected_output", model_id) for model_id in MODEL_IDS]
+            if MODEL_IDS else "expected_output"
+        )
+        filled_rows = load_filled_rows(OUTPUT_CSV_PATH, RESUME_KEY_FIELDS, resume_columns)
+        if filled_rows:
+            print(f"Resuming: {len(filled_rows)} rows with expected_output found in previous output.")
 
-    with open(INPUT_CSV_PATH, "r", encoding="utf-8", newline="") as in_file, open(
-        OUTPUT_CSV_PATH, "w", encoding="utf-8", newline=""
-    ) as out_file:
+    with open(INPUT_CSV_PATH, "r", encoding="utf-8", newline="") as in_file:
         reader = csv.DictReader(in_file)
         if not reader.fieldnames:
             print(f"No header found in input file: {INPUT_CSV_PATH}")
             return
 
         output_columns = build_output_columns(reader.fieldnames)
-        writer = csv.DictWriter(out_file, fieldnames=output_columns)
-        writer.writeheader()
+        generated_columns = [
+            col for col in output_columns
+            if col == "expected_output" or col not in reader.fieldnames
+        ]
+        # Rows stream into "<output>.partial"; the output is replaced atomically at the end.
+        writer = CheckpointWriter(OUTPUT_CSV_PATH, output_columns)
+
+        def _generate(user_message, dedup_key, model_id):
+            def _call():
+                return generate_expected_output(user_message, client, error_log, cache, model_id)
+
+            if not DEDUP:
+                return _call()
+            (expected_output, usage), shared = dedup.do(request_key(model_id, dedup_key), _call)
+            return expected_output, {} if shared else usage
+
+        def _process(item):
+            _, key, row = item
+            previous = filled_rows.get(key)
+            pending_models = MODEL_IDS
+            if previous is not None and MODEL_IDS:
+                pending_models = [
+                    model_id for model_id in MODEL_IDS
+                    if not str(previous.get(model_column("expected_output", model_id)) or "").strip()
+                ]
+            if previous is not None and not pending_models:
+                output_row = {col: row.get(col, "") for col in output_columns}
+                for col in generated_columns:
+                    if col in previous:
+                        output_row[col] = previous[col]
+                return output_row, True, []
 
-        processed_rows = 0
-        for idx, row in enumerate(reader, start=1):
             user_input = (row.get("user_input") or "").strip()
             reference_contexts = normalize_reference_contexts(row.get("reference_contexts", ""))
-            expected_output = ""
+            generated = {}
+            if previous is not None:
+                # Carry over the models that already answered; only pending ones are called.
+                answered = [model_id for model_id in MODEL_IDS if model_id not in pending_models]
+                for model_id in answered:
+                    for col in fan_out_columns():
+                        if model_column(col, model_id) in previous:
+                            generated[model_column(col, model_id)] = previous[model_column(col, model_id)]
 
             if user_input:
-                expected_output = generate_expected_output(
-                    user_input,
-                    reference_contexts,
-                    client,
-                    error_log
-                )
+                # One prompt per row, shared by every target model.
+                user_message = build_user_message(user_input, reference_contexts)
+                dedup_key = [user_input] + reference_contexts
+                if MODEL_IDS:
+                    futures = [
+                        model_executor.submit(_generate, user_message, dedup_key, model_id)
+                        for model_id in pending_models
+                    ]
+                    for model_id, future in zip(pending_models, futures):
+                        expected_output, usage = future.result()
+                        usage = dict(usage, expected_output=expected_output)
+                        for col in fan_out_columns():
+                            if col in usage:
+                                generated[model_column(col, model_id)] = usage[col]
+                    generated["expected_output"] = generated.get(
+                        model_column("expected_output", MODEL_IDS[0]), ""
+                    )
+                else:
+                    expected_output, usage = _generate(user_message, dedup_key, MODEL_ID)
+                    generated = dict(usage, expected_output=expected_output)
 
             output_row = {}
             for col in output_columns:
-                if col == "expected_output":
-                    output_row[col] = expected_output
+                if col in generated_columns:
+                    output_row[col] = generated.get(col, "")
                 else:
                     output_row[col] = row.get(col, "")
+            return output_row, False, pending_models
+
+        items = (
+            (idx, key, row)
+            for idx, (key, row) in enumerate(keyed_rows(reader, RESUME_KEY_FIELDS), start=1)
+        )
 
-            writer.writerow(output_row)
+        processed_rows = 0
+        # The reader is consumed lazily: ordered_map applies backpressure and
+        # yields results in input order, so the file diffs cleanly against a serial run.
+        results = ordered_map(_process, items, WORKERS, MAX_IN_FLIGHT)
+        for (idx, _, _), (output_row, reused, called_models) in results:
+            writer.write_row(output_row)
             processed_rows += 1
-            print(f"[{idx}] Expected output generated")
+            if reused:
+                reused_rows += 1
+                print(f"[{idx}] Expected output already filled, skipped")
+                continue
+            if MODEL_IDS:
+                for model_id in called_models:
+                    record_latency(latency_samples, output_row, model_id)
+            elif USE_STREAMING:
+                record_latency(latency_samples, output_row)
+
+            if USE_STREAMING and not MODEL_IDS and output_row.get("latency_ms") != "":
+                print(
+                    f"[{idx}] Expected output generated "
+                    f"(TTFT {output_row['ttft_ms']} ms, total {output_row['latency_ms']} ms, "
+                    f"{output_row['stop_reason']})"
+                )
+            else:
+                print(f"[{idx}] Expected output generated")
+
+        writer.finalize()
+
+    if model_executor is not None:
+        model_executor.shutdown()
 
-    print(f"Done. Processed {processed_rows} rows.")
+    print(f"Done. Processed {processed_rows} rows ({reused_rows} reused from previous output).")
     print(f"Saved file: {OUTPUT_CSV_PATH}")
 
+    dedup_stats = dedup.stats()
+    if DEDUP:
+        print(f"Dedup: {dedup_stats['saved_calls']} model calls saved for duplicated rows")
+
+    cache_stats = None
+    if cache is not None:
+        cache.close()
+        cache_stats = cache.stats()
+        print(f"Bedrock cache: {cache_stats['hits']} hits | {cache_stats['misses']} misses")
+
+    throughput = RETRY_CONTROLLER.stats()
+    print(
+        f"Bedrock: {throughput['requests_per_second']} req/s | "
+        f"throttle rate {throughput['throttle_rate']:.1%} | final concurrency {throughput['final_concurrency_limit']}"
+    )
+
+    latency = None
+    latency_by_model = None
+    if MODEL_IDS:
+        latency_by_model = {model_id: summarize_latency(latency_samples, model_id) for model_id in MODEL_IDS}
+        for model_id, model_latency in latency_by_model.items():
+            print(
+                f"Latency {model_id}: p50 {model_latency['latency_ms']['p50']} ms, "
+                f"p95 {model_latency['latency_ms']['p95']} ms ({model_latency['rows']} calls)"
+            )
+    elif USE_STREAMING:
+        latency = summarize_latency(latency_samples)
+        print(
+            f"Latency: TTFT p50 {latency['ttft_ms']['p50']} ms | total p50 {latency['latency_ms']['p50']} ms, "
+            f"p95 {latency['latency_ms']['p95']} ms | {latency['budget_exceeded']} rows over budget"
+        )
+
+    # Always written: latency percentiles and dedup savings matter even on clean runs.
+    ensure_parent_dir(RUN_SUMMARY_PATH)
+    with open(RUN_SUMMARY_PATH, "w", encoding="utf-8") as summary_file:
+        json.dump({
+            "processed_rows": processed_rows,
+            "reused_rows": reused_rows,
+            "dedup": dedup_stats,
+            "cache": cache_stats,
+            "throughput": throughput,
+            "latency": latency,
+            "models": MODEL_IDS or [MODEL_ID],
+            "latency_by_model": latency_by_model,
+            "errors": error_log,
+        }, summary_file, ensure_ascii=False, indent=2)
     if error_log:
-        ensure_parent_dir(RUN_SUMMARY_PATH)
-        with open(RUN_SUMMARY_PATH, "w", encoding="utf-8") as summary_file:
-            json.dump({
-                "processed_rows": processed_rows,
-                "errors": error_log,
-            }, summary_file, ensure_ascii=False, indent=2)
         print(f"Run summary with errors saved to: {RUN_SUMMARY_PATH}")
+    else:
+        print(f"Run summary saved to: {RUN_SUMMARY_PATH}")
 
 
 if __name__ == "__main__":
@@ -1,14 +1,18 @@
 ﻿import csv
 import json
 import os
-import random
 import time
-from datetime import datetime
 
 import boto3
-from botocore.exceptions import ClientError
 
 import config
+from agent_trace import AgentTraceCollector, dump_breakdown, summarize_breakdowns
+from bedrock_cache import cached_call, open_bedrock_cache
+from checkpoint import CheckpointWriter, keyed_rows, load_filled_rows
+from dedup import SingleFlight, normalize_text, request_key
+from latency_stats import summarize_values
+from parallel import ordered_map
+from throttling import AdaptiveConcurrencyController
 
 # --- CONFIG ---
 # INPUT_CSV_PATH = os.getenv(
@@ -36,6 +40,37 @@ BACKOFF_MAX_SECONDS = float(
 BACKOFF_JITTER_SECONDS = float(
     os.getenv("ACTUAL_OUTPUT_BACKOFF_JITTER_SECONDS", str(config.BACKOFF_JITTER_SECONDS))
 )
+# Resume: rows of an existing output (or its .partial file) whose actual_output
+# is filled are kept, matched by a hash of RESUME_KEY_FIELDS; only missing or
+# errored rows are sent to the agent again.
+RESUME = os.getenv("ACTUAL_OUTPUT_RESUME", "1") == "1"
+RESUME_KEY_FIELDS = ("user_input", "reference_contexts", "source_file")
+# In-run dedup: the agent only sees user_input, so rows with the same
+# normalized question share one invoke_agent call.
+DEDUP = os.getenv("ACTUAL_OUTPUT_DEDUP", "1") == "1"
+# Dedup results kept in memory (LRU); older duplicates are simply called again.
+DEDUP_MAX_RESULTS = int(os.getenv("ACTUAL_OUTPUT_DEDUP_MAX_RESULTS", "4096"))
+# Agent sessions in flight at once (1 = serial). Output keeps the input row order.
+WORKERS = int(os.getenv("ACTUAL_OUTPUT_WORKERS", "1"))
+MAX_IN_FLIGHT = int(os.getenv("ACTUAL_OUTPUT_MAX_IN_FLIGHT", str(2 * WORKERS)))
+# Session IDs are "<prefix>-<row hash>-<occurrence>-<run>-<attempt>": the row part
+# traces agent logs back to the input row, and the run/attempt suffix gives every
+# invocation (retries and reruns included) a fresh session with no earlier turns.
+SESSION_PREFIX = os.getenv("ACTUAL_OUTPUT_SESSION_PREFIX", "eval")
+RUN_ID = time.strftime("%Y%m%dT%H%M%S", time.gmtime())
+# enableTrace mode: trace events are parsed into a per-step breakdown (time and
+# tokens for pre-processing, orchestration, KB lookup, ...) stored as JSON in
+# the trace_breakdown column. Tracing makes the stream larger, so it is opt-in.
+ENABLE_TRACE = os.getenv("ACTUAL_OUTPUT_ENABLE_TRACE", "0") == "1"
+TIMING_COLUMNS = ["session_id", "first_chunk_ms", "total_ms", "chunk_count"]
+if ENABLE_TRACE:
+    TIMING_COLUMNS += ["trace_breakdown"]
+# Agent response cache (in the Bedrock response cache file), keyed by agent ID,
+# alias ID, the version the alias points to (resolved once per run) and the
+# normalized user_input. A new alias version gives new keys, so stale answers
+# are never served. Needs bedrock-agent:GetAgentAlias; without it the run
+# continues uncached.
+AGENT_CACHE = os.getenv("ACTUAL_OUTPUT_CACHE", "1") == "1"
 RUN_SUMMARY_PATH = os.getenv(
     "ACTUAL_OUTPUT_RUN_SUMMARY_PATH",
     "outputs/test/actual_outputs_run_summary.json"
@@ -53,43 +88,112 @@ def get_agent_client():
     return session.client(service_name="bedrock-agent-runtime", region_name=AWS_REGION)
 
 
-def backoff_sleep(attempt):
-    base = BACKOFF_BASE_SECONDS * (2 ** attempt)
-    sleep_for = min(base, BACKOFF_MAX_SECONDS)
-    sleep_for += random.uniform(0, BACKOFF_JITTER_SECONDS)
-    time.sleep(sleep_for)
+# Shared AIMD limiter + retry policy for every Bedrock call in this stage.
+RETRY_CONTROLLER = AdaptiveConcurrencyController(
+    max_retries=MAX_RETRIES,
+    backoff_base_seconds=BACKOFF_BASE_SECONDS,
+    backoff_max_seconds=BACKOFF_MAX_SECONDS,
+    backoff_jitter_seconds=BACKOFF_JITTER_SECONDS,
+)
 
 
 def call_with_retry(fn, operation_name, error_log):
-    last_error = None
-    for attempt in range(MAX_RETRIES + 1):
-        try:
-            return fn()
-        except ClientError as e:
-            last_error = e
-        except Exception as e:
-            last_error = e
-
-        if attempt < MAX_RETRIES:
-            backoff_sleep(attempt)
-        else:
-            if last_error is not None:
-                error_log.append({
-                    "timestamp": datetime.utcnow().isoformat() + "Z",
-                    "operation": operation_name,
-                    "error": str(last_error),
-                })
-            return None
+    return RETRY_CONTROLLER.call(fn, operation_name, error_log)
+
+
+def get_agent_build_client():
+    session = boto3.Session(profile_name=AWS_PROFILE_SANDBOX)
+    return session.client(service_name="bedrock-agent", region_name=AWS_REGION)
+
+
+def resolve_alias_version(client, error_log):
+    """
+    Version the alias routes to. DRAFT can change without a new version, so it
+    is qualified with the agent's preparedAt timestamp. Returns None if unknown.
+    """
+    def _get_alias():
+        return client.get_agent_alias(agentId=AGENT_ID, agentAliasId=AGENT_ALIAS_ID)
+
+    response = call_with_retry(_get_alias, "get_agent_alias", error_log)
+    routing = ((response or {}).get("agentAlias") or {}).get("routingConfiguration") or []
+    version = routing[0].get("agentVersion") if routing else None
+    if version != "DRAFT":
+        return version
+
+    def _get_agent():
+        return client.get_agent(agentId=AGENT_ID)
 
+    agent = call_with_retry(_get_agent, "get_agent", error_log)
+    prepared_at = ((agent or {}).get("agent") or {}).get("preparedAt")
+    return f"DRAFT@{prepared_at}" if prepared_at else None
 
-def extract_agent_text(response):
+
+def agent_cache_id(alias_version):
+    return f"agent/{AGENT_ID}/{AGENT_ALIAS_ID}/{alias_version}"
+
+
+def invoke_agent_cached(user_input, client, error_log, session_id, cache, alias_version):
+    """
+    invoke_agent through the agent response cache. A hit returns the cached
+    answer with the session that produced it and no timings.
+    """
+    if cache is None or not alias_version:
+        return invoke_agent(user_input, client, error_log, session_id)
+
+    fresh = {}
+
+    def _invoke():
+        actual_output, timing = invoke_agent(user_input, client, error_log, session_id)
+        fresh.update(timing)
+        if not actual_output:
+            return None
+        return json.dumps(
+            {"actual_output": actual_output, "session_id": timing.get("session_id", session_id)},
+            ensure_ascii=False,
+        )
+
+    raw = cached_call(
+        cache,
+        agent_cache_id(alias_version),
+        {"inputText": normalize_text(user_input)},
+        _invoke,
+        cacheable=True,
+    )
+    if raw is None:
+        return "", fresh
+    cached = json.loads(raw)
+    if fresh:
+        return cached["actual_output"], fresh
+    return cached["actual_output"], {"session_id": cached.get("session_id", "")}
+
+
+def make_session_id(row_key):
+    """Deterministic row part of the session ID from a keyed_rows key ("<sha256>:<occurrence>")."""
+    digest, _, occurrence = row_key.partition(":")
+    return f"{SESSION_PREFIX}-{digest[:16]}-{occurrence or 1}"
+
+
+def attempt_session_id(session_id, attempt):
+    """Session of one invoke_agent attempt, so a retry never lands in the failed attempt's session."""
+    return f"{session_id}-{RUN_ID}-{attempt}"
+
+
+def extract_agent_text(response, started=None):
+    """
+    Consumes the completion event stream as it arrives. Returns (text, timing)
+    with time to first chunk, total time (from started, if given), chunk count
+    and, in enableTrace mode, the trace breakdown.
+    """
+    started = time.monotonic() if started is None else started
+    timing = {"first_chunk_ms": "", "total_ms": "", "chunk_count": 0}
     if not response:
-        return ""
+        return "", timing
 
     completion = response.get("completion")
     if completion is None:
-        return ""
+        return "", timing
 
+    collector = AgentTraceCollector() if ENABLE_TRACE else None
     text_parts = []
     for event in completion:
         if not isinstance(event, dict):
@@ -97,39 +201,83 @@ def extract_agent_text(response):
         if "chunk" in event and isinstance(event["chunk"], dict):
             chunk = event["chunk"].get("bytes")
             if isinstance(chunk, (bytes, bytearray)):
+                if timing["chunk_count"] == 0:
+                    timing["first_chunk_ms"] = round((time.monotonic() - started) * 1000)
+                timing["chunk_count"] += 1
                 text_parts.append(chunk.decode("utf-8", errors="ignore"))
-        if "trace" in event:
-            continue
-    return "".join(text_parts).strip()
+        if "trace" in event and collector is not None:
+            collector.observe(event["trace"])
+    timing["total_ms"] = round((time.monotonic() - started) * 1000)
+    if collector is not None:
+        timing["trace_breakdown"] = dump_breakdown(collector.breakdown())
+    return "".join(text_parts).strip(), timing
 
 
 def invoke_agent(user_input, client, error_log, session_id):
+    """
+    Returns (actual_output, timing). The stream is read inside the retry, so
+    mid-stream errors are retried, each attempt in a new session.
+    """
+    attempts = []
+
     def _call():
-        return client.invoke_agent(
+        attempts.append(attempt_session_id(session_id, len(attempts) + 1))
+        started = time.monotonic()
+        response = client.invoke_agent(
             agentId=AGENT_ID,
             agentAliasId=AGENT_ALIAS_ID,
-            sessionId=session_id,
-            inputText=user_input
+            sessionId=attempts[-1],
+            inputText=user_input,
+            enableTrace=ENABLE_TRACE
         )
+        return extract_agent_text(response, started)
 
-    response = call_with_retry(_call, "invoke_agent", error_log)
-    return extract_agent_text(response) if response else ""
+    result = call_with_retry(_call, "invoke_agent", error_log)
+    last_session_id = attempts[-1] if attempts else session_id
+    if result is None:
+        return "", {"session_id": last_session_id}
+    text, timing = result
+    return text, dict(timing, session_id=last_session_id)
 
 
 def build_output_columns(input_columns):
     actual_column = "actual_output"
-    if actual_column in input_columns:
-        return input_columns
-
     columns = list(input_columns)
-    if "expected_output" in columns:
-        idx = columns.index("expected_output")
-        columns.insert(idx + 1, actual_column)
-    else:
-        columns.append(actual_column)
+    if actual_column not in columns:
+        if "expected_output" in columns:
+            idx = columns.index("expected_output")
+            columns.insert(idx + 1, actual_column)
+        else:
+            columns.append(actual_column)
+
+    columns.extend(col for col in TIMING_COLUMNS if col not in columns)
     return columns
 
 
+TIMING_SAMPLE_COLUMNS = ("first_chunk_ms", "total_ms", "chunk_count")
+
+
+def record_timing(samples, output_row):
+    """
+    Keeps only the timing values of a row that invoked the agent in this run
+    (and its trace breakdown in enableTrace mode), not the answer itself.
+    """
+    for col in TIMING_SAMPLE_COLUMNS:
+        value = output_row.get(col)
+        if isinstance(value, (int, float)):
+            samples.setdefault(col, []).append(value)
+    if ENABLE_TRACE:
+        samples.setdefault("trace_breakdown", []).append(output_row.get("trace_breakdown"))
+
+
+def summarize_timing(samples):
+    """p50/p95 of the agent timing columns over the rows that invoked the agent in this run."""
+    summary = {"rows": len(samples.get("total_ms", []))}
+    for col in TIMING_SAMPLE_COLUMNS:
+        summary[col] = summarize_values(samples.get(col, []))
+    return summary
+
+
 def main():
     if not os.path.exists(INPUT_CSV_PATH):
         print(f"Input file not found: {INPUT_CSV_PATH}")
@@ -139,49 +287,151 @@ def main():
     client = get_agent_client()
     error_log = []
 
-    with open(INPUT_CSV_PATH, "r", encoding="utf-8", newline="") as in_file, open(
-        OUTPUT_CSV_PATH, "w", encoding="utf-8", newline=""
-    ) as out_file:
+    cache = None
+    alias_version = None
+    if AGENT_CACHE:
+        cache = open_bedrock_cache()
+    if cache is not None:
+        alias_version = resolve_alias_version(get_agent_build_client(), error_log)
+        if alias_version:
+            print(f"Agent cache: alias {AGENT_ALIAS_ID} -> version {alias_version}")
+        else:
+            print("Agent cache: alias version unknown, running without cache.")
+    reused_rows = 0
+    timing_samples = {}
+    dedup = SingleFlight(is_ok=lambda result: bool(result[0]), max_results=DEDUP_MAX_RESULTS)
+
+    filled_rows = {}
+    if RESUME:
+        filled_rows = load_filled_rows(OUTPUT_CSV_PATH, RESUME_KEY_FIELDS, "actual_output")
+        if filled_rows:
+            print(f"Resuming: {len(filled_rows)} rows with actual_output found in previous output.")
+
+    with open(INPUT_CSV_PATH, "r", encoding="utf-8", newline="") as in_file:
         reader = csv.DictReader(in_file)
         if not reader.fieldnames:
             print(f"No header found in input file: {INPUT_CSV_PATH}")
             return
 
         output_columns = build_output_columns(reader.fieldnames)
-        writer = csv.DictWriter(out_file, fieldnames=output_columns)
-        writer.writeheader()
+        generated_columns = ["actual_output"] + TIMING_COLUMNS
+        # Rows stream into "<output>.partial"; the output is replaced atomically at the end.
+        writer = CheckpointWriter(OUTPUT_CSV_PATH, output_columns)
+
+        def _process(item):
+            _, key, row = item
+            previous = filled_rows.get(key)
+            if previous is not None:
+                output_row = {col: row.get(col, "") for col in output_columns}
+                for col in generated_columns:
+                    if col in previous:
+                        output_row[col] = previous[col]
+                return output_row, True
 
-        processed_rows = 0
-        for idx, row in enumerate(reader, start=1):
             user_input = (row.get("user_input") or "").strip()
             actual_output = ""
+            timing = {}
 
             if user_input:
-                session_id = f"row-{idx}-{int(time.time() * 1000)}"
-                actual_output = invoke_agent(user_input, client, error_log, session_id)
+                session_id = make_session_id(key)
+                def _invoke():
+                    return invoke_agent_cached(
+                        user_input, client, error_log, session_id, cache, alias_version
+                    )
+
+                if DEDUP:
+                    (actual_output, timing), shared = dedup.do(request_key(user_input), _invoke)
+                    if shared:
+                        # Only the session that answered is recorded; no timings for this row.
+                        timing = {"session_id": timing.get("session_id", "")}
+                else:
+                    actual_output, timing = _invoke()
 
             output_row = {}
             for col in output_columns:
                 if col == "actual_output":
                     output_row[col] = actual_output
+                elif col in TIMING_COLUMNS:
+                    output_row[col] = timing.get(col, "")
                 else:
                     output_row[col] = row.get(col, "")
+            return output_row, False
 
-            writer.writerow(output_row)
-            processed_rows += 1
-            print(f"[{idx}] Actual output generated")
+        items = (
+            (idx, key, row)
+            for idx, (key, row) in enumerate(keyed_rows(reader, RESUME_KEY_FIELDS), start=1)
+        )
 
-    print(f"Done. Processed {processed_rows} rows.")
+        processed_rows = 0
+        results = ordered_map(_process, items, WORKERS, MAX_IN_FLIGHT)
+        for (idx, _, _), (output_row, reused) in results:
+            writer.write_row(output_row)
+            processed_rows += 1
+            if reused:
+                reused_rows += 1
+                print(f"[{idx}] Actual output already filled, skipped")
+            elif output_row["total_ms"] != "":
+                record_timing(timing_samples, output_row)
+                print(
+                    f"[{idx}] Actual output generated "
+                    f"(first chunk {output_row['first_chunk_ms']} ms, total {output_row['total_ms']} ms)"
+                )
+            else:
+                print(f"[{idx}] Actual output generated")
+
+        writer.finalize()
+
+    print(f"Done. Processed {processed_rows} rows ({reused_rows} reused from previous output).")
     print(f"Saved file: {OUTPUT_CSV_PATH}")
 
+    dedup_stats = dedup.stats()
+    if DEDUP:
+        print(f"Dedup: {dedup_stats['saved_calls']} agent calls saved for duplicated rows")
+
+    throughput = RETRY_CONTROLLER.stats()
+    print(
+        f"Bedrock: {throughput['requests_per_second']} req/s | "
+        f"throttle rate {throughput['throttle_rate']:.1%} | final concurrency {throughput['final_concurrency_limit']}"
+    )
+
+    timing_summary = summarize_timing(timing_samples)
+    print(
+        f"Agent latency: first chunk p50 {timing_summary['first_chunk_ms']['p50']} ms | "
+        f"total p50 {timing_summary['total_ms']['p50']} ms, p95 {timing_summary['total_ms']['p95']} ms"
+    )
+    if ENABLE_TRACE:
+        timing_summary["trace_steps"] = summarize_breakdowns(timing_samples.get("trace_breakdown", []))
+        for step, step_summary in timing_summary["trace_steps"].items():
+            print(
+                f"  {step}: p50 {step_summary['ms']['p50']} ms, p95 {step_summary['ms']['p95']} ms "
+                f"({step_summary['share_of_step_time']:.0%} of traced time)"
+            )
+
+    cache_stats = None
+    if cache is not None:
+        cache.close()
+        cache_stats = dict(cache.stats(), alias_version=alias_version)
+        print(
+            f"Agent cache: {cache_stats['hits']} hits | {cache_stats['misses']} misses | "
+            f"hit rate {cache_stats['hit_rate']:.1%}"
+        )
+
+    # Always written: the cache hit rate and latency matter even on clean runs.
+    ensure_parent_dir(RUN_SUMMARY_PATH)
+    with open(RUN_SUMMARY_PATH, "w", encoding="utf-8") as summary_file:
+        json.dump({
+            "processed_rows": processed_rows,
+            "reused_rows": reused_rows,
+            "dedup": dedup_stats,
+            "cache": cache_stats,
+            "throughput": throughput,
+            "latency": timing_summary,
+            "errors": error_log,
+        }, summary_file, ensure_ascii=False, indent=2)
     if error_log:
-        ensure_parent_dir(RUN_SUMMARY_PATH)
-        with open(RUN_SUMMARY_PATH, "w", encoding="utf-8") as summary_file:
-            json.dump({
-                "processed_rows": processed_rows,
-                "errors": error_log,
-            }, summary_file, ensure_ascii=False, indent=2)
         print(f"Run summary with errors saved to: {RUN_SUMMARY_PATH}")
+    else:
+        print(f"Run summary saved to: {RUN_SUMMARY_PATH}")
 
 
 if __name__ == "__main__":
@@ -4,12 +4,14 @@ import json
 import pandas as pd
 import boto3
 import ast
-import random
-import time
 import re
-from datetime import datetime
-from botocore.exceptions import ClientError
+import time
 import config
+from latency_stats import summarize_values
+from local_retriever import open_local_retriever, stored_embedder
+from parallel import ordered_map
+from retrieval_store import compact_results, open_retrieval_store, query_key
+from throttling import AdaptiveConcurrencyController
 
 def get_runtime_client():
     session = boto3.Session(profile_name=config.AWS_PROFILE_SANDBOX)
@@ -20,32 +22,11 @@ def ensure_parent_dir(path):
     if parent:
         os.makedirs(parent, exist_ok=True)
 
-def backoff_sleep(attempt):
-    base = config.BACKOFF_BASE_SECONDS * (2 ** attempt)
-    sleep_for = min(base, config.BACKOFF_MAX_SECONDS)
-    sleep_for += random.uniform(0, config.BACKOFF_JITTER_SECONDS)
-    time.sleep(sleep_for)
+# Shared AIMD limiter + retry policy for every Bedrock call in this stage.
+RETRY_CONTROLLER = AdaptiveConcurrencyController()
 
 def call_with_retry(fn, operation_name, error_log):
-    last_error = None
-    for attempt in range(config.MAX_RETRIES + 1):
-        try:
-            return fn()
-        except ClientError as e:
-            last_error = e
-        except Exception as e:
-            last_error = e
-
-        if attempt < config.MAX_RETRIES:
-            backoff_sleep(attempt)
-        else:
-            if last_error is not None:
-                error_log.append({
-                    "timestamp": datetime.utcnow().isoformat() + "Z",
-                    "operation": operation_name,
-                    "error": str(last_error),
-                })
-            return None
+    return RETRY_CONTROLLER.call(fn, operation_name, error_log)
 
 def clean_text(text):
     """Helper to clean retrieved text for better comparison."""
@@ -57,7 +38,15 @@ def clean_text(text):
 def extract_s3_uri(uri):
     return uri or ""
 
-def retrieve_contexts(query, client, error_log):
+def retrieve_response(query, client, error_log, top_k=None, search_type=None):
+    """
+    Raw retrieve response for query, or None once retries are exhausted.
+    search_type ("SEMANTIC" or "HYBRID") overrides the KB's default search.
+    """
+    vector_search = {'numberOfResults': top_k or config.TOP_K}
+    if search_type:
+        vector_search['overrideSearchType'] = search_type
+
     def _call():
         return client.retrieve(
             knowledgeBaseId=config.KB_ID,
@@ -65,29 +54,89 @@ def retrieve_contexts(query, client, error_log):
                 'text': query
             },
             retrievalConfiguration={
-                'vectorSearchConfiguration': {
-                    'numberOfResults': config.TOP_K
-                }
+                'vectorSearchConfiguration': vector_search
             }
         )
 
-    response = call_with_retry(_call, "retrieve", error_log)
+    return call_with_retry(_call, "retrieve", error_log)
+
+def ranked_lists(results):
+    """(cleaned texts, file URIs, scores) of compact results, best first."""
+    return (
+        [clean_text(res['text']) for res in results],
+        [extract_s3_uri(res['uri']) for res in results],
+        [res['score'] for res in results],
+    )
+
+def retrieve_contexts(query, client, error_log, top_k=None, search_type=None):
+    """Returns (texts, file URIs, scores) of the top_k results, best first."""
+    response = retrieve_response(query, client, error_log, top_k, search_type)
     if response is None:
         print(f"Retrieval Error for query '{query}': exhausted retries")
-        return []
-
-    results = response.get('retrievalResults', [])
-    retrieved_texts = []
-    retrieved_files = []
-    for res in results:
-        retrieved_texts.append(clean_text(res['content']['text']))
-        uri = (
-            res.get('location', {})
-               .get('s3Location', {})
-               .get('uri', "")
-        )
-        retrieved_files.append(extract_s3_uri(uri))
-    return retrieved_texts, retrieved_files
+        return [], [], []
+    return ranked_lists(compact_results(response))
+
+def fetch_into_store(queries, client, store, error_log):
+    """
+    Retrieves at RETRIEVAL_MAX_K every distinct query the store does not hold
+    yet (all of them with RETRIEVER_REFRESH) and persists the raw results.
+    Returns {query key: latency_ms} of the KB calls made in this run (None
+    for calls that failed).
+    """
+    pending = {}
+    for query in queries:
+        key = query_key(config.KB_ID, query)
+        if key in pending:
+            continue
+        if config.RETRIEVER_REFRESH or not store.has(config.KB_ID, query, config.RETRIEVAL_MAX_K):
+            pending[key] = query
+    print(f"{len(pending)} of {len(queries)} queries need a KB call ({config.RETRIEVER_WORKERS} workers)...")
+
+    def _fetch(query):
+        started = time.monotonic()
+        response = retrieve_response(query, client, error_log, config.RETRIEVAL_MAX_K)
+        latency_ms = round((time.monotonic() - started) * 1000)
+        if response is None:
+            print(f"Retrieval Error for query '{query}': exhausted retries")
+            return None
+        store.put(config.KB_ID, query, config.RETRIEVAL_MAX_K, response, latency_ms)
+        return latency_ms
+
+    fresh = {}
+    for done, (query, latency_ms) in enumerate(
+        ordered_map(_fetch, list(pending.values()), config.RETRIEVER_WORKERS), 1
+    ):
+        fresh[query_key(config.KB_ID, query)] = latency_ms
+        if latency_ms is not None:
+            print(f"[{done}/{len(pending)}] Retrieved in {latency_ms} ms: {str(query)[:30]}...")
+    return fresh
+
+def derive_from_store(queries, store, fresh_latencies=None):
+    """
+    Yields (position, query, (texts, files, scores), latency_ms) from the stored
+    results, in row order. Queries missing from the store get empty lists.
+    latency_ms is only set on the first row of a query fetched in this run
+    (fresh_latencies); rows served from an earlier run's results have none.
+    """
+    fresh_latencies = dict(fresh_latencies or {})
+    for position, query in enumerate(queries):
+        stored = store.get(config.KB_ID, query, config.RETRIEVAL_MAX_K)
+        if stored is None:
+            yield position, query, ([], [], []), None
+            continue
+        results, _ = stored
+        latency_ms = fresh_latencies.pop(query_key(config.KB_ID, query), None)
+        yield position, query, ranked_lists(results), latency_ms
+
+def retrieve_all_local(queries, backend):
+    """Same as derive_from_store from the offline index; latency is the batch time per query."""
+    retriever = open_local_retriever(dense=backend == "dense")
+    embed = stored_embedder("question") if backend == "dense" else None
+    started = time.monotonic()
+    results = retriever.retrieve_batch(queries, config.RETRIEVAL_MAX_K, backend, embed)
+    latency_ms = round((time.monotonic() - started) * 1000 / max(1, len(queries)), 3)
+    for position, (query, ranked) in enumerate(zip(queries, results)):
+        yield position, query, ranked, latency_ms
 
 def main():
     print(f"Loading {config.RETRIEVER_INPUT_CSV}...")
@@ -103,39 +152,89 @@ def main():
         lambda x: ast.literal_eval(x) if isinstance(x, str) else x
     )
 
-    client = get_runtime_client()
     error_log = []
-    
-    print("Starting retrieval process...")
-    retrieved_data = []
-    retrieved_files_data = []
-    
-    for index, row in df.iterrows():
-        query = row['user_input']
-        print(f"[{index+1}/{len(df)}] Retrieving: {query[:30]}...")
-        
-        contexts, retrieved_files = retrieve_contexts(query, client, error_log)
-        retrieved_data.append(contexts)
-        retrieved_files_data.append(retrieved_files)
+    queries = df['user_input'].tolist()
+    store = None
+    kb_calls = 0
+    fresh_latencies = {}
+    if config.RETRIEVER_BACKEND == "kb":
+        store = open_retrieval_store()
+        if config.RETRIEVER_OFFLINE:
+            print(f"Offline: deriving columns from {store.path} only.")
+        else:
+            fresh_latencies = fetch_into_store(queries, get_runtime_client(), store, error_log)
+            kb_calls = len(fresh_latencies)
+        results = derive_from_store(queries, store, fresh_latencies)
+    else:
+        print(f"Starting local {config.RETRIEVER_BACKEND} retrieval over {config.KB_FOLDER}...")
+        results = retrieve_all_local(queries, config.RETRIEVER_BACKEND)
+
+    retrieved_data = [None] * len(df)
+    retrieved_files_data = [None] * len(df)
+    retrieved_scores_data = [None] * len(df)
+    latencies = [None] * len(df)
+    ranked_data = [None] * len(df)
+    ranked_files_data = [None] * len(df)
+    ranked_scores_data = [None] * len(df)
+
+    # One retrieve at the largest K: retrieved_* keep the TOP_K prefix for the
+    # evaluators, ranked_* keep the full list for the K-sweep in 7_custom_evaluator.py.
+    # Columns are filled by row position, so they stay aligned with their rows.
+    for position, query, (contexts, retrieved_files, scores), latency_ms in results:
+        retrieved_data[position] = contexts[:config.TOP_K]
+        retrieved_files_data[position] = retrieved_files[:config.TOP_K]
+        retrieved_scores_data[position] = scores[:config.TOP_K]
+        ranked_data[position] = contexts
+        ranked_files_data[position] = retrieved_files
+        ranked_scores_data[position] = scores
+        latencies[position] = latency_ms
 
     df['retrieved_contexts'] = retrieved_data
     df['retrieved_file'] = retrieved_files_data
+    df['retrieved_scores'] = retrieved_scores_data
+    df['ranked_contexts'] = ranked_data
+    df['ranked_files'] = ranked_files_data
+    df['ranked_scores'] = ranked_scores_data
+    df['retrieval_latency_ms'] = latencies
     
     # df.to_csv(config.OUTPUT_EVALSET_CSV, index=False)
     df.to_csv("outputs/subset/4_evalset.csv", index=False)
     print(f"Retrieval complete. Saved to {config.OUTPUT_EVALSET_CSV}")
 
-    if error_log:
-        summary_path = os.path.join(
-            os.path.dirname(config.OUTPUT_EVALSET_CSV),
-            "retriever_run_summary.json"
-        )
-        ensure_parent_dir(summary_path)
-        with open(summary_path, "w", encoding="utf-8") as summary_file:
-            json.dump({
-                "retrieved": len(df),
-                "errors": error_log,
-            }, summary_file, ensure_ascii=False, indent=2)
+    missing = sum(1 for contexts in ranked_data if not contexts)
+    if missing:
+        print(f"{missing} rows have no retrieved contexts.")
+    store_stats = None
+    if store is not None:
+        store_stats = store.stats()
+        store.close()
+        print(f"Retrieval store: {kb_calls} KB calls, {store_stats['requests']} stored queries ({store_stats['path']})")
+
+    throughput = RETRY_CONTROLLER.stats()
+    # Only KB calls made in this run have a latency: rows served from the store,
+    # repeated queries and failed retrievals are left blank.
+    latency = summarize_values([value for value in latencies if value is not None], (50, 95, 99))
+    print(f"Retrieve latency: p50 {latency['p50']} ms | p95 {latency['p95']} ms | p99 {latency['p99']} ms")
+    print(
+        f"Bedrock: {throughput['requests_per_second']} req/s | "
+        f"throttle rate {throughput['throttle_rate']:.1%} | final concurrency {throughput['final_concurrency_limit']}"
+    )
+
+    summary_path = os.path.join(
+        os.path.dirname(config.OUTPUT_EVALSET_CSV),
+        "retriever_run_summary.json"
+    )
+    ensure_parent_dir(summary_path)
+    with open(summary_path, "w", encoding="utf-8") as summary_file:
+        json.dump({
+            "retrieved": len(df),
+            "missing_rows": missing,
+            "throughput": throughput,
+            "latency_ms": latency,
+            "kb_calls": kb_calls,
+            "store": store_stats,
+            "errors": error_log,
+        }, summary_file, ensure_ascii=False, indent=2)
 
 if __name__ == "__main__":
     main()
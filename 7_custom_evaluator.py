@@ -4,6 +4,13 @@ import numpy as np
 import ast
 import config
 
+def parse_list(value):
+    if isinstance(value, str):
+        return ast.literal_eval(value) if value.strip() else []
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return list(value)
+    return []
+
 def contains_source_file(source_file, retrieved_files):
     if not source_file or not retrieved_files:
         return False, 0
@@ -13,52 +20,63 @@ def contains_source_file(source_file, retrieved_files):
             return True, i + 1
     return False, 0
 
-def calculate_metrics(row):
-    # Load lists (handling string conversion from CSV)
-    gt_list = row['reference_contexts']
-    retrieved_list = row['retrieved_contexts']
-    retrieved_files = row.get('retrieved_file', [])
-    
-    if isinstance(gt_list, str): gt_list = ast.literal_eval(gt_list)
-    if isinstance(retrieved_list, str): retrieved_list = ast.literal_eval(retrieved_list)
-    if isinstance(retrieved_files, str): retrieved_files = ast.literal_eval(retrieved_files)
-    
+def contains_reference_text(gt_text, retrieved_list):
+    # Logic: Is the ground truth substring roughly contained in the retrieved chunk?
+    # Or is the retrieved chunk contained in the ground truth (if chunks are small)?
+    clean_gt = " ".join(str(gt_text).lower().split())
+    for i, ret_text in enumerate(retrieved_list):
+        clean_ret = " ".join(str(ret_text).lower().split())
+        if clean_gt in clean_ret or clean_ret in clean_gt:
+            return True, i + 1
+    return False, 0
+
+def match_ranks(row):
+    """
+    1-based ranks (0 = no match) of the first source-file match and the first
+    reference-text match in the ranked results. Uses the full ranked_* lists
+    of a max-K retrieval when present, else retrieved_*.
+    """
+    has_ranked = isinstance(row.get('ranked_files'), (str, list, np.ndarray))
+    retrieved_list = parse_list(row['ranked_contexts'] if has_ranked else row['retrieved_contexts'])
+    retrieved_files = parse_list(row['ranked_files'] if has_ranked else row.get('retrieved_file', []))
+
     # We assume 1 ground truth chunk for this pipeline
+    gt_list = parse_list(row['reference_contexts'])
     gt_text = gt_list[0] if gt_list else ""
-    
-    hit = False
-    rank = 0
 
-    source_file = row.get('source_file', "")
-    if source_file and retrieved_files:
-        hit, rank = contains_source_file(source_file, retrieved_files)
-    
-    # Check for containment
-    # Logic: Is the ground truth substring roughly contained in the retrieved chunk?
-    # Or is the retrieved chunk contained in the ground truth (if chunks are small)?
-    if not hit:
-        for i, ret_text in enumerate(retrieved_list):
-            # Normalize for comparison
-            clean_gt = " ".join(gt_text.lower().split())
-            clean_ret = " ".join(ret_text.lower().split())
-            
-            if clean_gt in clean_ret or clean_ret in clean_gt:
-                hit = True
-                rank = i + 1
-                break
-    
-    # Metrics
-    hit_rate = 1 if hit else 0
-    mrr = 1.0 / rank if hit else 0.0
-    
-    # Precision@K: (Relevant Items in Top K) / K
-    precision = (1 / config.EVAL_K) if hit else 0
-    
-    # Recall@K: (Relevant Items in Top K) / Total Relevant Items
-    # Total Relevant is 1 in this synthetic setup
-    recall = 1 if hit else 0
-    
-    return pd.Series([hit_rate, mrr, precision, recall])
+    _, source_rank = contains_source_file(row.get('source_file', ""), retrieved_files)
+    _, text_rank = contains_reference_text(gt_text, retrieved_list)
+    return pd.Series([source_rank, text_rank, max(len(retrieved_list), len(retrieved_files))])
+
+def ranks_at_k(source_ranks, text_ranks, k_values):
+    """
+    (rows x K) matrix of the rank that counts as the hit at each K, 0 for a miss.
+    A source-file match within the top k wins over a text match, as in the
+    single-K metric.
+    """
+    source = np.asarray(source_ranks, dtype=int)[:, None]
+    text = np.asarray(text_ranks, dtype=int)[:, None]
+    ks = np.asarray(k_values, dtype=int)[None, :]
+    source_hit = (source >= 1) & (source <= ks)
+    text_hit = (text >= 1) & (text <= ks)
+    return np.where(source_hit, source, np.where(text_hit, text, 0))
+
+def metric_curves(source_ranks, text_ranks, k_values):
+    """
+    Hit rate, MRR, precision and recall at every K for all rows at once.
+    Returns per-row matrices (rows x K) keyed by metric name.
+    """
+    ranks = ranks_at_k(source_ranks, text_ranks, k_values)
+    hit = ranks > 0
+    ks = np.asarray(k_values, dtype=float)[None, :]
+    return {
+        'hit_rate': hit.astype(int),
+        'mrr': np.where(hit, 1.0 / np.maximum(ranks, 1), 0.0),
+        # Precision@K: (Relevant Items in Top K) / K
+        'precision': hit / ks,
+        # Recall@K: (Relevant Items in Top K) / Total Relevant Items (1 in this synthetic setup)
+        'recall': hit.astype(float),
+    }
 
 def main():
     print(f"Loading {config.OUTPUT_RAGAS_DEEP_EVALSET_CSV}...")
@@ -69,16 +87,36 @@ def main():
         return
 
     print("Calculating metrics...")
-    
-    metrics_df = df.apply(calculate_metrics, axis=1)
-    metrics_df.columns = [
-        'custom_hit_rate',
-        'custom_mrr',
-        'custom_precision_at_k',
-        'custom_recall_at_k',
-    ]
-    
-    final_df = pd.concat([df, metrics_df], axis=1)
+
+    ranks_df = df.apply(match_ranks, axis=1)
+    ranks_df.columns = ['custom_source_rank', 'custom_text_rank', 'custom_results_retrieved']
+
+    k_values = sorted(set(config.EVAL_K_VALUES) | {config.EVAL_K})
+    curves = metric_curves(ranks_df['custom_source_rank'], ranks_df['custom_text_rank'], k_values)
+    eval_k = k_values.index(config.EVAL_K)
+    metrics_df = pd.DataFrame({
+        'custom_hit_rate': curves['hit_rate'][:, eval_k],
+        'custom_mrr': curves['mrr'][:, eval_k],
+        'custom_precision_at_k': curves['precision'][:, eval_k],
+        'custom_recall_at_k': curves['recall'][:, eval_k],
+    }, index=df.index)
+
+    final_df = pd.concat([df, ranks_df, metrics_df], axis=1)
+
+    # K-sweep curves: mean of each metric at every K. rows_with_k_results shows
+    # how many rows actually had K results (an evalset retrieved at a smaller K
+    # cannot support the larger ones).
+    curves_df = pd.DataFrame({
+        'k': k_values,
+        'hit_rate': curves['hit_rate'].mean(axis=0),
+        'mrr': curves['mrr'].mean(axis=0),
+        'precision': curves['precision'].mean(axis=0),
+        'recall': curves['recall'].mean(axis=0),
+        'rows_with_k_results': [
+            int((ranks_df['custom_results_retrieved'] >= k).sum()) for k in k_values
+        ],
+    })
+    print(curves_df.to_string(index=False, float_format=lambda x: f"{x:.3f}"))
     
     # Parse lists back to actual python objects for Parquet saving
     # (Parquet handles lists natively, unlike CSV)
@@ -88,20 +126,24 @@ def main():
     final_df['retrieved_contexts'] = final_df['retrieved_contexts'].apply(
         lambda x: ast.literal_eval(x) if isinstance(x, str) else x
     )
-    if 'retrieved_file' in final_df.columns:
-        final_df['retrieved_file'] = final_df['retrieved_file'].apply(
-            lambda x: ast.literal_eval(x) if isinstance(x, str) else x
-        )
+    for col in ['retrieved_file', 'ranked_contexts', 'ranked_files', 'ranked_scores']:
+        if col in final_df.columns:
+            final_df[col] = final_df[col].apply(
+                lambda x: ast.literal_eval(x) if isinstance(x, str) else x
+            )
 
     # Persist the augmented eval set with custom metrics (new file)
     final_df.to_csv(config.OUTPUT_FULL_EVALSET_CSV, index=False)
 
     # Save a Parquet version for downstream apps (handles lists natively)
     final_df.to_parquet(config.OUTPUT_RESULTS_PARQUET, index=False)
+
+    curves_df.to_csv(config.OUTPUT_K_CURVES_CSV, index=False)
     print(
         "Evaluation complete. Results saved to "
         f"{config.OUTPUT_FULL_EVALSET_CSV} and {config.OUTPUT_RESULTS_PARQUET}"
     )
+    print(f"K curves saved to {config.OUTPUT_K_CURVES_CSV}")
 
 if __name__ == "__main__":
     main()
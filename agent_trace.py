@@ -0,0 +1,132 @@
+import json
+import time
+
+from latency_stats import summarize_values
+
+# Top-level trace types of invoke_agent(enableTrace=True) and the step they map to.
+PHASE_STEPS = {
+    "preProcessingTrace": "pre_processing",
+    "orchestrationTrace": "orchestration",
+    "postProcessingTrace": "post_processing",
+    "routingClassifierTrace": "routing",
+    "guardrailTrace": "guardrail",
+}
+
+
+def _usage(output):
+    usage = (output.get("metadata") or {}).get("usage") or {}
+    return usage.get("inputTokens", 0) or 0, usage.get("outputTokens", 0) or 0
+
+
+def _reported_ms(output):
+    """totalTimeMs from the output metadata, when the service sends it."""
+    value = (output.get("metadata") or {}).get("totalTimeMs")
+    return value if isinstance(value, (int, float)) else None
+
+
+class AgentTraceCollector:
+    """
+    Turns the trace events of one invoke_agent stream into per-step timings and
+    token usage. Steps: pre_processing, orchestration (model calls),
+    kb_lookup, action_group, post_processing, routing and guardrail.
+
+    A step's time is the totalTimeMs the service reports for it; otherwise the
+    time between its input and output events arriving on the stream.
+    """
+
+    def __init__(self):
+        self.steps = {}
+        self._open = {}
+
+    def _step(self, name):
+        return self.steps.setdefault(
+            name, {"count": 0, "ms": 0, "input_tokens": 0, "output_tokens": 0}
+        )
+
+    def _begin(self, name, trace_id):
+        self._open[(name, trace_id)] = time.monotonic()
+
+    def _end(self, name, trace_id, output):
+        opened = self._open.pop((name, trace_id), None)
+        if opened is None:
+            # Unmatched trace ID: close the oldest open input of the same step.
+            for key in list(self._open):
+                if key[0] == name:
+                    opened = self._open.pop(key)
+                    break
+        elapsed = _reported_ms(output)
+        if elapsed is None and opened is not None:
+            elapsed = round((time.monotonic() - opened) * 1000)
+        step = self._step(name)
+        step["count"] += 1
+        step["ms"] += elapsed or 0
+        input_tokens, output_tokens = _usage(output)
+        step["input_tokens"] += input_tokens
+        step["output_tokens"] += output_tokens
+
+    def observe(self, trace_event):
+        """Feeds one stream event's "trace" payload."""
+        trace = (trace_event or {}).get("trace") or {}
+        for phase, phase_trace in trace.items():
+            step = PHASE_STEPS.get(phase)
+            if step is None or not isinstance(phase_trace, dict):
+                continue
+            if phase == "guardrailTrace":
+                self._end(step, None, phase_trace)
+                continue
+
+            model_input = phase_trace.get("modelInvocationInput")
+            if model_input:
+                self._begin(step, model_input.get("traceId"))
+            model_output = phase_trace.get("modelInvocationOutput")
+            if model_output:
+                self._end(step, model_output.get("traceId"), model_output)
+
+            invocation = phase_trace.get("invocationInput") or {}
+            if "knowledgeBaseLookupInput" in invocation:
+                self._begin("kb_lookup", invocation.get("traceId"))
+            elif "actionGroupInvocationInput" in invocation:
+                self._begin("action_group", invocation.get("traceId"))
+
+            observation = phase_trace.get("observation") or {}
+            if "knowledgeBaseLookupOutput" in observation:
+                self._end("kb_lookup", observation.get("traceId"), observation["knowledgeBaseLookupOutput"])
+            elif "actionGroupInvocationOutput" in observation:
+                self._end("action_group", observation.get("traceId"), observation["actionGroupInvocationOutput"])
+
+    def breakdown(self):
+        """Compact per-row struct: {step: {count, ms, input_tokens, output_tokens}}."""
+        return {name: dict(step) for name, step in self.steps.items()}
+
+
+def dump_breakdown(breakdown):
+    return json.dumps(breakdown, ensure_ascii=False, separators=(",", ":")) if breakdown else ""
+
+
+def load_breakdown(value):
+    if isinstance(value, dict):
+        return value
+    try:
+        return json.loads(value) if value else {}
+    except ValueError:
+        return {}
+
+
+def summarize_breakdowns(breakdowns):
+    """p50/p95 of each step's time and tokens across rows, plus each step's share of the total step time."""
+    per_step = {}
+    for breakdown in breakdowns:
+        for name, step in load_breakdown(breakdown).items():
+            per_step.setdefault(name, []).append(step)
+
+    total_ms = sum(step["ms"] for steps in per_step.values() for step in steps) or 0
+    summary = {}
+    for name, steps in sorted(per_step.items()):
+        step_ms = [step["ms"] for step in steps]
+        summary[name] = {
+            "ms": summarize_values(step_ms),
+            "input_tokens": summarize_values([step["input_tokens"] for step in steps]),
+            "output_tokens": summarize_values([step["output_tokens"] for step in steps]),
+            "share_of_step_time": round(sum(step_ms) / total_ms, 4) if total_ms else 0.0,
+        }
+    return summary
@@ -1,26 +1,18 @@
 ﻿import argparse
 import csv
 import json
+import sys
 from pathlib import Path
-from typing import Tuple
 
 import boto3
 
+# Also runnable as a plain script (python aws_tokenizer/token_count_all_md.py):
+# put the repo root on the path so the shared KB loader imports either way.
+REPO_ROOT = str(Path(__file__).resolve().parent.parent)
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
 
-def read_text(path: Path) -> Tuple[str, str]:
-    """
-    Returns (text, encoding_used). Falls back to latin-1 if utf-8 fails.
-    """
-    try:
-        return path.read_text(encoding="utf-8"), "utf-8"
-    except UnicodeDecodeError:
-        return path.read_text(encoding="latin-1"), "latin-1"
-
-
-def iter_md_files(root: Path):
-    for path in sorted(root.rglob("*.md")):
-        if path.is_file():
-            yield path
+from kb_loader import read_kb_texts, scan_kb
 
 
 def main() -> int:
@@ -44,7 +36,6 @@ def main() -> int:
     )
     args = parser.parse_args()
 
-    root = Path(args.root)
     out_path = Path(args.out)
     out_path.parent.mkdir(parents=True, exist_ok=True)
 
@@ -56,8 +47,8 @@ def main() -> int:
         if write_header:
             writer.writerow(["token_count", "file_name"])
 
-        for md_path in iter_md_files(root):
-            text, encoding_used = read_text(md_path)
+        for entry, text, encoding_used in read_kb_texts(scan_kb(args.root)):
+            md_path = Path(entry["path"])
             if not text.strip():
                 print(f"SKIP empty: {md_path}")
                 continue
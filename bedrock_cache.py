@@ -0,0 +1,191 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import config
+
+
+def canonical_body(body):
+    """Returns a stable JSON string for a request body given as str or dict."""
+    if isinstance(body, (bytes, bytearray)):
+        body = body.decode("utf-8")
+    if isinstance(body, str):
+        body = json.loads(body)
+    return json.dumps(body, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+
+
+def make_cache_key(model_id, body):
+    digest = hashlib.sha256()
+    digest.update(model_id.encode("utf-8"))
+    digest.update(b"\n")
+    digest.update(canonical_body(body).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def request_temperature(body):
+    if isinstance(body, (str, bytes, bytearray)):
+        body = json.loads(body)
+    if "temperature" in body:
+        return float(body["temperature"])
+    inference_config = body.get("inferenceConfig") or {}
+    if "temperature" in inference_config:
+        return float(inference_config["temperature"])
+    return None
+
+
+class BedrockCache:
+    """
+    On-disk cache of Bedrock responses keyed by model ID + hash of the canonical
+    request body. Deterministic (temperature 0) requests are always cached;
+    sampled requests are only cached in replay mode.
+    """
+
+    def __init__(self, path, max_age_seconds=None, max_bytes=None, replay=False):
+        self.path = path
+        self.max_age_seconds = max_age_seconds
+        self.max_bytes = max_bytes
+        self.replay = replay
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.evicted = 0
+        self._lock = threading.Lock()
+
+        parent = os.path.dirname(path)
+        if parent:
+            os.makedirs(parent, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY,"
+            " model_id TEXT NOT NULL,"
+            " response TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " last_access REAL NOT NULL)"
+        )
+        self._conn.commit()
+        self.evict()
+
+    def is_cacheable(self, body):
+        if self.replay:
+            return True
+        temperature = request_temperature(body)
+        return temperature is not None and temperature == 0.0
+
+    def get(self, model_id, body):
+        key = make_cache_key(model_id, body)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            now = time.time()
+            if row and self.max_age_seconds and now - row[1] > self.max_age_seconds:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._conn.commit()
+                self.evicted += 1
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, model_id, body, response_text):
+        key = make_cache_key(model_id, body)
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses"
+                " (key, model_id, response, size, created_at, last_access)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model_id, response_text, len(response_text.encode("utf-8")), now, now),
+            )
+            self._conn.commit()
+
+    def fetch(self, model_id, body, fn, cacheable=None):
+        """
+        Returns the cached response text, or calls fn() and caches its result.
+        cacheable overrides the temperature check (e.g. for agent responses).
+        """
+        if cacheable is None:
+            cacheable = self.is_cacheable(body)
+        if not cacheable:
+            with self._lock:
+                self.bypassed += 1
+            return fn()
+
+        cached = self.get(model_id, body)
+        if cached is not None:
+            return cached
+
+        response_text = fn()
+        if response_text is not None:
+            self.put(model_id, body, response_text)
+        return response_text
+
+    def evict(self):
+        """Drops entries older than max_age, then least recently used ones above max_bytes."""
+        with self._lock:
+            if self.max_age_seconds:
+                cursor = self._conn.execute(
+                    "DELETE FROM responses WHERE created_at < ?",
+                    (time.time() - self.max_age_seconds,),
+                )
+                self.evicted += cursor.rowcount
+
+            if self.max_bytes:
+                total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+                if total > self.max_bytes:
+                    rows = self._conn.execute(
+                        "SELECT key, size FROM responses ORDER BY last_access ASC"
+                    ).fetchall()
+                    to_delete = []
+                    for key, size in rows:
+                        if total <= self.max_bytes:
+                            break
+                        to_delete.append((key,))
+                        total -= size
+                    self._conn.executemany("DELETE FROM responses WHERE key = ?", to_delete)
+                    self.evicted += len(to_delete)
+            self._conn.commit()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "path": self.path,
+            "replay": self.replay,
+            "hits": self.hits,
+            "misses": self.misses,
+            "bypassed": self.bypassed,
+            "evicted": self.evicted,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+    def close(self):
+        self.evict()
+        with self._lock:
+            self._conn.close()
+
+
+def open_bedrock_cache(path=None):
+    """Builds the cache from config, or returns None when caching is disabled."""
+    if not config.BEDROCK_CACHE_ENABLED:
+        return None
+    return BedrockCache(
+        path or config.BEDROCK_CACHE_PATH,
+        max_age_seconds=config.BEDROCK_CACHE_MAX_AGE_DAYS * 86400,
+        max_bytes=config.BEDROCK_CACHE_MAX_MB * 1024 * 1024,
+        replay=config.BEDROCK_CACHE_REPLAY,
+    )
+
+
+def cached_call(cache, model_id, body, fn, cacheable=None):
+    if cache is None:
+        return fn()
+    return cache.fetch(model_id, body, fn, cacheable)
@@ -0,0 +1,168 @@
+import csv
+import hashlib
+import io
+import json
+import os
+from collections import Counter
+
+
+def read_csv_rows(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, "r", encoding="utf-8", newline="") as in_file:
+        return list(csv.DictReader(in_file))
+
+
+def write_csv_atomic(path, fieldnames, rows):
+    """Writes rows to a temporary sibling file and renames it over path."""
+    parent = os.path.dirname(path)
+    if parent:
+        os.makedirs(parent, exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8", newline="") as out_file:
+        writer = csv.DictWriter(
+            out_file, fieldnames=fieldnames, extrasaction="ignore", lineterminator="\n"
+        )
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+        out_file.flush()
+        os.fsync(out_file.fileno())
+    os.replace(tmp_path, path)
+
+
+def row_hash(row, fields):
+    """Stable hash of the given columns of a CSV row (whitespace-trimmed)."""
+    payload = json.dumps([str(row.get(field) or "").strip() for field in fields], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def keyed_rows(rows, fields):
+    """
+    Lazily yields (key, row) pairs. The key is the row hash plus an occurrence
+    number, so duplicated input rows still get distinct keys.
+    """
+    seen = Counter()
+    for row in rows:
+        digest = row_hash(row, fields)
+        seen[digest] += 1
+        yield f"{digest}:{seen[digest]}", row
+
+
+def load_filled_rows(final_path, key_fields, output_column):
+    """
+    Returns {row key: row} for rows of previous runs whose output_column is
+    non-empty (any of them, when a list of columns is given): the final file,
+    the resume stash of earlier interrupted runs and the partial file of the
+    last one.
+
+    The partial file is folded into "<final_path>.resume" so the new run can
+    reuse the partial path without losing rows if it is interrupted too; the
+    stash is removed by CheckpointWriter.finalize().
+    """
+    partial_path = final_path + ".partial"
+    stash_path = final_path + ".resume"
+    output_columns = [output_column] if isinstance(output_column, str) else list(output_column)
+    filled = {}
+    for path in (final_path, stash_path, partial_path):
+        for key, row in keyed_rows(read_csv_rows(path), key_fields):
+            if any(str(row.get(col) or "").strip() for col in output_columns):
+                filled[key] = row
+
+    if os.path.exists(partial_path):
+        fieldnames = []
+        for row in filled.values():
+            fieldnames.extend(col for col in row if col not in fieldnames)
+        write_csv_atomic(stash_path, fieldnames, filled.values())
+        os.remove(partial_path)
+    return filled
+
+
+class CheckpointWriter:
+    """
+    Appends CSV rows to "<final_path>.partial", flushing each row to disk, and
+    renames the partial file over final_path on finalize().
+
+    With resume=True an existing partial file (or, failing that, the existing
+    final file) is kept and exposed as existing_rows so callers can skip work
+    that is already done. base_rows, when given, replaces the existing final
+    file as the starting point (the partial file still takes precedence).
+    """
+
+    def __init__(self, final_path, fieldnames, resume=False, base_rows=None):
+        self.final_path = final_path
+        self.partial_path = final_path + ".partial"
+        self.fieldnames = list(fieldnames)
+        self.existing_rows = []
+        self.rows_written = 0
+
+        parent = os.path.dirname(final_path)
+        if parent:
+            os.makedirs(parent, exist_ok=True)
+
+        if resume and os.path.exists(self.partial_path):
+            # Keep appending to the partial file left by the interrupted run.
+            self.existing_rows = read_csv_rows(self.partial_path)
+            self._file = open(self.partial_path, "a", encoding="utf-8", newline="")
+            return
+
+        if base_rows is not None:
+            self.existing_rows = list(base_rows)
+        elif resume:
+            self.existing_rows = read_csv_rows(final_path)
+
+        self._file = open(self.partial_path, "w", encoding="utf-8", newline="")
+        writer = csv.DictWriter(
+            self._file, fieldnames=self.fieldnames, extrasaction="ignore", lineterminator="\n"
+        )
+        writer.writeheader()
+        writer.writerows(self.existing_rows)
+        self._sync()
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    @property
+    def total_rows(self):
+        return len(self.existing_rows) + self.rows_written
+
+    def write_row(self, row):
+        self.write_rows([row])
+
+    def write_rows(self, rows):
+        """
+        Appends rows with a single write and fsync, so a crash never leaves a
+        unit (e.g. one file's batched questions) half-written for resume to
+        mistake for done.
+        """
+        rows = list(rows)
+        if not rows:
+            return
+        buffer = io.StringIO()
+        writer = csv.DictWriter(
+            buffer, fieldnames=self.fieldnames, extrasaction="ignore", lineterminator="\n"
+        )
+        writer.writerows(rows)
+        self._file.write(buffer.getvalue())
+        self._sync()
+        self.rows_written += len(rows)
+
+    def finalize(self, sort_key=None):
+        """
+        Atomically publishes the partial file as final_path. When sort_key is
+        given the rows are re-ordered (stable) before publishing.
+        """
+        self._file.close()
+        if sort_key is not None:
+            rows = sorted(read_csv_rows(self.partial_path), key=sort_key)
+            write_csv_atomic(self.partial_path, self.fieldnames, rows)
+        os.replace(self.partial_path, self.final_path)
+        stash_path = self.final_path + ".resume"
+        if os.path.exists(stash_path):
+            os.remove(stash_path)
+
+    def discard(self):
+        self._file.close()
+        if os.path.exists(self.partial_path):
+            os.remove(self.partial_path)
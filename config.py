@@ -27,6 +27,9 @@ KB_ID = os.getenv("KB_ID", "J7JNHSZPJ3")
 # --- LLM CONFIG ---
 MODEL_ID = os.getenv("MODEL_ID", "openai.gpt-oss-120b-1:0")
 TEMPERATURE = float(os.getenv("TEMPERATURE", "0.7"))
+# Questions generated per KB document. Values above 1 request one question per
+# style in a single call (batched mode) instead of one call per question.
+QUESTIONS_PER_DOC = int(os.getenv("QUESTIONS_PER_DOC", "1"))
 
 # LLM PRICING PER 1K TOKENS
 INPUT_PRICE = float(os.getenv("INPUT_PRICE", "0.00015"))
@@ -35,12 +38,90 @@ OUTPUT_PRICE = float(os.getenv("OUTPUT_PRICE", "0.0006"))
 # --- RETRIEVAL / EVAL ---
 TOP_K = int(os.getenv("TOP_K", "2"))
 EVAL_K = int(os.getenv("EVAL_K", "2"))
+# K-sweep: 4_retriever.py fetches once at the largest K (ranked_* columns, with
+# scores) and 7_custom_evaluator.py reports hit/MRR/precision/recall at each K.
+EVAL_K_VALUES = sorted({int(k) for k in os.getenv("EVAL_K_VALUES", "1,2,5,10").split(",") if k.strip()})
+RETRIEVAL_MAX_K = max([TOP_K, EVAL_K] + EVAL_K_VALUES)
+OUTPUT_K_CURVES_CSV = os.getenv("OUTPUT_K_CURVES_CSV", "outputs/subset/k_curves.csv")
+# Raw KB retrieve results (text, URI, score, metadata), fetched once per query and
+# reused by every 4_retriever.py run; evalset columns are derived from this store.
+RETRIEVAL_STORE_PATH = os.getenv(
+    "RETRIEVAL_STORE_PATH",
+    os.path.join(os.path.dirname(OUTPUT_EVALSET_CSV), "kb_retrievals.sqlite")
+)
+# RETRIEVER_OFFLINE=1 only derives columns from the store (no KB calls);
+# RETRIEVER_REFRESH=1 refetches every query instead of reusing stored results.
+RETRIEVER_OFFLINE = os.getenv("RETRIEVER_OFFLINE", "0") == "1"
+RETRIEVER_REFRESH = os.getenv("RETRIEVER_REFRESH", "0") == "1"
+
+# --- LOCAL RETRIEVAL ---
+# 4_retriever.py backend: "kb" (Bedrock retrieve on KB_ID), or the offline index
+# built from KB_FOLDER by local_retriever.py: "bm25" or "dense" (Titan embeddings).
+RETRIEVER_BACKEND = os.getenv("RETRIEVER_BACKEND", "kb")
+LOCAL_INDEX_DIR = os.getenv("LOCAL_INDEX_DIR", ".cache/local_index")
+EMBEDDING_MODEL_ID = os.getenv("EMBEDDING_MODEL_ID", "amazon.titan-embed-text-v2:0")
+
+# --- EMBEDDING STORE ---
+# Titan vectors cached by content hash (embedding_store.py), one memmap per model + size.
+EMBEDDING_STORE_DIR = os.getenv("EMBEDDING_STORE_DIR", ".cache/embeddings")
+# Titan Text Embeddings V2 output size: 256, 512 or 1024.
+EMBEDDING_DIMENSIONS = int(os.getenv("EMBEDDING_DIMENSIONS", "1024"))
+# Texts embedded between index saves, and concurrent invoke_model calls per batch.
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+EMBEDDING_WORKERS = int(os.getenv("EMBEDDING_WORKERS", "4"))
+
+# --- CHUNKING ---
+# Split KB documents into token-budgeted chunks before question generation.
+# Defaults mirror the KB ingestion settings (200 tokens, 20% overlap).
+CHUNKING_ENABLED = os.getenv("CHUNKING_ENABLED", "0") == "1"
+CHUNK_SIZE_TOKENS = int(os.getenv("CHUNK_SIZE_TOKENS", "200"))
+CHUNK_OVERLAP_PCT = float(os.getenv("CHUNK_OVERLAP_PCT", "20"))
+TOKEN_COUNTS_CSV = os.getenv("TOKEN_COUNTS_CSV", "outputs/token_counts.csv")
 
 # --- REPRODUCIBILITY ---
 SEED = int(os.getenv("SEED", "42"))
 
+# --- BEDROCK RESPONSE CACHE ---
+BEDROCK_CACHE_ENABLED = os.getenv("BEDROCK_CACHE_ENABLED", "1") == "1"
+BEDROCK_CACHE_PATH = os.getenv("BEDROCK_CACHE_PATH", ".cache/bedrock_cache.sqlite")
+BEDROCK_CACHE_MAX_AGE_DAYS = float(os.getenv("BEDROCK_CACHE_MAX_AGE_DAYS", "30"))
+BEDROCK_CACHE_MAX_MB = float(os.getenv("BEDROCK_CACHE_MAX_MB", "512"))
+# Replay mode also caches non-zero temperature calls (reruns return the same sample).
+BEDROCK_CACHE_REPLAY = os.getenv("BEDROCK_CACHE_REPLAY", "0") == "1"
+
+# --- CHECKPOINTING ---
+# Resume from "<output>.partial" (or the existing output) instead of starting over.
+RESUME = os.getenv("RESUME", "0") == "1"
+
+# --- KB LOADER ---
+# Cached file index (path, BD code, size, mtime, sha256) shared by KB scans.
+KB_INDEX_PATH = os.getenv("KB_INDEX_PATH", ".cache/kb_index.json")
+KB_READ_WORKERS = int(os.getenv("KB_READ_WORKERS", "8"))
+
+# --- KB MANIFEST / INCREMENTAL GENERATION ---
+KB_MANIFEST_PATH = os.getenv(
+    "KB_MANIFEST_PATH",
+    os.path.join(os.path.dirname(OUTPUT_TESTSET_CSV), "kb_manifest.json")
+)
+# Only regenerate questions for new or changed KB files (also: --incremental).
+INCREMENTAL = os.getenv("INCREMENTAL", "0") == "1"
+
+# --- CONCURRENCY ---
+# Number of files processed in parallel by 1_generate_user_inputs.py (1 = serial).
+GENERATION_WORKERS = int(os.getenv("GENERATION_WORKERS", "1"))
+# Concurrent retrieve calls in 4_retriever.py (1 = serial).
+RETRIEVER_WORKERS = int(os.getenv("RETRIEVER_WORKERS", "1"))
+
 # --- RETRIES ---
 MAX_RETRIES = int(os.getenv("MAX_RETRIES", "3"))
 BACKOFF_BASE_SECONDS = float(os.getenv("BACKOFF_BASE_SECONDS", "1.0"))
 BACKOFF_MAX_SECONDS = float(os.getenv("BACKOFF_MAX_SECONDS", "8.0"))
 BACKOFF_JITTER_SECONDS = float(os.getenv("BACKOFF_JITTER_SECONDS", "0.3"))
+
+# --- ADAPTIVE CONCURRENCY (AIMD on throttling) ---
+ADAPTIVE_INITIAL_CONCURRENCY = float(os.getenv("ADAPTIVE_INITIAL_CONCURRENCY", "4"))
+ADAPTIVE_MIN_CONCURRENCY = float(os.getenv("ADAPTIVE_MIN_CONCURRENCY", "1"))
+ADAPTIVE_MAX_CONCURRENCY = float(os.getenv("ADAPTIVE_MAX_CONCURRENCY", "32"))
+ADAPTIVE_INCREASE_STEP = float(os.getenv("ADAPTIVE_INCREASE_STEP", "1.0"))
+ADAPTIVE_DECREASE_FACTOR = float(os.getenv("ADAPTIVE_DECREASE_FACTOR", "0.5"))
+ADAPTIVE_DECREASE_COOLDOWN_SECONDS = float(os.getenv("ADAPTIVE_DECREASE_COOLDOWN_SECONDS", "1.0"))
@@ -0,0 +1,97 @@
+import hashlib
+import json
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+
+WHITESPACE_RE = re.compile(r"\s+")
+DEFAULT_MAX_RESULTS = 4096
+
+
+def normalize_text(value):
+    """NFC form with trimmed, collapsed whitespace, so trivially different copies match."""
+    text = unicodedata.normalize("NFC", str(value or ""))
+    return WHITESPACE_RE.sub(" ", text).strip()
+
+
+def request_key(*parts):
+    """Hash of the normalized request inputs; list parts are normalized item by item."""
+    normalized = []
+    for part in parts:
+        if isinstance(part, (list, tuple)):
+            normalized.append([normalize_text(item) for item in part])
+        else:
+            normalized.append(normalize_text(part))
+    payload = json.dumps(normalized, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class SingleFlight:
+    """
+    In-run request deduplication. The first caller for a key runs fn(); callers
+    with the same key wait for it (if it is still running) and share its result.
+    Results rejected by is_ok (e.g. an empty output after an error) are not
+    kept, so a later duplicate row tries again.
+
+    Kept results are bounded by an LRU of max_results entries, so memory stays
+    flat on large inputs; a duplicate arriving after its result was evicted
+    simply makes the call again.
+    """
+
+    def __init__(self, is_ok=bool, max_results=DEFAULT_MAX_RESULTS):
+        self.is_ok = is_ok
+        self.max_results = max(1, int(max_results or DEFAULT_MAX_RESULTS))
+        self.calls = 0
+        self.saved_calls = 0
+        self.stored = 0
+        self.evicted = 0
+        self._results = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        """Returns (result, shared); shared is True when no call was made for this caller."""
+        with self._lock:
+            if key in self._results:
+                self._results.move_to_end(key)
+                self.saved_calls += 1
+                return self._results[key], True
+            event = self._pending.get(key)
+            leader = event is None
+            if leader:
+                event = self._pending[key] = threading.Event()
+                self.calls += 1
+
+        if not leader:
+            event.wait()
+            with self._lock:
+                if key in self._results:
+                    self.saved_calls += 1
+                    return self._results[key], True
+            # The leader failed: make the call for this row instead.
+            return self.do(key, fn)
+
+        try:
+            result = fn()
+            if self.is_ok(result):
+                with self._lock:
+                    self._results[key] = result
+                    self.stored += 1
+                    while len(self._results) > self.max_results:
+                        self._results.popitem(last=False)
+                        self.evicted += 1
+            return result, False
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+            event.set()
+
+    def stats(self):
+        return {
+            "stored_results": self.stored,
+            "calls": self.calls,
+            "saved_calls": self.saved_calls,
+            "kept_results": len(self._results),
+            "evicted": self.evicted,
+        }
@@ -0,0 +1,81 @@
+import argparse
+import ast
+import json
+import time
+
+import pandas as pd
+
+import config
+from embedding_store import EmbeddingStore, titan_embedder
+from local_retriever import load_corpus
+
+
+def parse_list(value):
+    if isinstance(value, list):
+        return value
+    if not isinstance(value, str) or not value.strip():
+        return []
+    try:
+        parsed = ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        return [value]
+    return parsed if isinstance(parsed, list) else [parsed]
+
+
+def read_questions(path):
+    df = pd.read_csv(path)
+    return [text for text in df["user_input"].dropna().astype(str) if text.strip()]
+
+
+def read_contexts(path):
+    """Every retrieved context of the evalset, preferring the full ranked list when present."""
+    df = pd.read_csv(path)
+    column = "ranked_contexts" if "ranked_contexts" in df.columns else "retrieved_contexts"
+    return [text for value in df[column] for text in parse_list(value) if str(text).strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Fill the embedding store with KB chunks, testset questions and retrieved contexts."
+    )
+    parser.add_argument("--kb", action="store_true", help="Embed the retrieval units of --root")
+    parser.add_argument("--root", default=config.KB_FOLDER)
+    parser.add_argument("--questions", nargs="?", const=config.OUTPUT_TESTSET_CSV, help="CSV with a user_input column")
+    parser.add_argument("--contexts", nargs="?", const=config.OUTPUT_EVALSET_CSV, help="Evalset CSV with retrieved contexts")
+    parser.add_argument("--batch-size", type=int, default=config.EMBEDDING_BATCH_SIZE)
+    args = parser.parse_args()
+
+    sources = []
+    if args.kb:
+        docs, _ = load_corpus(args.root)
+        sources.append(("kb_chunk", [doc["text"] for doc in docs]))
+    if args.questions:
+        sources.append(("question", read_questions(args.questions)))
+    if args.contexts:
+        sources.append(("context", read_contexts(args.contexts)))
+    if not sources:
+        parser.error("nothing to embed: pass --kb, --questions and/or --contexts")
+
+    store = EmbeddingStore()
+    error_log = []
+    embed = titan_embedder(error_log=error_log)
+    for kind, texts in sources:
+        started = time.monotonic()
+        before = store.embedded
+        try:
+            store.ensure(texts, embed, kind, args.batch_size)
+        except RuntimeError as e:
+            print(f"Stopped embedding {kind}: {e}")
+            break
+        print(
+            f"{kind}: {len(texts)} texts, {store.embedded - before} embedded "
+            f"in {time.monotonic() - started:.1f}s"
+        )
+
+    print(json.dumps(store.stats(), indent=2))
+    if error_log:
+        print(f"{len(error_log)} embedding errors; last: {error_log[-1]['error']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+import hashlib
+import json
+import os
+import re
+import threading
+
+import boto3
+import numpy as np
+
+import config
+from dedup import normalize_text
+from parallel import ordered_map
+from throttling import AdaptiveConcurrencyController
+
+KINDS = ("kb_chunk", "question", "context")
+INITIAL_CAPACITY = 1024
+VECTORS_FILE = "vectors.f32"
+INDEX_FILE = "index.json"
+
+# Shared AIMD limiter + retry policy for every embedding call.
+RETRY_CONTROLLER = AdaptiveConcurrencyController()
+
+
+def content_key(text):
+    """Hash of the normalized text; the model and size are fixed per store directory."""
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+
+
+def store_path(root=None, model_id=None, dimensions=None):
+    model_id = model_id or config.EMBEDDING_MODEL_ID
+    dimensions = dimensions or config.EMBEDDING_DIMENSIONS
+    slug = re.sub(r"[^A-Za-z0-9]+", "-", model_id).strip("-").lower()
+    return os.path.join(root or config.EMBEDDING_STORE_DIR, f"{slug}-{dimensions}")
+
+
+def titan_embedder(client=None, model_id=None, dimensions=None, workers=None, error_log=None):
+    """
+    Returns embed(texts) -> float32 array using Titan Text Embeddings on Bedrock.
+    Titan embeds one text per invoke_model call, so a batch runs as up to
+    `workers` concurrent calls with the shared retry policy; a text that still
+    fails raises RuntimeError so nothing partial is stored for it.
+    """
+    model_id = model_id or config.EMBEDDING_MODEL_ID
+    dimensions = dimensions or config.EMBEDDING_DIMENSIONS
+    workers = workers or config.EMBEDDING_WORKERS
+    error_log = [] if error_log is None else error_log
+    if client is None:
+        session = boto3.Session(profile_name=config.AWS_PROFILE_LLM)
+        client = session.client(service_name="bedrock-runtime", region_name=config.AWS_REGION)
+
+    def _embed_one(text):
+        def _call():
+            response = client.invoke_model(
+                modelId=model_id,
+                body=json.dumps({"inputText": text, "dimensions": dimensions, "normalize": True}),
+            )
+            return json.loads(response["body"].read())["embedding"]
+
+        return RETRY_CONTROLLER.call(_call, "invoke_model (embedding)", error_log)
+
+    def embed(texts):
+        vectors = []
+        for text, vector in ordered_map(_embed_one, list(texts), workers):
+            if vector is None:
+                raise RuntimeError(f"Embedding failed after retries: {str(text)[:60]}...")
+            vectors.append(vector)
+        return np.asarray(vectors, dtype=np.float32).reshape(len(vectors), dimensions)
+
+    return embed
+
+
+class EmbeddingStore:
+    """
+    Append-only embedding cache: a float32 memory-mapped matrix (vectors.f32)
+    plus a content-hash -> row index (index.json). Rows are only ever added, so
+    a row number stays valid for the life of the store and readers can slice
+    the memmap without copying.
+
+    The matrix grows by doubling its capacity; index.json records how many rows
+    are valid and is rewritten atomically after every batch, so an interrupted
+    fill keeps every completed batch.
+    """
+
+    def __init__(self, path=None, dimensions=None, model_id=None):
+        self.path = path or store_path(model_id=model_id, dimensions=dimensions)
+        self.dimensions = dimensions or config.EMBEDDING_DIMENSIONS
+        self.model_id = model_id or config.EMBEDDING_MODEL_ID
+        self.keys = []
+        self.kinds = []
+        self.rows = {}
+        self.embedded = 0
+        self.reused = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+
+        index_path = os.path.join(self.path, INDEX_FILE)
+        if os.path.exists(index_path):
+            with open(index_path, "r", encoding="utf-8") as f:
+                index = json.load(f)
+            if index["dimensions"] != self.dimensions or index["model_id"] != self.model_id:
+                raise ValueError(
+                    f"{self.path} holds {index['model_id']} vectors of size {index['dimensions']}, "
+                    f"not {self.model_id} of size {self.dimensions}"
+                )
+            self.keys = index["keys"]
+            self.kinds = index["kinds"]
+            self.rows = {key: row for row, key in enumerate(self.keys)}
+        self._matrix = self._open(max(INITIAL_CAPACITY, len(self.keys)))
+
+    def _open(self, capacity):
+        vectors_path = os.path.join(self.path, VECTORS_FILE)
+        size = capacity * self.dimensions * 4
+        with open(vectors_path, "ab") as f:
+            if f.tell() < size:
+                f.truncate(size)
+        capacity = os.path.getsize(vectors_path) // (self.dimensions * 4)
+        return np.memmap(vectors_path, dtype=np.float32, mode="r+", shape=(capacity, self.dimensions))
+
+    def _save_index(self):
+        index_path = os.path.join(self.path, INDEX_FILE)
+        tmp_path = index_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({
+                "model_id": self.model_id,
+                "dimensions": self.dimensions,
+                "keys": self.keys,
+                "kinds": self.kinds,
+            }, f)
+        os.replace(tmp_path, index_path)
+
+    def _append(self, keys, kind, vectors):
+        start = len(self.keys)
+        end = start + len(keys)
+        if end > self._matrix.shape[0]:
+            self._matrix.flush()
+            capacity = self._matrix.shape[0]
+            while capacity < end:
+                capacity *= 2
+            self._matrix = self._open(capacity)
+        self._matrix[start:end] = vectors
+        self._matrix.flush()
+        for offset, key in enumerate(keys):
+            self.rows[key] = start + offset
+        self.keys.extend(keys)
+        self.kinds.extend([kind] * len(keys))
+        self._save_index()
+
+    def __len__(self):
+        return len(self.keys)
+
+    @property
+    def vectors(self):
+        """Read-only zero-copy view of every stored row (rows x dimensions)."""
+        view = self._matrix[:len(self.keys)]
+        view.flags.writeable = False
+        return view
+
+    def lookup(self, texts):
+        """Row of each text in the store, -1 for texts not embedded yet."""
+        return np.asarray([self.rows.get(content_key(text), -1) for text in texts], dtype=np.int64)
+
+    def rows_of_kind(self, kind):
+        return np.asarray([row for row, row_kind in enumerate(self.kinds) if row_kind == kind], dtype=np.int64)
+
+    def ensure(self, texts, embed, kind, batch_size=None):
+        """
+        Embeds the texts the store has not seen (by normalized content), batch
+        by batch, and returns the row of every text in input order.
+        """
+        if kind not in KINDS:
+            raise ValueError(f"Unknown embedding kind: {kind}")
+        batch_size = max(1, batch_size or config.EMBEDDING_BATCH_SIZE)
+        texts = [str(text or "") for text in texts]
+        keys = [content_key(text) for text in texts]
+
+        with self._lock:
+            missing = {}
+            for key, text in zip(keys, texts):
+                if key not in self.rows and key not in missing:
+                    missing[key] = text
+            self.reused += len(texts) - len(missing)
+            pending = list(missing.items())
+            for start in range(0, len(pending), batch_size):
+                batch = pending[start:start + batch_size]
+                vectors = embed([text for _, text in batch])
+                self._append([key for key, _ in batch], kind, vectors)
+                self.embedded += len(batch)
+            return np.asarray([self.rows[key] for key in keys], dtype=np.int64)
+
+    def get(self, texts, embed=None, kind="question"):
+        """
+        Vectors for texts, embedding the unseen ones first when embed is given.
+        A gather of scattered rows is a copy; use ensure() + vectors for views.
+        """
+        rows = self.ensure(texts, embed, kind) if embed is not None else self.lookup(texts)
+        if (rows < 0).any():
+            raise KeyError(f"{int((rows < 0).sum())} texts are not in the embedding store")
+        return self.vectors[rows]
+
+    def embedder(self, embed, kind, batch_size=None):
+        """Wraps embed(texts) so repeated texts are served from the store."""
+        def cached_embed(texts):
+            rows = self.ensure(texts, embed, kind, batch_size)
+            return self.vectors[rows]
+
+        return cached_embed
+
+    def stats(self):
+        return {
+            "path": self.path,
+            "rows": len(self.keys),
+            "capacity": int(self._matrix.shape[0]),
+            "by_kind": {kind: self.kinds.count(kind) for kind in KINDS},
+            "embedded": self.embedded,
+            "reused": self.reused,
+        }
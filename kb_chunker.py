@@ -0,0 +1,202 @@
+import csv
+import os
+import re
+import unicodedata
+
+# Fallback when no calibration data is available (Titan tokens on Spanish text).
+DEFAULT_CHARS_PER_TOKEN = 4.0
+
+HEADING_RE = re.compile(r'^(#{1,6})\s+(.*\S)\s*$')
+SENTENCE_SPLIT_RE = re.compile(r'(?<=[.!?;:])\s+')
+
+
+def normalize_file_key(path):
+    """Basename in NFC form, so NFD file names on disk match the token CSV."""
+    return unicodedata.normalize("NFC", os.path.basename(path))
+
+
+def load_token_counts(path):
+    """Reads outputs/token_counts.csv into {file basename: token_count}."""
+    counts = {}
+    if not path or not os.path.exists(path):
+        return counts
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        for row in csv.DictReader(f):
+            try:
+                counts[normalize_file_key(row["file_name"])] = int(row["token_count"])
+            except (KeyError, TypeError, ValueError):
+                continue
+    return counts
+
+
+class TokenEstimator:
+    """
+    Estimates Titan token counts from character length. The chars-per-token
+    ratio is calibrated from measured counts when the measured files are
+    available, and a file with a measured count uses its own ratio.
+    """
+
+    def __init__(self, token_counts=None, chars_per_token=DEFAULT_CHARS_PER_TOKEN):
+        self.token_counts = token_counts or {}
+        self.chars_per_token = chars_per_token
+
+    def calibrate(self, texts_by_key):
+        total_chars = 0
+        total_tokens = 0
+        for key, text in texts_by_key.items():
+            tokens = self.token_counts.get(key)
+            if tokens:
+                total_chars += len(text)
+                total_tokens += tokens
+        if total_tokens:
+            self.chars_per_token = total_chars / total_tokens
+        return self.chars_per_token
+
+    def ratio_for(self, key=None, text=None):
+        tokens = self.token_counts.get(key) if key else None
+        if tokens and text:
+            return max(len(text) / tokens, 1.0)
+        return self.chars_per_token
+
+    def count(self, text, ratio=None):
+        if not text:
+            return 0
+        return max(1, round(len(text) / (ratio or self.chars_per_token)))
+
+
+def iter_blocks(lines):
+    """
+    Streams (heading_path, heading_text, paragraph_text) triples from markdown
+    lines. Heading lines are attached to the paragraph that follows them.
+    """
+    heading_path = []
+    pending_headings = []
+    paragraph = []
+
+    for raw_line in lines:
+        line = raw_line.rstrip("\n").rstrip("\r")
+        heading = HEADING_RE.match(line)
+        if heading or not line.strip():
+            if paragraph:
+                yield list(heading_path), "\n".join(pending_headings), "\n".join(paragraph)
+                pending_headings.clear()
+                paragraph.clear()
+            if heading:
+                level = len(heading.group(1))
+                heading_path[:] = heading_path[:level - 1] + [heading.group(2)]
+                pending_headings.append(line)
+            continue
+        paragraph.append(line)
+
+    if paragraph or pending_headings:
+        yield list(heading_path), "\n".join(pending_headings), "\n".join(paragraph)
+
+
+def split_units(text, max_tokens, count):
+    """Splits a paragraph into sentences, and sentences above max_tokens into word runs."""
+    units = []
+    for sentence in SENTENCE_SPLIT_RE.split(text.strip()):
+        if not sentence:
+            continue
+        if count(sentence) <= max_tokens:
+            units.append(sentence)
+            continue
+        current = ""
+        for word in sentence.split():
+            candidate = f"{current} {word}".strip()
+            if current and count(candidate) > max_tokens:
+                units.append(current)
+                current = word
+            else:
+                current = candidate
+        if current:
+            units.append(current)
+    return units
+
+
+def iter_units(lines, max_unit_tokens, count):
+    """
+    Streams (heading_path, separator, text, is_heading) units. The separator
+    is what joins the unit to the previous one inside a chunk.
+    """
+    for heading_path, heading_text, paragraph in iter_blocks(lines):
+        separator = "\n\n"
+        if heading_text:
+            yield heading_path, separator, heading_text, True
+            separator = "\n"
+        for unit in split_units(paragraph, max_unit_tokens, count):
+            yield heading_path, separator, unit, False
+            separator = " "
+
+
+def chunk_markdown(lines, chunk_tokens, overlap_tokens, count):
+    """
+    Streams chunks of about chunk_tokens (as measured by count) built from
+    whole sentences, never ending a chunk on a bare heading. Only sentences
+    longer than a whole chunk are split into word runs. Consecutive chunks
+    share the whole trailing sentences that fit in overlap_tokens (none when
+    the last sentence is longer). Yields dicts with text, heading and
+    token_estimate.
+    """
+    window = []  # (heading_path, separator, text, is_heading, tokens)
+
+    def window_tokens(items):
+        return sum(item[4] for item in items)
+
+    def emit(items):
+        text = items[0][2] + "".join(item[1] + item[2] for item in items[1:])
+        heading = " > ".join(items[0][0]) if items[0][0] else ""
+        return {"text": text, "heading": heading, "token_estimate": window_tokens(items)}
+
+    for heading_path, separator, text, is_heading in iter_units(lines, chunk_tokens, count):
+        unit = (heading_path, separator, text, is_heading, count(text))
+        if window and window_tokens(window) + unit[4] > chunk_tokens:
+            # Headings at the end of the window move on with the next chunk.
+            held = []
+            while window and window[-1][3]:
+                held.insert(0, window.pop())
+            if window:
+                yield emit(window)
+                carried = []
+                for item in reversed(window):
+                    if item[3] or window_tokens(carried) + item[4] > overlap_tokens:
+                        break
+                    carried.insert(0, item)
+                window = carried + held
+                if window_tokens(window) + unit[4] > chunk_tokens:
+                    window = held
+            else:
+                window = held
+        window.append(unit)
+
+    if window:
+        yield emit(window)
+
+
+def make_chunk_id(source_code, index):
+    return f"{source_code}#{index:03d}"
+
+
+def chunk_document(text, file_key, source_code, estimator, chunk_tokens, overlap_tokens, min_chars=30):
+    """
+    Streams the chunks of one KB document with stable chunk IDs. A document
+    whose measured (or estimated) size fits in one chunk is returned whole.
+    """
+    ratio = estimator.ratio_for(file_key, text)
+    if estimator.count(text, ratio) <= chunk_tokens:
+        chunks = [{"text": text, "heading": "", "token_estimate": estimator.count(text, ratio)}]
+    else:
+        chunks = chunk_markdown(
+            text.splitlines(),
+            chunk_tokens,
+            overlap_tokens,
+            lambda value: estimator.count(value, ratio),
+        )
+
+    index = 0
+    for chunk in chunks:
+        if len(chunk["text"].strip()) < min_chars:
+            continue
+        chunk["chunk_id"] = make_chunk_id(source_code, index)
+        index += 1
+        yield chunk
@@ -0,0 +1,136 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+
+
+def extract_bd_code(filename):
+    if not filename:
+        return ""
+    return filename[:9]
+
+
+def kb_relpath(path, root):
+    """Path relative to the KB root, always with forward slashes."""
+    return os.path.relpath(path, root).replace(os.sep, "/")
+
+
+def decode_text(data):
+    """
+    Returns (text, encoding_used). Falls back to latin-1 if utf-8 fails.
+    """
+    try:
+        return data.decode("utf-8"), "utf-8"
+    except UnicodeDecodeError:
+        return data.decode("latin-1"), "latin-1"
+
+
+def read_text(path):
+    with open(path, "rb") as f:
+        return decode_text(f.read())
+
+
+def iter_md_paths(root):
+    """Walks root with os.scandir and yields (path, stat) for every .md file."""
+    stack = [root]
+    while stack:
+        current = stack.pop()
+        try:
+            with os.scandir(current) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file() and entry.name.lower().endswith(".md"):
+                        yield entry.path, entry.stat()
+        except FileNotFoundError:
+            continue
+
+
+def load_index(path):
+    if not path or not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f).get("files", {})
+    except (OSError, ValueError):
+        return {}
+
+
+def save_index(path, entries):
+    parent = os.path.dirname(path)
+    if parent:
+        os.makedirs(parent, exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"files": entries}, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def _sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def scan_kb(root, index_path=None, workers=None):
+    """
+    Lists the KB's .md files (sorted by path) as dicts with path, rel_path,
+    bd_code, size, mtime and sha256. Hashes are reused from the persisted
+    index when size and mtime are unchanged; only new or modified files are
+    hashed, on a thread pool.
+    """
+    index_path = config.KB_INDEX_PATH if index_path is None else index_path
+    workers = workers or config.KB_READ_WORKERS
+    index = load_index(index_path)
+
+    entries = []
+    stale = []
+    for path, stat in sorted(iter_md_paths(root)):
+        cached = index.get(path)
+        entry = {
+            "path": path,
+            "rel_path": kb_relpath(path, root),
+            "bd_code": extract_bd_code(os.path.basename(path)),
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "mtime_ns": stat.st_mtime_ns,
+            "sha256": None,
+        }
+        if cached and cached.get("size") == entry["size"] and cached.get("mtime_ns") == entry["mtime_ns"]:
+            entry["sha256"] = cached.get("sha256")
+        if not entry["sha256"]:
+            stale.append(entry)
+        entries.append(entry)
+
+    if stale:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for entry, digest in zip(stale, executor.map(lambda e: _sha256_file(e["path"]), stale)):
+                entry["sha256"] = digest
+
+    if index_path and (stale or len(index) != len(entries)):
+        # Entries for other KB roots are kept so switching KB_FOLDER stays cheap.
+        index = {path: data for path, data in index.items() if not path.startswith(root)}
+        index.update({entry["path"]: entry for entry in entries})
+        save_index(index_path, index)
+
+    return entries
+
+
+def read_kb_texts(entries, workers=None):
+    """Reads the entries' files on a thread pool; returns [(entry, text, encoding)] in input order."""
+    workers = workers or config.KB_READ_WORKERS
+
+    def _read(entry):
+        try:
+            text, encoding = read_text(entry["path"])
+            return entry, text, encoding
+        except OSError as e:
+            print(f"Error reading file {entry['path']}: {e}")
+            return entry, None, None
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return [result for result in executor.map(_read, entries) if result[1] is not None]
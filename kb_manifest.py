@@ -0,0 +1,63 @@
+import json
+import os
+from datetime import datetime
+
+
+def build_manifest(kb_entries, root):
+    """Builds a manifest from kb_loader.scan_kb entries (hashes come from its index)."""
+    entries = {}
+    for entry in kb_entries:
+        entries[entry["rel_path"]] = {
+            "sha256": entry["sha256"],
+            "size": entry["size"],
+            "mtime": entry["mtime"],
+        }
+    return {
+        "root": root,
+        "created_at": datetime.utcnow().isoformat() + "Z",
+        "files": entries,
+    }
+
+
+def load_manifest(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_manifest(path, manifest):
+    parent = os.path.dirname(path)
+    if parent:
+        os.makedirs(parent, exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+def diff_manifests(old_manifest, new_manifest):
+    """
+    Compares two manifests by content hash. Returns a dict of sorted relative
+    paths: added, changed, deleted and unchanged.
+    """
+    old_files = (old_manifest or {}).get("files", {})
+    new_files = new_manifest.get("files", {})
+
+    added, changed, unchanged = [], [], []
+    for rel_path, entry in new_files.items():
+        previous = old_files.get(rel_path)
+        if previous is None:
+            added.append(rel_path)
+        elif previous.get("sha256") != entry.get("sha256"):
+            changed.append(rel_path)
+        else:
+            unchanged.append(rel_path)
+    deleted = [rel_path for rel_path in old_files if rel_path not in new_files]
+
+    return {
+        "added": sorted(added),
+        "changed": sorted(changed),
+        "deleted": sorted(deleted),
+        "unchanged": sorted(unchanged),
+    }
@@ -0,0 +1,18 @@
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers; None when empty."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def numeric_values(rows, column):
+    """Values of column that are numbers (empty cells of skipped rows are left out)."""
+    return [row[column] for row in rows if isinstance(row.get(column), (int, float))]
+
+
+def summarize_values(values, percentiles=(50, 95)):
+    summary = {f"p{pct}": percentile(values, pct) for pct in percentiles}
+    summary["count"] = len(values)
+    return summary
@@ -0,0 +1,324 @@
+import argparse
+import csv
+import json
+import math
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import boto3
+
+import config
+from latency_stats import summarize_values
+from loadtest.stub_agent import LATENCY_DISTRIBUTIONS, StubAgentClient
+from throttling import FATAL, THROTTLE, classify_error
+
+# Run from the repo root: python -m loadtest.agent_loadtest --profile "1-10:60,10:120"
+INPUT_CSV_PATH = os.getenv("LOADTEST_INPUT_CSV_PATH", "outputs/subset/testset.csv")
+OUTPUT_DIR = os.getenv("LOADTEST_OUTPUT_DIR", "outputs/loadtest")
+AWS_REGION = os.getenv("LOADTEST_AWS_REGION", config.AWS_REGION)
+AWS_PROFILE_SANDBOX = os.getenv("LOADTEST_AWS_PROFILE", config.AWS_PROFILE_SANDBOX)
+AGENT_ID = os.getenv("LOADTEST_AGENT_ID", os.getenv("ACTUAL_OUTPUT_AGENT_ID", "UKQEMRZQUS"))
+AGENT_ALIAS_ID = os.getenv("LOADTEST_AGENT_ALIAS_ID", os.getenv("ACTUAL_OUTPUT_AGENT_ALIAS_ID", "JPSUY1DN1P"))
+PERCENTILES = (50, 90, 95, 99)
+OUTCOME_OK = "ok"
+
+REQUEST_COLUMNS = [
+    "seq",
+    "session_id",
+    "scheduled_s",
+    "started_s",
+    "finished_s",
+    "queue_ms",
+    "first_chunk_ms",
+    "service_ms",
+    "latency_ms",
+    "chunk_count",
+    "outcome",
+    "error",
+]
+
+
+def ensure_parent_dir(path):
+    parent = os.path.dirname(path)
+    if parent:
+        os.makedirs(parent, exist_ok=True)
+
+
+def get_agent_client():
+    session = boto3.Session(profile_name=AWS_PROFILE_SANDBOX)
+    return session.client(service_name="bedrock-agent-runtime", region_name=AWS_REGION)
+
+
+def parse_profile(profile):
+    """
+    Parses "rate[:seconds]" segments separated by commas into
+    [(start_rate, end_rate, seconds)]. "a-b:s" ramps linearly from a to b
+    requests/second over s seconds; "a:s" holds a constant rate.
+    """
+    segments = []
+    for part in profile.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        rates, _, seconds = part.partition(":")
+        start, _, end = rates.partition("-")
+        start_rate = float(start)
+        end_rate = float(end) if end else start_rate
+        duration = float(seconds) if seconds else 60.0
+        if start_rate < 0 or end_rate < 0 or duration <= 0:
+            raise ValueError(f"Invalid load profile segment: {part}")
+        segments.append((start_rate, end_rate, duration))
+    if not segments:
+        raise ValueError("Empty load profile")
+    return segments
+
+
+def _segment_time(start_rate, end_rate, duration, target):
+    """Time t in the segment where the cumulative arrivals r0*t + (r1-r0)*t^2/(2*T) reach target."""
+    slope = (end_rate - start_rate) / duration
+    if abs(slope) < 1e-12:
+        return target / start_rate if start_rate else math.inf
+    # slope/2 * t^2 + r0 * t - target = 0
+    disc = start_rate * start_rate + 2 * slope * target
+    if disc < 0:
+        return math.inf
+    return (-start_rate + math.sqrt(disc)) / slope
+
+
+def arrival_times(segments, arrival="poisson", seed=None):
+    """
+    Open-loop schedule: offsets (seconds from start) of every request. Uniform
+    arrivals are evenly spaced in cumulative rate; Poisson arrivals use unit
+    exponential gaps in cumulative rate (an inhomogeneous Poisson process).
+    """
+    rng = random.Random(seed)
+
+    def _gap():
+        return rng.expovariate(1.0) if arrival == "poisson" else 1.0
+
+    times = []
+    offset = 0.0
+    next_at = _gap()  # cumulative expected arrivals, from the segment start, of the next request
+    for start_rate, end_rate, duration in segments:
+        expected = (start_rate + end_rate) / 2 * duration
+        while next_at <= expected:
+            times.append(offset + min(duration, _segment_time(start_rate, end_rate, duration, next_at)))
+            next_at += _gap()
+        next_at -= expected
+        offset += duration
+    return times
+
+
+def load_inputs(path):
+    with open(path, "r", encoding="utf-8", newline="") as in_file:
+        inputs = [(row.get("user_input") or "").strip() for row in csv.DictReader(in_file)]
+    return [text for text in inputs if text]
+
+
+def run_request(client, seq, session_id, user_input, scheduled_at, run_started):
+    """One open-loop request: no retries, so throttles and errors show up in the results."""
+    started_at = time.monotonic()
+    record = {
+        "seq": seq,
+        "session_id": session_id,
+        "scheduled_s": round(scheduled_at - run_started, 4),
+        "started_s": round(started_at - run_started, 4),
+        "queue_ms": round((started_at - scheduled_at) * 1000),
+        "first_chunk_ms": "",
+        "chunk_count": 0,
+        "outcome": OUTCOME_OK,
+        "error": "",
+    }
+    try:
+        response = client.invoke_agent(
+            agentId=AGENT_ID,
+            agentAliasId=AGENT_ALIAS_ID,
+            sessionId=session_id,
+            inputText=user_input,
+        )
+        for event in response.get("completion") or []:
+            if isinstance(event, dict) and "chunk" in event:
+                if record["chunk_count"] == 0:
+                    record["first_chunk_ms"] = round((time.monotonic() - started_at) * 1000)
+                record["chunk_count"] += 1
+    except Exception as e:
+        record["outcome"] = classify_error(e)
+        record["error"] = str(e)[:300]
+
+    finished_at = time.monotonic()
+    record["finished_s"] = round(finished_at - run_started, 4)
+    record["service_ms"] = round((finished_at - started_at) * 1000)
+    # Measured from the scheduled arrival, so client-side queueing is included.
+    record["latency_ms"] = round((finished_at - scheduled_at) * 1000)
+    return record
+
+
+def run_load(client, inputs, schedule, max_concurrency, run_id):
+    """
+    Dispatches every scheduled request at its arrival time, whether or not
+    earlier requests have finished (open loop). Returns the per-request records.
+    """
+    records = []
+    lock = threading.Lock()
+    run_started = time.monotonic()
+
+    def _run(seq, scheduled_at):
+        record = run_request(
+            client, seq, f"loadtest-{run_id}-{seq}", inputs[seq % len(inputs)], scheduled_at, run_started
+        )
+        with lock:
+            records.append(record)
+
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        for seq, offset in enumerate(schedule):
+            scheduled_at = run_started + offset
+            delay = scheduled_at - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(_run, seq, scheduled_at)
+
+    return sorted(records, key=lambda record: record["seq"])
+
+
+def throughput_over_time(records, bucket_seconds):
+    """Per time bucket: offered rate (by scheduled arrival), completions by outcome and latency (by finish time)."""
+    if not records:
+        return []
+    last = max(record["finished_s"] for record in records)
+    buckets = []
+    for index in range(int(last // bucket_seconds) + 1):
+        start, end = index * bucket_seconds, (index + 1) * bucket_seconds
+        offered = [r for r in records if start <= r["scheduled_s"] < end]
+        completed = [r for r in records if start <= r["finished_s"] < end]
+        ok_latency = [r["latency_ms"] for r in completed if r["outcome"] == OUTCOME_OK]
+        buckets.append({
+            "start_s": start,
+            "offered_rps": round(len(offered) / bucket_seconds, 3),
+            "completed_rps": round(len(completed) / bucket_seconds, 3),
+            "ok": sum(1 for r in completed if r["outcome"] == OUTCOME_OK),
+            "throttles": sum(1 for r in completed if r["outcome"] == THROTTLE),
+            "errors": sum(1 for r in completed if r["outcome"] not in (OUTCOME_OK, THROTTLE)),
+            "latency_ms": summarize_values(ok_latency),
+        })
+    return buckets
+
+
+def summarize(records, segments, args, elapsed_seconds):
+    total = len(records)
+    ok = [r for r in records if r["outcome"] == OUTCOME_OK]
+    throttles = sum(1 for r in records if r["outcome"] == THROTTLE)
+    fatal = sum(1 for r in records if r["outcome"] == FATAL)
+    errors = total - len(ok) - throttles
+    return {
+        "run_at": datetime.utcnow().isoformat() + "Z",
+        "target": "stub" if args.stub else {"agent_id": AGENT_ID, "agent_alias_id": AGENT_ALIAS_ID},
+        "profile": [{"start_rps": s, "end_rps": e, "seconds": d} for s, e, d in segments],
+        "arrival": args.arrival,
+        "requests": total,
+        "elapsed_seconds": round(elapsed_seconds, 3),
+        "throughput_rps": round(len(ok) / elapsed_seconds, 3) if elapsed_seconds > 0 else 0.0,
+        "error_rate": round(errors / total, 4) if total else 0.0,
+        "throttle_rate": round(throttles / total, 4) if total else 0.0,
+        "fatal_errors": fatal,
+        "latency_ms": summarize_values([r["latency_ms"] for r in ok], PERCENTILES),
+        "service_ms": summarize_values([r["service_ms"] for r in ok], PERCENTILES),
+        "queue_ms": summarize_values([r["queue_ms"] for r in records], PERCENTILES),
+        "first_chunk_ms": summarize_values(
+            [r["first_chunk_ms"] for r in ok if r["first_chunk_ms"] != ""], PERCENTILES
+        ),
+        "timeline": throughput_over_time(records, args.bucket_seconds),
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Open-loop load test for the Bedrock agent alias.")
+    parser.add_argument("--input", default=INPUT_CSV_PATH, help="Testset CSV whose user_input rows are replayed")
+    parser.add_argument(
+        "--profile",
+        default=os.getenv("LOADTEST_PROFILE", "1:60"),
+        help='Arrival rate segments "rate:seconds" or "start-end:seconds" (ramp), comma-separated',
+    )
+    parser.add_argument("--arrival", choices=["poisson", "uniform"], default="poisson")
+    parser.add_argument(
+        "--max-concurrency",
+        type=int,
+        default=int(os.getenv("LOADTEST_MAX_CONCURRENCY", "256")),
+        help="Client threads; requests beyond this wait and the wait shows up as queue_ms",
+    )
+    parser.add_argument("--bucket-seconds", type=float, default=5.0, help="Timeline bucket width")
+    parser.add_argument("--seed", type=int, default=config.SEED)
+    parser.add_argument("--out-dir", default=OUTPUT_DIR)
+
+    stub = parser.add_argument_group("stub agent (offline)")
+    stub.add_argument("--stub", action="store_true", help="Use the local stub agent instead of AWS")
+    stub.add_argument("--stub-distribution", choices=LATENCY_DISTRIBUTIONS, default="lognormal")
+    stub.add_argument("--stub-latency-ms", type=float, default=1500.0)
+    stub.add_argument("--stub-spread-ms", type=float, default=500.0)
+    stub.add_argument("--stub-sigma", type=float, default=0.5)
+    stub.add_argument("--stub-throttle-rate", type=float, default=0.0)
+    stub.add_argument("--stub-error-rate", type=float, default=0.0)
+    stub.add_argument("--stub-max-concurrency", type=int, default=None)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if not os.path.exists(args.input):
+        print(f"Input file not found: {args.input}")
+        return
+
+    inputs = load_inputs(args.input)
+    if not inputs:
+        print(f"No user_input rows found in: {args.input}")
+        return
+
+    segments = parse_profile(args.profile)
+    schedule = arrival_times(segments, args.arrival, args.seed)
+    if args.stub:
+        client = StubAgentClient(
+            distribution=args.stub_distribution,
+            latency_ms=args.stub_latency_ms,
+            spread_ms=args.stub_spread_ms,
+            sigma=args.stub_sigma,
+            throttle_rate=args.stub_throttle_rate,
+            error_rate=args.stub_error_rate,
+            max_concurrency=args.stub_max_concurrency,
+            seed=args.seed,
+        )
+    else:
+        client = get_agent_client()
+
+    run_id = datetime.utcnow().strftime("%Y%m%dT%H%M%S")
+    print(f"Load test {run_id}: {len(schedule)} requests over {sum(s[2] for s in segments):.0f}s ({args.arrival})")
+    started = time.monotonic()
+    records = run_load(client, inputs, schedule, args.max_concurrency, run_id)
+    elapsed = time.monotonic() - started
+
+    requests_path = os.path.join(args.out_dir, f"loadtest_{run_id}_requests.csv")
+    summary_path = os.path.join(args.out_dir, f"loadtest_{run_id}_summary.json")
+    ensure_parent_dir(requests_path)
+    with open(requests_path, "w", encoding="utf-8", newline="") as out_file:
+        writer = csv.DictWriter(out_file, fieldnames=REQUEST_COLUMNS)
+        writer.writeheader()
+        writer.writerows(records)
+
+    summary = summarize(records, segments, args, elapsed)
+    with open(summary_path, "w", encoding="utf-8") as summary_file:
+        json.dump(summary, summary_file, ensure_ascii=False, indent=2)
+
+    latency = summary["latency_ms"]
+    print(
+        f"Done. {summary['throughput_rps']} ok req/s | latency p50 {latency['p50']} ms, "
+        f"p95 {latency['p95']} ms, p99 {latency['p99']} ms | error rate {summary['error_rate']:.1%} | "
+        f"throttle rate {summary['throttle_rate']:.1%}"
+    )
+    print(f"Saved: {requests_path}")
+    print(f"Saved: {summary_path}")
+
+
+if __name__ == "__main__":
+    main()
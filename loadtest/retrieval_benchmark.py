@@ -0,0 +1,249 @@
+import argparse
+import importlib
+import json
+import os
+import random
+import time
+from datetime import datetime
+
+import pandas as pd
+
+import config
+from latency_stats import summarize_values
+from loadtest.stub_kb import StubKBClient
+from parallel import ordered_map
+from retrieval_store import compact_results
+from throttling import AdaptiveConcurrencyController
+
+# Run from the repo root: python -m loadtest.retrieval_benchmark --k 2,5,10 --search-types SEMANTIC,HYBRID
+retriever = importlib.import_module("4_retriever")
+evaluator = importlib.import_module("7_custom_evaluator")
+
+INPUT_CSV_PATH = os.getenv("RETRIEVAL_BENCHMARK_INPUT_CSV", config.OUTPUT_TESTSET_CSV)
+OUTPUT_DIR = os.getenv("RETRIEVAL_BENCHMARK_OUTPUT_DIR", "outputs/loadtest")
+SEARCH_TYPES = ("SEMANTIC", "HYBRID")
+ALL_STYLES = "ALL"
+OUTCOME_OK = "ok"
+
+
+def parse_csv_list(value, cast=str):
+    return [cast(item.strip()) for item in str(value).split(",") if item.strip()]
+
+
+def load_queries(path, sample, seed):
+    """Testset rows (user_input, query_style, source_file, reference text), sampled without replacement."""
+    df = pd.read_csv(path)
+    df = df[df["user_input"].fillna("").astype(str).str.strip() != ""]
+    if sample and sample < len(df):
+        df = df.sample(n=sample, random_state=seed)
+    queries = []
+    for _, row in df.iterrows():
+        references = evaluator.parse_list(row.get("reference_contexts", ""))
+        queries.append({
+            "query": str(row["user_input"]),
+            "query_style": str(row.get("query_style") or "unknown"),
+            "source_file": "" if pd.isna(row.get("source_file")) else str(row.get("source_file")),
+            "reference": references[0] if references else "",
+        })
+    return queries
+
+
+def payload_bytes(response):
+    """Response body size: the HTTP content-length when boto3 reports it, else the JSON size of the results."""
+    headers = (response.get("ResponseMetadata") or {}).get("HTTPHeaders") or {}
+    if "content-length" in headers:
+        return int(headers["content-length"])
+    body = {key: value for key, value in response.items() if key != "ResponseMetadata"}
+    return len(json.dumps(body, ensure_ascii=False, default=str).encode("utf-8"))
+
+
+def run_query(client, item, number_of_results, search_type):
+    """One retrieve with the same request and parsing as retrieve_contexts, plus timing and payload size."""
+    error_log = []
+    started = time.monotonic()
+    response = retriever.retrieve_response(item["query"], client, error_log, number_of_results, search_type)
+    record = {
+        "number_of_results": number_of_results,
+        "search_type": search_type,
+        "query_style": item["query_style"],
+        "latency_ms": round((time.monotonic() - started) * 1000, 3),
+        "outcome": OUTCOME_OK,
+        "error": "",
+        "payload_bytes": 0,
+        "results": 0,
+        "top_score": None,
+        "source_rank": 0,
+        "text_rank": 0,
+    }
+    if response is None:
+        record["outcome"] = error_log[-1]["error_type"] if error_log else "error"
+        record["error"] = error_log[-1]["error"][:300] if error_log else ""
+        return record
+
+    texts, files, scores = retriever.ranked_lists(compact_results(response))
+    _, source_rank = evaluator.contains_source_file(item["source_file"], files)
+    _, text_rank = evaluator.contains_reference_text(item["reference"], texts) if item["reference"] else (False, 0)
+    record.update({
+        "payload_bytes": payload_bytes(response),
+        "results": len(texts),
+        "top_score": scores[0] if scores else None,
+        "source_rank": source_rank,
+        "text_rank": text_rank,
+    })
+    return record
+
+
+def run_grid(client, queries, grid, workers, repeats, warmup, seed):
+    """
+    Runs every query under every (numberOfResults, search type) configuration.
+    Configurations are shuffled per repeat so slow drifts in KB latency do not
+    land on one configuration; the first `warmup` calls of each are discarded.
+    """
+    rng = random.Random(seed)
+    records = []
+    for repeat in range(repeats):
+        order = list(grid)
+        rng.shuffle(order)
+        for number_of_results, search_type in order:
+            for item in queries[:warmup]:
+                run_query(client, item, number_of_results, search_type)
+            started = time.monotonic()
+            batch = [
+                record
+                for _, record in ordered_map(
+                    lambda item: run_query(client, item, number_of_results, search_type), queries, workers
+                )
+            ]
+            for record in batch:
+                record["repeat"] = repeat
+            records.extend(batch)
+            latency = summarize_values([r["latency_ms"] for r in batch if r["outcome"] == OUTCOME_OK], (50, 95))
+            print(
+                f"[repeat {repeat + 1}/{repeats}] k={number_of_results} {search_type}: "
+                f"p50 {latency['p50']} ms | p95 {latency['p95']} ms | {time.monotonic() - started:.1f}s"
+            )
+    return records
+
+
+def summarize_group(records):
+    ok = [r for r in records if r["outcome"] == OUTCOME_OK]
+    latency = summarize_values([r["latency_ms"] for r in ok], (50, 95, 99))
+    payload = summarize_values([r["payload_bytes"] for r in ok], (50, 95))
+    top_scores = [r["top_score"] for r in ok if r["top_score"] is not None]
+    return {
+        "requests": len(records),
+        "errors": len(records) - len(ok),
+        "error_rate": round((len(records) - len(ok)) / len(records), 4) if records else 0.0,
+        "latency_p50_ms": latency["p50"],
+        "latency_p95_ms": latency["p95"],
+        "latency_p99_ms": latency["p99"],
+        "latency_mean_ms": round(sum(r["latency_ms"] for r in ok) / len(ok), 3) if ok else None,
+        "payload_p50_bytes": payload["p50"],
+        "payload_p95_bytes": payload["p95"],
+        "payload_mean_bytes": round(sum(r["payload_bytes"] for r in ok) / len(ok), 1) if ok else None,
+        "results_mean": round(sum(r["results"] for r in ok) / len(ok), 3) if ok else None,
+        "top_score_mean": round(sum(top_scores) / len(top_scores), 4) if top_scores else None,
+        "hit_rate": round(sum(1 for r in ok if r["source_rank"] or r["text_rank"]) / len(ok), 4) if ok else None,
+        "source_hit_rate": round(sum(1 for r in ok if r["source_rank"]) / len(ok), 4) if ok else None,
+        "text_hit_rate": round(sum(1 for r in ok if r["text_rank"]) / len(ok), 4) if ok else None,
+    }
+
+
+def summarize(records):
+    """Tidy table: one row per configuration and query_style, plus an "ALL" row per configuration."""
+    groups = {}
+    for record in records:
+        config_key = (record["number_of_results"], record["search_type"])
+        groups.setdefault(config_key + (record["query_style"],), []).append(record)
+        groups.setdefault(config_key + (ALL_STYLES,), []).append(record)
+    rows = []
+    for (number_of_results, search_type, query_style), group in sorted(groups.items()):
+        rows.append({
+            "number_of_results": number_of_results,
+            "search_type": search_type,
+            "query_style": query_style,
+            **summarize_group(group),
+        })
+    return pd.DataFrame(rows)
+
+
+def build_stub_client(queries, seed):
+    corpus = [(item["reference"] or item["query"], f"s3://stub-kb/{item['source_file'] or 'unknown'}") for item in queries]
+    sources = {item["query"]: pair for item, pair in zip(queries, corpus)}
+    return StubKBClient(corpus, sources, seed=seed)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Retrieve latency / payload / hit-rate benchmark over a grid of KB configurations.")
+    parser.add_argument("--input", default=INPUT_CSV_PATH, help="Testset CSV (user_input, query_style, source_file, reference_contexts)")
+    parser.add_argument("--k", default=",".join(str(k) for k in config.EVAL_K_VALUES), help="numberOfResults values")
+    parser.add_argument("--search-types", default=",".join(SEARCH_TYPES), help="overrideSearchType values")
+    parser.add_argument("--sample", type=int, default=50, help="Queries sampled from the testset (0 = all)")
+    parser.add_argument("--repeats", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=4, help="Concurrent retrieve calls")
+    parser.add_argument("--warmup", type=int, default=2, help="Unrecorded calls per configuration")
+    parser.add_argument("--max-retries", type=int, default=0, help="0 = throttles show up as errors, as in the load test")
+    parser.add_argument("--seed", type=int, default=config.SEED)
+    parser.add_argument("--out-dir", default=OUTPUT_DIR)
+    parser.add_argument("--stub", action="store_true", help="Use the local stub KB instead of AWS")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if not os.path.exists(args.input):
+        print(f"Input file not found: {args.input}")
+        return
+    queries = load_queries(args.input, args.sample, args.seed)
+    if not queries:
+        print(f"No user_input rows found in: {args.input}")
+        return
+
+    search_types = [value.upper() for value in parse_csv_list(args.search_types)]
+    unknown = [value for value in search_types if value not in SEARCH_TYPES]
+    if unknown:
+        print(f"Unknown search types: {', '.join(unknown)} (expected {', '.join(SEARCH_TYPES)})")
+        return
+    grid = [(k, search_type) for k in parse_csv_list(args.k, int) for search_type in search_types]
+
+    # Fixed concurrency for the whole run: the AIMD limiter would otherwise
+    # change the load between configurations.
+    retriever.RETRY_CONTROLLER = AdaptiveConcurrencyController(
+        max_retries=args.max_retries,
+        initial_concurrency=args.workers,
+        min_concurrency=args.workers,
+        max_concurrency=args.workers,
+    )
+    client = build_stub_client(queries, args.seed) if args.stub else retriever.get_runtime_client()
+
+    run_id = datetime.utcnow().strftime("%Y%m%dT%H%M%S")
+    styles = pd.Series([item["query_style"] for item in queries]).value_counts().to_dict()
+    print(
+        f"Retrieval benchmark {run_id}: {len(queries)} queries x {len(grid)} configurations x "
+        f"{args.repeats} repeats, {args.workers} workers | styles {styles}"
+    )
+    records = run_grid(client, queries, grid, args.workers, args.repeats, args.warmup, args.seed)
+
+    summary = summarize(records)
+    summary.insert(0, "run_id", run_id)
+    summary.insert(1, "kb_id", config.KB_ID)
+    requests_df = pd.DataFrame(records)
+    requests_df.insert(0, "run_id", run_id)
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    summary_path = os.path.join(args.out_dir, f"retrieval_benchmark_{run_id}.parquet")
+    requests_path = os.path.join(args.out_dir, f"retrieval_benchmark_{run_id}_requests.parquet")
+    summary.to_parquet(summary_path, index=False)
+    requests_df.to_parquet(requests_path, index=False)
+
+    overall = summary[summary["query_style"] == ALL_STYLES]
+    print(overall[[
+        "number_of_results", "search_type", "latency_p50_ms", "latency_p95_ms", "latency_p99_ms",
+        "payload_mean_bytes", "hit_rate", "error_rate",
+    ]].to_string(index=False))
+    print(f"Saved: {summary_path}")
+    print(f"Saved: {requests_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+import random
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+LATENCY_DISTRIBUTIONS = ("fixed", "uniform", "exponential", "lognormal")
+
+
+def _client_error(code, message):
+    return ClientError({"Error": {"Code": code, "Message": message}}, "InvokeAgent")
+
+
+class StubAgentClient:
+    """
+    Offline stand-in for a bedrock-agent-runtime client: invoke_agent() returns a
+    completion stream that sleeps according to a latency distribution, so the
+    load-test harness can be exercised without AWS.
+
+    latency_ms is the median (lognormal), mean (exponential), fixed value or
+    centre of a +/- spread_ms window (uniform). Requests above max_concurrency
+    in flight, plus a random throttle_rate share, fail with a
+    throttlingException; error_rate share fail with an internalServerException.
+    """
+
+    def __init__(
+        self,
+        distribution="lognormal",
+        latency_ms=1500.0,
+        spread_ms=500.0,
+        sigma=0.5,
+        first_chunk_fraction=0.6,
+        chunks=3,
+        throttle_rate=0.0,
+        error_rate=0.0,
+        max_concurrency=None,
+        seed=None,
+    ):
+        if distribution not in LATENCY_DISTRIBUTIONS:
+            raise ValueError(f"Unknown latency distribution: {distribution}")
+        self.distribution = distribution
+        self.latency_ms = latency_ms
+        self.spread_ms = spread_ms
+        self.sigma = sigma
+        self.first_chunk_fraction = first_chunk_fraction
+        self.chunks = max(1, chunks)
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.max_concurrency = max_concurrency
+        self.in_flight = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def sample_latency_ms(self):
+        with self._lock:
+            if self.distribution == "fixed":
+                return self.latency_ms
+            if self.distribution == "uniform":
+                return max(0.0, self._rng.uniform(self.latency_ms - self.spread_ms, self.latency_ms + self.spread_ms))
+            if self.distribution == "exponential":
+                return self._rng.expovariate(1.0 / self.latency_ms)
+            return self._rng.lognormvariate(0.0, self.sigma) * self.latency_ms
+
+    def _draw(self):
+        with self._lock:
+            return self._rng.random()
+
+    def invoke_agent(self, agentId=None, agentAliasId=None, sessionId=None, inputText="", **kwargs):
+        with self._lock:
+            saturated = self.max_concurrency is not None and self.in_flight >= self.max_concurrency
+            if not saturated:
+                self.in_flight += 1
+        if saturated or self._draw() < self.throttle_rate:
+            if not saturated:
+                with self._lock:
+                    self.in_flight -= 1
+            raise _client_error("throttlingException", "Stub agent: rate exceeded")
+        if self._draw() < self.error_rate:
+            with self._lock:
+                self.in_flight -= 1
+            raise _client_error("internalServerException", "Stub agent: internal error")
+
+        total_seconds = self.sample_latency_ms() / 1000.0
+        return {"sessionId": sessionId, "completion": self._stream(inputText, total_seconds)}
+
+    def _stream(self, input_text, total_seconds):
+        try:
+            first = total_seconds * self.first_chunk_fraction
+            time.sleep(first)
+            rest = (total_seconds - first) / max(1, self.chunks - 1) if self.chunks > 1 else 0.0
+            for index in range(self.chunks):
+                if index:
+                    time.sleep(rest)
+                yield {"chunk": {"bytes": f"[stub {index}] {input_text[:40]} ".encode("utf-8")}}
+        finally:
+            with self._lock:
+                self.in_flight -= 1
@@ -0,0 +1,50 @@
+import random
+import threading
+import time
+
+SEARCH_TYPE_FACTORS = {"SEMANTIC": 1.0, "HYBRID": 1.4}
+
+
+class StubKBClient:
+    """
+    Offline stand-in for a bedrock-agent-runtime client: retrieve() sleeps for
+    a lognormal latency that grows with numberOfResults (and more for HYBRID),
+    then returns that many results drawn from a corpus of (text, uri) pairs.
+    Each query's source is returned at a random rank with probability
+    hit_rate, so the benchmark's hit-rate columns have something to measure.
+    """
+
+    def __init__(self, corpus, sources=None, base_ms=120.0, per_result_ms=8.0, sigma=0.3, hit_rate=0.7, seed=None):
+        self.corpus = corpus
+        self.sources = sources or {}
+        self.base_ms = base_ms
+        self.per_result_ms = per_result_ms
+        self.sigma = sigma
+        self.hit_rate = hit_rate
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def retrieve(self, knowledgeBaseId=None, retrievalQuery=None, retrievalConfiguration=None, **kwargs):
+        query = (retrievalQuery or {}).get("text", "")
+        vector_search = (retrievalConfiguration or {}).get("vectorSearchConfiguration") or {}
+        k = int(vector_search.get("numberOfResults", 5))
+        factor = SEARCH_TYPE_FACTORS.get(vector_search.get("overrideSearchType"), 1.0)
+        with self._lock:
+            latency_ms = (self.base_ms + self.per_result_ms * k) * factor * self._rng.lognormvariate(0.0, self.sigma)
+            picks = self._rng.sample(self.corpus, min(k, len(self.corpus)))
+            hit_rank = self._rng.randrange(len(picks)) if picks and self._rng.random() < self.hit_rate else None
+        time.sleep(latency_ms / 1000.0)
+
+        if hit_rank is not None and query in self.sources:
+            picks[hit_rank] = self.sources[query]
+        return {
+            "retrievalResults": [
+                {
+                    "content": {"text": text},
+                    "location": {"type": "S3", "s3Location": {"uri": uri}},
+                    "score": round(1.0 - rank / (2.0 * max(1, k)), 4),
+                    "metadata": {},
+                }
+                for rank, (text, uri) in enumerate(picks)
+            ]
+        }
@@ -0,0 +1,358 @@
+import argparse
+import hashlib
+import json
+import os
+import re
+import time
+import unicodedata
+from datetime import datetime
+
+import numpy as np
+from scipy import sparse
+
+import config
+from embedding_store import EmbeddingStore, titan_embedder
+from kb_chunker import TokenEstimator, chunk_document, load_token_counts, normalize_file_key
+from kb_loader import read_kb_texts, scan_kb
+
+TOKEN_RE = re.compile(r"\w+")
+LOCAL_URI_PREFIX = "local://"
+BM25_K1 = 1.2
+BM25_B = 0.75
+SEARCH_BATCH_SIZE = 512
+
+
+def tokenize(text):
+    """Lower-cased word tokens with accents stripped, so "interés" matches "interes"."""
+    decomposed = unicodedata.normalize("NFKD", str(text or "").lower())
+    stripped = "".join(ch for ch in decomposed if not unicodedata.combining(ch))
+    return TOKEN_RE.findall(stripped)
+
+
+def clean_text(text):
+    """Same whitespace cleanup 4_retriever.py applies to KB results."""
+    return " ".join((text or "").split())
+
+
+def load_corpus(root=None, chunking=None):
+    """
+    Reads the KB into retrieval units: whole documents, or kb_chunker chunks
+    when chunking is on. Returns (docs, fingerprint); each doc has id, text and
+    uri. The fingerprint changes when any file or the chunk settings change.
+    """
+    root = root or config.KB_FOLDER
+    chunking = config.CHUNKING_ENABLED if chunking is None else chunking
+    entries = scan_kb(root)
+    documents = read_kb_texts(entries)
+
+    estimator = None
+    if chunking:
+        estimator = TokenEstimator(load_token_counts(config.TOKEN_COUNTS_CSV))
+        estimator.calibrate({normalize_file_key(entry["path"]): text for entry, text, _ in documents})
+
+    docs = []
+    for entry, text, _ in documents:
+        uri = LOCAL_URI_PREFIX + entry["rel_path"]
+        if estimator is None:
+            docs.append({"id": entry["bd_code"] or entry["rel_path"], "text": text, "uri": uri})
+            continue
+        for chunk in chunk_document(
+            text,
+            normalize_file_key(entry["path"]),
+            entry["bd_code"],
+            estimator,
+            config.CHUNK_SIZE_TOKENS,
+            int(config.CHUNK_SIZE_TOKENS * config.CHUNK_OVERLAP_PCT / 100),
+        ):
+            docs.append({"id": chunk["chunk_id"], "text": chunk["text"], "uri": uri})
+
+    return docs, corpus_fingerprint(entries, chunking)
+
+
+def corpus_fingerprint(entries, chunking=None):
+    """Hash of the scan_kb entries (path + content hash) and the chunk settings; no file is read."""
+    chunking = config.CHUNKING_ENABLED if chunking is None else chunking
+    digest = hashlib.sha256()
+    digest.update(json.dumps(
+        [chunking, config.CHUNK_SIZE_TOKENS, config.CHUNK_OVERLAP_PCT] if chunking else [False],
+    ).encode("utf-8"))
+    for entry in entries:
+        digest.update(f"{entry['rel_path']}\0{entry['sha256']}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def top_k(scores, k):
+    """Row-wise top-k of a dense (queries x docs) score matrix: (indices, scores), best first."""
+    k = min(k, scores.shape[1])
+    if k <= 0:
+        empty = np.empty((scores.shape[0], 0))
+        return empty.astype(np.int64), empty
+    part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    part_scores = np.take_along_axis(scores, part, axis=1)
+    order = np.argsort(-part_scores, axis=1, kind="stable")
+    return np.take_along_axis(part, order, axis=1), np.take_along_axis(part_scores, order, axis=1)
+
+
+class BM25Index:
+    """
+    Okapi BM25 over a sparse term-document matrix. The BM25 weight of every
+    (term, doc) pair is precomputed, so scoring a batch of queries is one
+    sparse (queries x terms) @ (terms x docs) product.
+    """
+
+    def __init__(self, vocab, weights, k1=BM25_K1, b=BM25_B):
+        self.vocab = vocab
+        self.term_ids = {term: i for i, term in enumerate(vocab)}
+        self.weights = weights  # csr (terms x docs)
+        self.k1 = k1
+        self.b = b
+
+    @classmethod
+    def build(cls, texts, k1=BM25_K1, b=BM25_B):
+        term_ids = {}
+        rows, cols = [], []
+        for doc_id, text in enumerate(texts):
+            for token in tokenize(text):
+                rows.append(term_ids.setdefault(token, len(term_ids)))
+                cols.append(doc_id)
+        shape = (len(term_ids), len(texts))
+        counts = sparse.csr_matrix(
+            (np.ones(len(rows), dtype=np.float32), (rows, cols)), shape=shape
+        )
+        counts.sum_duplicates()
+
+        doc_len = np.asarray(counts.sum(axis=0)).ravel()
+        avg_len = doc_len.mean() if len(doc_len) else 0.0
+        doc_freq = np.diff(counts.indptr)
+        idf = np.log1p((len(texts) - doc_freq + 0.5) / (doc_freq + 0.5)).astype(np.float32)
+
+        tf = counts.data
+        norm = k1 * (1 - b + b * doc_len[counts.indices] / (avg_len or 1.0))
+        term_of_value = np.repeat(np.arange(shape[0]), doc_freq)
+        counts.data = (tf * (k1 + 1) / (tf + norm) * idf[term_of_value]).astype(np.float32)
+
+        vocab = [None] * len(term_ids)
+        for term, i in term_ids.items():
+            vocab[i] = term
+        return cls(vocab, counts, k1, b)
+
+    def query_matrix(self, queries):
+        rows, cols = [], []
+        for query_id, query in enumerate(queries):
+            for term_id in {self.term_ids[t] for t in tokenize(query) if t in self.term_ids}:
+                rows.append(query_id)
+                cols.append(term_id)
+        return sparse.csr_matrix(
+            (np.ones(len(rows), dtype=np.float32), (rows, cols)),
+            shape=(len(queries), len(self.vocab)),
+        )
+
+    def search(self, queries, k):
+        """Top-k (doc indices, scores) per query, best first; zero-score docs are dropped."""
+        results = []
+        for start in range(0, len(queries), SEARCH_BATCH_SIZE):
+            batch = queries[start:start + SEARCH_BATCH_SIZE]
+            scores = (self.query_matrix(batch) @ self.weights).toarray()
+            indices, top_scores = top_k(scores, k)
+            for doc_ids, doc_scores in zip(indices, top_scores):
+                keep = doc_scores > 0
+                results.append((doc_ids[keep].tolist(), doc_scores[keep].tolist()))
+        return results
+
+    def save(self, index_dir):
+        np.save(os.path.join(index_dir, "bm25_data.npy"), self.weights.data)
+        np.save(os.path.join(index_dir, "bm25_indices.npy"), self.weights.indices)
+        np.save(os.path.join(index_dir, "bm25_indptr.npy"), self.weights.indptr)
+        with open(os.path.join(index_dir, "bm25_vocab.json"), "w", encoding="utf-8") as f:
+            json.dump({"k1": self.k1, "b": self.b, "vocab": self.vocab, "shape": self.weights.shape}, f)
+
+    @classmethod
+    def load(cls, index_dir):
+        with open(os.path.join(index_dir, "bm25_vocab.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        arrays = [
+            np.load(os.path.join(index_dir, f"bm25_{name}.npy"), mmap_mode="r")
+            for name in ("data", "indices", "indptr")
+        ]
+        weights = sparse.csr_matrix(tuple(arrays), shape=tuple(meta["shape"]), copy=False)
+        return cls(meta["vocab"], weights, meta["k1"], meta["b"])
+
+
+class DenseIndex:
+    """
+    Cosine-similarity index over L2-normalized float32 document vectors,
+    stored as a raw memory-mapped file (dense.f32) so loading is instant.
+    """
+
+    def __init__(self, vectors):
+        self.vectors = vectors
+
+    @staticmethod
+    def normalize(vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms == 0, 1.0, norms)
+
+    @classmethod
+    def build(cls, vectors):
+        return cls(cls.normalize(vectors))
+
+    def search(self, query_vectors, k):
+        results = []
+        query_vectors = self.normalize(query_vectors)
+        for start in range(0, len(query_vectors), SEARCH_BATCH_SIZE):
+            scores = query_vectors[start:start + SEARCH_BATCH_SIZE] @ self.vectors.T
+            indices, top_scores = top_k(scores, k)
+            results.extend((i.tolist(), s.tolist()) for i, s in zip(indices, top_scores))
+        return results
+
+    def save(self, index_dir):
+        path = os.path.join(index_dir, "dense.f32")
+        out = np.memmap(path, dtype=np.float32, mode="w+", shape=self.vectors.shape)
+        out[:] = self.vectors
+        out.flush()
+        with open(os.path.join(index_dir, "dense.json"), "w", encoding="utf-8") as f:
+            json.dump({"shape": list(self.vectors.shape)}, f)
+
+    @classmethod
+    def load(cls, index_dir):
+        meta_path = os.path.join(index_dir, "dense.json")
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, "r", encoding="utf-8") as f:
+            shape = tuple(json.load(f)["shape"])
+        return cls(np.memmap(os.path.join(index_dir, "dense.f32"), dtype=np.float32, mode="r", shape=shape))
+
+
+class LocalRetriever:
+    """BM25 (and optionally dense) retrieval over a persisted local index of the KB."""
+
+    def __init__(self, index_dir, docs, bm25, dense=None, meta=None):
+        self.index_dir = index_dir
+        self.docs = docs
+        self.bm25 = bm25
+        self.dense = dense
+        self.meta = meta or {}
+
+    @classmethod
+    def build(cls, index_dir=None, root=None, embed=None):
+        """Builds and saves the index; embed(texts) adds the dense index."""
+        index_dir = index_dir or config.LOCAL_INDEX_DIR
+        os.makedirs(index_dir, exist_ok=True)
+        docs, fingerprint = load_corpus(root)
+        texts = [doc["text"] for doc in docs]
+
+        bm25 = BM25Index.build(texts)
+        bm25.save(index_dir)
+        dense = None
+        if embed is not None:
+            dense = DenseIndex.build(embed(texts))
+            dense.save(index_dir)
+        else:
+            # A dense index from an earlier build would index the old docs list.
+            for name in ("dense.f32", "dense.json"):
+                path = os.path.join(index_dir, name)
+                if os.path.exists(path):
+                    os.remove(path)
+
+        with open(os.path.join(index_dir, "docs.jsonl"), "w", encoding="utf-8") as f:
+            for doc in docs:
+                f.write(json.dumps(doc, ensure_ascii=False) + "\n")
+        meta = {
+            "created_at": datetime.utcnow().isoformat() + "Z",
+            "root": root or config.KB_FOLDER,
+            "fingerprint": fingerprint,
+            "docs": len(docs),
+            "vocab": len(bm25.vocab),
+            "dense": dense is not None,
+        }
+        with open(os.path.join(index_dir, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False, indent=2)
+        return cls(index_dir, docs, bm25, dense, meta)
+
+    @classmethod
+    def load(cls, index_dir=None):
+        index_dir = index_dir or config.LOCAL_INDEX_DIR
+        meta_path = os.path.join(index_dir, "meta.json")
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        with open(os.path.join(index_dir, "docs.jsonl"), "r", encoding="utf-8") as f:
+            docs = [json.loads(line) for line in f if line.strip()]
+        dense = DenseIndex.load(index_dir) if meta.get("dense") else None
+        return cls(index_dir, docs, BM25Index.load(index_dir), dense, meta)
+
+    def retrieve_batch(self, queries, k, backend="bm25", embed=None):
+        """
+        Top-k results for every query, in the shape of 4_retriever.retrieve_contexts:
+        a list of (texts, uris, scores) tuples.
+        """
+        queries = [str(query or "") for query in queries]
+        if backend == "dense":
+            if self.dense is None:
+                raise ValueError(f"No dense index in {self.index_dir}; rebuild with --dense")
+            if embed is None:
+                raise ValueError("Dense retrieval needs an embed function for the queries")
+            hits = self.dense.search(embed(queries), k)
+        elif backend == "bm25":
+            hits = self.bm25.search(queries, k)
+        else:
+            raise ValueError(f"Unknown local retrieval backend: {backend}")
+
+        results = []
+        for doc_ids, scores in hits:
+            docs = [self.docs[i] for i in doc_ids]
+            results.append((
+                [clean_text(doc["text"]) for doc in docs],
+                [doc["uri"] for doc in docs],
+                [round(float(score), 6) for score in scores],
+            ))
+        return results
+
+
+def stored_embedder(kind):
+    """Titan embed(texts) backed by the embedding store, so only unseen texts hit Bedrock."""
+    return EmbeddingStore().embedder(titan_embedder(), kind)
+
+
+def open_local_retriever(index_dir=None, root=None, dense=False):
+    """Loads the persisted index, rebuilding it when the KB (or chunk settings) changed."""
+    retriever = LocalRetriever.load(index_dir)
+    fingerprint = corpus_fingerprint(scan_kb(root or config.KB_FOLDER))
+    if retriever is not None and retriever.meta.get("fingerprint") == fingerprint:
+        if not dense or retriever.dense is not None:
+            return retriever
+    print("Building local retrieval index...")
+    return LocalRetriever.build(index_dir, root, stored_embedder("kb_chunk") if dense else None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or query the local BM25/dense index of the KB.")
+    parser.add_argument("--root", default=config.KB_FOLDER)
+    parser.add_argument("--index-dir", default=config.LOCAL_INDEX_DIR)
+    parser.add_argument("--dense", action="store_true", help="Also embed the corpus with Titan for dense search")
+    parser.add_argument("--query", action="append", default=[], help="Query to run after building (repeatable)")
+    parser.add_argument("--k", type=int, default=config.TOP_K)
+    args = parser.parse_args()
+
+    started = time.monotonic()
+    retriever = LocalRetriever.build(args.index_dir, args.root, stored_embedder("kb_chunk") if args.dense else None)
+    print(
+        f"Indexed {retriever.meta['docs']} units ({retriever.meta['vocab']} terms) "
+        f"in {time.monotonic() - started:.1f}s -> {args.index_dir}"
+    )
+
+    backend = "dense" if args.dense else "bm25"
+    for query, (texts, uris, scores) in zip(
+        args.query, retriever.retrieve_batch(
+            args.query, args.k, backend, stored_embedder("question") if args.dense else None
+        )
+    ):
+        print(f"\n{query}")
+        for uri, score, text in zip(uris, scores, texts):
+            print(f"  {score:.3f}  {uri}  {text[:80]}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,30 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+def ordered_map(fn, items, workers, max_in_flight=None):
+    """
+    Applies fn to every item on a thread pool and yields results in input order.
+
+    At most max_in_flight items (default: 2 * workers) are submitted ahead of the
+    item being yielded, so a lazy iterable is never consumed faster than its
+    results are drained.
+    """
+    workers = max(1, int(workers))
+    if workers == 1:
+        for item in items:
+            yield item, fn(item)
+        return
+
+    max_in_flight = max(workers, int(max_in_flight or 2 * workers))
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for item in items:
+            pending.append((item, executor.submit(fn, item)))
+            if len(pending) >= max_in_flight:
+                head_item, head_future = pending.popleft()
+                yield head_item, head_future.result()
+
+        while pending:
+            head_item, head_future = pending.popleft()
+            yield head_item, head_future.result()
@@ -0,0 +1,181 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import config
+from dedup import normalize_text, request_key
+
+
+def query_key(kb_id, query, search_type=None):
+    """Identity of a retrieve request apart from numberOfResults."""
+    return request_key(kb_id, query, search_type or "")
+
+
+def result_location(result):
+    """(location type, URI) of a retrievalResults item, whatever the data source."""
+    location = result.get("location") or {}
+    location_type = location.get("type", "")
+    for field, uri_field in (
+        ("s3Location", "uri"),
+        ("webLocation", "url"),
+        ("confluenceLocation", "url"),
+        ("salesforceLocation", "url"),
+        ("sharePointLocation", "url"),
+        ("customDocumentLocation", "id"),
+    ):
+        if field in location:
+            return location_type, location[field].get(uri_field, "") or ""
+    return location_type, ""
+
+
+def compact_results(response):
+    """The fields we use from a retrieve response: one dict per result, best first."""
+    results = []
+    for rank, result in enumerate((response or {}).get("retrievalResults", [])):
+        location_type, uri = result_location(result)
+        results.append({
+            "rank": rank,
+            "text": (result.get("content") or {}).get("text", "") or "",
+            "uri": uri,
+            "location_type": location_type,
+            "score": result.get("score"),
+            "metadata": result.get("metadata") or {},
+        })
+    return results
+
+
+class RetrievalStore:
+    """
+    Raw KB retrieve results, persisted once and indexed by request.
+
+    A request is identified by KB ID + normalized query + search type; its
+    results are stored uncleaned with score, location and metadata, together
+    with numberOfResults, so any K up to the stored one is served as a prefix
+    of the ranked list without another KB call.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        parent = os.path.dirname(path)
+        if parent:
+            os.makedirs(parent, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS requests ("
+            " key TEXT PRIMARY KEY,"
+            " kb_id TEXT NOT NULL,"
+            " query TEXT NOT NULL,"
+            " search_type TEXT NOT NULL,"
+            " number_of_results INTEGER NOT NULL,"
+            " result_count INTEGER NOT NULL,"
+            " latency_ms REAL,"
+            " retrieved_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            " key TEXT NOT NULL,"
+            " rank INTEGER NOT NULL,"
+            " text TEXT NOT NULL,"
+            " uri TEXT NOT NULL,"
+            " location_type TEXT NOT NULL,"
+            " score REAL,"
+            " metadata TEXT NOT NULL,"
+            " PRIMARY KEY (key, rank)) WITHOUT ROWID"
+        )
+        self._conn.commit()
+
+    def has(self, kb_id, query, number_of_results, search_type=None):
+        key = query_key(kb_id, query, search_type)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT number_of_results FROM requests WHERE key = ?", (key,)
+            ).fetchone()
+        return row is not None and row[0] >= number_of_results
+
+    def put(self, kb_id, query, number_of_results, response, latency_ms=None, search_type=None):
+        """Replaces the stored results of the request with those of response."""
+        key = query_key(kb_id, query, search_type)
+        results = compact_results(response)
+        with self._lock:
+            self._conn.execute("DELETE FROM results WHERE key = ?", (key,))
+            self._conn.execute(
+                "INSERT OR REPLACE INTO requests"
+                " (key, kb_id, query, search_type, number_of_results, result_count, latency_ms, retrieved_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    key, kb_id, normalize_text(query), search_type or "", number_of_results,
+                    len(results), latency_ms, time.time(),
+                ),
+            )
+            self._conn.executemany(
+                "INSERT INTO results (key, rank, text, uri, location_type, score, metadata)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        key, r["rank"], r["text"], r["uri"], r["location_type"], r["score"],
+                        json.dumps(r["metadata"], ensure_ascii=False, separators=(",", ":")),
+                    )
+                    for r in results
+                ],
+            )
+            self._conn.commit()
+        return results
+
+    def get(self, kb_id, query, top_k=None, search_type=None):
+        """
+        Returns (results, latency_ms) for the request, results truncated to
+        top_k, or None when it was never fetched (or only with a smaller K).
+        """
+        key = query_key(kb_id, query, search_type)
+        with self._lock:
+            request = self._conn.execute(
+                "SELECT number_of_results, latency_ms FROM requests WHERE key = ?", (key,)
+            ).fetchone()
+            if request is None or (top_k and request[0] < top_k):
+                self.misses += 1
+                return None
+            rows = self._conn.execute(
+                "SELECT rank, text, uri, location_type, score, metadata FROM results"
+                " WHERE key = ? ORDER BY rank LIMIT ?",
+                (key, top_k or -1),
+            ).fetchall()
+            self.hits += 1
+        results = [
+            {
+                "rank": rank,
+                "text": text,
+                "uri": uri,
+                "location_type": location_type,
+                "score": score,
+                "metadata": json.loads(metadata),
+            }
+            for rank, text, uri, location_type, score, metadata in rows
+        ]
+        return results, request[1]
+
+    def stats(self):
+        with self._lock:
+            requests, results = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(result_count), 0) FROM requests"
+            ).fetchone()
+        return {
+            "path": self.path,
+            "requests": requests,
+            "results": results,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def open_retrieval_store(path=None):
+    return RetrievalStore(path or config.RETRIEVAL_STORE_PATH)
@@ -0,0 +1,198 @@
+import random
+import threading
+import time
+from datetime import datetime
+
+from botocore.exceptions import BotoCoreError, ClientError, ConnectionError, HTTPClientError
+
+import config
+
+# Error codes are compared lower-cased: event stream errors (e.g. from
+# invoke_agent) use camelCase codes such as "throttlingException".
+THROTTLE_ERROR_CODES = {
+    "throttlingexception",
+    "throttling",
+    "toomanyrequestsexception",
+    "requestlimitexceeded",
+    "servicequotaexceededexception",
+}
+RETRYABLE_ERROR_CODES = {
+    "serviceunavailableexception",
+    "serviceunavailable",
+    "internalserverexception",
+    "internalfailure",
+    "modeltimeoutexception",
+    "modelnotreadyexception",
+    "dependencyfailedexception",
+    "badgatewayexception",
+    "requesttimeout",
+    "requesttimeoutexception",
+}
+
+THROTTLE = "throttle"
+RETRYABLE = "retryable"
+FATAL = "fatal"
+
+
+def error_code(error):
+    if isinstance(error, ClientError):
+        return (error.response.get("Error", {}).get("Code") or "").lower()
+    return ""
+
+
+def classify_error(error):
+    """
+    Returns THROTTLE, RETRYABLE or FATAL. Validation, access and not-found
+    errors are fatal: retrying them only burns quota.
+    """
+    code = error_code(error)
+    if code in THROTTLE_ERROR_CODES:
+        return THROTTLE
+    if code in RETRYABLE_ERROR_CODES:
+        return RETRYABLE
+    if isinstance(error, (ConnectionError, HTTPClientError)):
+        # Connect/read timeouts and dropped connections.
+        return RETRYABLE
+    if isinstance(error, (ClientError, BotoCoreError)):
+        return FATAL
+    if isinstance(error, (TimeoutError, OSError)):
+        return RETRYABLE
+    return FATAL
+
+
+class AdaptiveConcurrencyController:
+    """
+    Shared retry policy and in-flight limiter for Bedrock calls.
+
+    The in-flight limit follows AIMD: every success adds increase_step / limit
+    (about +increase_step per round of requests) and every throttle multiplies
+    it by decrease_factor, at most once per decrease_cooldown_seconds so one
+    burst of throttles counts as a single congestion signal. Throttles and
+    transient errors are retried with exponential backoff; fatal errors are
+    logged and not retried.
+    """
+
+    def __init__(
+        self,
+        max_retries=None,
+        backoff_base_seconds=None,
+        backoff_max_seconds=None,
+        backoff_jitter_seconds=None,
+        initial_concurrency=None,
+        min_concurrency=None,
+        max_concurrency=None,
+        increase_step=None,
+        decrease_factor=None,
+        decrease_cooldown_seconds=None,
+    ):
+        self.max_retries = config.MAX_RETRIES if max_retries is None else max_retries
+        self.backoff_base_seconds = (
+            config.BACKOFF_BASE_SECONDS if backoff_base_seconds is None else backoff_base_seconds
+        )
+        self.backoff_max_seconds = (
+            config.BACKOFF_MAX_SECONDS if backoff_max_seconds is None else backoff_max_seconds
+        )
+        self.backoff_jitter_seconds = (
+            config.BACKOFF_JITTER_SECONDS if backoff_jitter_seconds is None else backoff_jitter_seconds
+        )
+        self.min_concurrency = min_concurrency or config.ADAPTIVE_MIN_CONCURRENCY
+        self.max_concurrency = max_concurrency or config.ADAPTIVE_MAX_CONCURRENCY
+        self.limit = float(initial_concurrency or config.ADAPTIVE_INITIAL_CONCURRENCY)
+        self.limit = min(max(self.limit, self.min_concurrency), self.max_concurrency)
+        self.increase_step = increase_step or config.ADAPTIVE_INCREASE_STEP
+        self.decrease_factor = decrease_factor or config.ADAPTIVE_DECREASE_FACTOR
+        self.decrease_cooldown_seconds = (
+            config.ADAPTIVE_DECREASE_COOLDOWN_SECONDS
+            if decrease_cooldown_seconds is None else decrease_cooldown_seconds
+        )
+
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.attempts = 0
+        self.successes = 0
+        self.throttles = 0
+        self.retryable_errors = 0
+        self.fatal_errors = 0
+        self.started_at = None
+        self.finished_at = None
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= max(1, int(self.limit)):
+                self._cond.wait()
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            self.attempts += 1
+            if self.started_at is None:
+                self.started_at = time.monotonic()
+
+    def release(self, outcome):
+        with self._cond:
+            self.in_flight -= 1
+            self.finished_at = time.monotonic()
+            if outcome == "success":
+                self.successes += 1
+                self.limit = min(self.max_concurrency, self.limit + self.increase_step / self.limit)
+            elif outcome == THROTTLE:
+                self.throttles += 1
+                now = time.monotonic()
+                if now - self._last_decrease >= self.decrease_cooldown_seconds:
+                    self.limit = max(self.min_concurrency, self.limit * self.decrease_factor)
+                    self._last_decrease = now
+            elif outcome == RETRYABLE:
+                self.retryable_errors += 1
+            else:
+                self.fatal_errors += 1
+            self._cond.notify_all()
+
+    def backoff_sleep(self, attempt):
+        base = self.backoff_base_seconds * (2 ** attempt)
+        sleep_for = min(base, self.backoff_max_seconds)
+        sleep_for += random.uniform(0, self.backoff_jitter_seconds)
+        time.sleep(sleep_for)
+
+    def call(self, fn, operation_name, error_log):
+        """Runs fn() under the in-flight limit with retries; returns None after logging on failure."""
+        last_error = None
+        kind = FATAL
+        for attempt in range(self.max_retries + 1):
+            self.acquire()
+            try:
+                result = fn()
+            except Exception as e:
+                last_error = e
+                kind = classify_error(e)
+                self.release(kind)
+            else:
+                self.release("success")
+                return result
+
+            if kind == FATAL or attempt >= self.max_retries:
+                break
+            self.backoff_sleep(attempt)
+
+        error_log.append({
+            "timestamp": datetime.utcnow().isoformat() + "Z",
+            "operation": operation_name,
+            "error_type": kind,
+            "error": str(last_error),
+        })
+        return None
+
+    def stats(self):
+        elapsed = 0.0
+        if self.started_at is not None and self.finished_at is not None:
+            elapsed = self.finished_at - self.started_at
+        return {
+            "attempts": self.attempts,
+            "successes": self.successes,
+            "throttles": self.throttles,
+            "retryable_errors": self.retryable_errors,
+            "fatal_errors": self.fatal_errors,
+            "throttle_rate": round(self.throttles / self.attempts, 4) if self.attempts else 0.0,
+            "requests_per_second": round(self.successes / elapsed, 3) if elapsed > 0 else 0.0,
+            "final_concurrency_limit": round(self.limit, 2),
+            "peak_in_flight": self.peak_in_flight,
+        }